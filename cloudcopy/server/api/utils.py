@@ -15,3 +15,26 @@ def to_response(data, raw=False):
         )
 
     return {'data': data}
+
+
+def to_keyset_filter(cursor, operator, sort, key):
+    """Get a SQL filter for rows strictly before or after a keyset cursor
+
+    Arguments:
+        cursor: either "<sort value>" or "<sort value>,<key value>"
+            the latter is built from the last row of the previous page
+        operator: "<" (before) or ">" (after)
+        sort: name of the primary sort field, never null:
+            a row-value comparison with null is never true,
+            so rows with a null sort value would never be reached
+        key: name of the unique tie-breaking field
+
+    Returns:
+        (SQL condition, parameters)
+    """
+    value, _, id = cursor.partition(',')
+    if not id:
+        return f'"{sort}" {operator} ?', [value]
+
+    # row value comparison can use the (sort, key) index
+    return f'("{sort}", "{key}") {operator} (?, ?)', [value, id]
@@ -1,14 +1,19 @@
 import json
 import copy
-from typing import Optional, List
+import asyncio
+from typing import Optional, List, Any
 
 from adbc.store import Database as Storage
+from adbc.workflow import Workflow as Runner
 from pydantic import BaseModel
 from fastapi import Depends
 
 from cloudcopy.server.api import api
-from cloudcopy.server.models import Database
-from cloudcopy.server.storage import get_internal_database
+from cloudcopy.server.config import settings
+from cloudcopy.server.models import Database, DatabaseInfo
+from cloudcopy.server.storage import (
+    get_internal_reader, get_internal_writer, internal_writer
+)
 from ...utils import from_request, to_response
 
 VERSION = 'v0'
@@ -72,27 +77,180 @@ class EditDatabaseOut(SetDatabaseOut):
     pass
 
 
+class AddDatabasesIn(In):
+    data: List[Base]
+
+
+class DatabaseBatchIn(DatabaseIn):
+    id: str
+
+
+class EditDatabasesIn(In):
+    data: List[DatabaseBatchIn]
+
+
+class DeleteDatabasesIn(In):
+    # IDs or names
+    data: List[str]
+
+
 class DeleteDatabaseOut(Out):
     data: str
 
 
+class DatabaseInfoOut(BaseModel):
+    id: str
+    scope: Optional[dict] = None
+    info: Any
+    fetched: str
+    cached: bool
+
+
+class GetDatabaseInfoOut(Out):
+    data: DatabaseInfoOut
+
+
+async def introspect(url, scope=None):
+    """Get a database's schema and stats, by running an info step"""
+    step = {'type': 'info', 'source': url}
+    if scope:
+        step['scope'] = scope
+    runner = Runner('database-info', steps=[step], verbose=settings.DEBUG)
+    result = await runner.execute()
+    return result[0] if result else None
+
+
+# (database ID, scope) -> introspection in progress
+# concurrent requests for the same info share one introspection
+_introspections = {}
+
+
+async def fetch_info(database, scope):
+    """Introspect a database and cache the result
+
+    Returns:
+        (info, fetched time)
+    """
+    info = await introspect(database['url'], scope)
+    async with internal_writer() as writer:
+        info_model = await DatabaseInfo.initialize(writer)
+        fetched = await info_model.save(
+            database['id'], database['url'], scope, info
+        )
+        await info_model.evict(
+            database['id'],
+            settings.DATABASE_INFO_TTL,
+            settings.DATABASE_INFO_MAX_SCOPES
+        )
+    return info, fetched
+
+
+async def _get_info(database, scope):
+    """Fetch a database's info, or join a fetch already in progress"""
+    key = (database['id'], DatabaseInfo.to_scope(scope))
+    fetching = _introspections.get(key)
+    if fetching is None:
+        fetching = _introspections[key] = asyncio.ensure_future(
+            fetch_info(database, scope)
+        )
+        fetching.add_done_callback(lambda _: _introspections.pop(key, None))
+    # shielded, so that a caller that disconnects
+    # does not cancel the introspection for the others
+    return await asyncio.shield(fetching)
+
 
 @api.get(f"/{VERSION}/{ENDPOINT}/", response_model=GetDatabasesOut)
-async def get_databases(db: Storage = Depends(get_internal_database)):
+async def get_databases(db: Storage = Depends(get_internal_reader)):
     model = await Database.initialize(db)
-    result = await model.get()
-    return to_response(result)
+    result = await model.get_json(fields=DatabaseOut.__fields__)
+    return to_response(result, raw=True)
+
+
+@api.post(f"/{VERSION}/{ENDPOINT}/batch/", response_model=GetDatabasesOut, status_code=201)
+async def add_databases(data: AddDatabasesIn, db: Storage = Depends(get_internal_writer)):
+    items = from_request(data)
+
+    model = await Database.initialize(db)
+    records = [model.to_record(item) for item in items]
+    result = await model.add_records(records, fields=DatabaseOut.__fields__)
+
+    return to_response(result, raw=True)
+
+
+@api.patch(f"/{VERSION}/{ENDPOINT}/batch/", response_model=GetDatabasesOut)
+async def edit_databases(data: EditDatabasesIn, db: Storage = Depends(get_internal_writer)):
+    items = from_request(data, patch=True)
+
+    model = await Database.initialize(db)
+    records = [model.to_record(item) for item in items]
+    result = await model.edit_records(records, fields=DatabaseOut.__fields__)
+
+    return to_response(result, raw=True)
+
+
+@api.delete(f"/{VERSION}/{ENDPOINT}/batch/", status_code=204)
+async def delete_databases(data: DeleteDatabasesIn, db: Storage = Depends(get_internal_writer)):
+    model = await Database.initialize(db)
+    await model.delete_records(from_request(data))
+    # return 204 (No Content) with empty body
+    return {}
 
 
 @api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/", response_model=GetDatabaseOut)
-async def get_database(id: str, db: Storage = Depends(get_internal_database)):
+async def get_database(id: str, db: Storage = Depends(get_internal_reader)):
     model = await Database.initialize(db)
     result = await model.get_record(id)
     return to_response(result)
 
 
+@api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/info/", response_model=GetDatabaseInfoOut)
+async def get_database_info(
+    id: str,
+    scope: Optional[str] = None,
+    refresh: bool = False,
+    db: Storage = Depends(get_internal_reader)
+):
+    """Get a database's schema and stats
+
+    Results are cached per database and scope for DATABASE_INFO_TTL
+    seconds, up to DATABASE_INFO_MAX_SCOPES scopes per database,
+    and dropped when the database is changed
+
+    Arguments:
+        scope: JSON-encoded scope, defaults to the database's scope
+        refresh: introspect the database even if cached
+    """
+    model = await Database.initialize(db)
+    database = await model.get_record(id)
+    if scope is None:
+        scope = database['scope']
+        if isinstance(scope, str):
+            scope = json.loads(scope)
+    else:
+        try:
+            scope = json.loads(scope)
+        except ValueError:
+            raise ValueError(f'Invalid scope: "{scope}", expecting JSON')
+
+    info_model = await DatabaseInfo.initialize(db)
+    cached = None if refresh else await info_model.get_value(
+        database['id'], scope, settings.DATABASE_INFO_TTL
+    )
+    if cached:
+        info, fetched = cached
+    else:
+        info, fetched = await _get_info(database, scope)
+    return to_response({
+        'id': database['id'],
+        'scope': scope,
+        'info': info,
+        'fetched': fetched,
+        'cached': cached is not None
+    })
+
+
 @api.post(f"/{VERSION}/{ENDPOINT}/", response_model=AddDatabaseOut, status_code=201)
-async def add_database(data: AddDatabaseIn, db: Storage = Depends(get_internal_database)):
+async def add_database(data: AddDatabaseIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(data)
 
     model = await Database.initialize(db)
@@ -103,7 +261,7 @@ async def add_database(data: AddDatabaseIn, db: Storage = Depends(get_internal_d
 
 
 @api.put(f"/{VERSION}/{ENDPOINT}/{{id}}/", response_model=SetDatabaseOut)
-async def set_database(id: str, data: SetDatabaseIn, db: Storage = Depends(get_internal_database)):
+async def set_database(id: str, data: SetDatabaseIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(data)
 
     model = await Database.initialize(db)
@@ -114,7 +272,7 @@ async def set_database(id: str, data: SetDatabaseIn, db: Storage = Depends(get_i
 
 
 @api.patch(f'/{VERSION}/{ENDPOINT}/{{id}}/')
-async def edit_database(id: str, data: EditDatabaseIn, db: Storage = Depends(get_internal_database)):
+async def edit_database(id: str, data: EditDatabaseIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(data, patch=True)
 
     model = await Database.initialize(db)
@@ -125,7 +283,7 @@ async def edit_database(id: str, data: EditDatabaseIn, db: Storage = Depends(get
 
 
 @api.delete(f'/{VERSION}/{ENDPOINT}/{{id}}/', status_code=204)
-async def delete_database(id: str, db: Storage = Depends(get_internal_database)):
+async def delete_database(id: str, db: Storage = Depends(get_internal_writer)):
     model = await Database.initialize(db)
     result = await model.delete_record(id)
     # return 204 (No Content) with empty body
@@ -1,15 +1,21 @@
+import os
 import json
+import asyncio
 import copy
 from typing import Optional, List
 
 from adbc.store import Database as Storage
 from pydantic import BaseModel
 from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 
 from cloudcopy.server.api import api
 from cloudcopy.server.models import Job
-from cloudcopy.server.storage import get_internal_database
-from ...utils import from_request, to_response
+from cloudcopy.server.storage import get_internal_reader, get_internal_writer
+from cloudcopy.server.config import settings
+from cloudcopy.server.logs import read_log, follow_log
+from ...utils import from_request, to_response, to_keyset_filter
 
 VERSION = 'v0'
 ENDPOINT = 'jobs'
@@ -51,30 +57,171 @@ class GetJobsOut(Out):
     data: List[JobOut]
 
 
+class LogLineOut(BaseModel):
+    time: str
+    message: str
+
+
+class GetJobLogsOut(Out):
+    data: List[LogLineOut]
+
+
 class DeleteJobOut(Out):
     data: str
 
 
 @api.get(f"/{VERSION}/{ENDPOINT}/", response_model=GetJobsOut)
-async def get_jobs(db: Storage = Depends(get_internal_database), f__workflow_id: Optional[str] = None):
+async def get_jobs(
+    db: Storage = Depends(get_internal_reader),
+    f__workflow_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    ascending: bool = False
+):
+    """Get a page of jobs, ordered by (created, id)
+
+    "before" and "after" are keyset cursors: either a timestamp,
+    or "<created>,<id>" of the last job in the previous page.
+    Jobs are keyed by creation, which unlike "started" is never null
+    (e.g. for queued jobs)
+    """
+    if limit is None:
+        limit = settings.PAGE_SIZE
+    limit = max(1, min(limit, settings.MAX_PAGE_SIZE))
+
     model = await Job.initialize(db)
-    query = model
+    filters = []
+    params = []
     if f__workflow_id:
-        query = query.where({'=': ['workflow_id', f'"{f__workflow_id}"']})
-
-    result = await query.get()
-    return to_response(result)
+        filters.append('"workflow_id" = ?')
+        params.append(f__workflow_id)
+    for cursor, operator in ((before, '<'), (after, '>')):
+        if cursor:
+            condition, values = to_keyset_filter(cursor, operator, 'created', 'id')
+            filters.append(condition)
+            params.extend(values)
+
+    order = 'ASC' if ascending else 'DESC'
+    result = await model.get_json(
+        fields=JobOut.__fields__,
+        where=' AND '.join(filters),
+        params=params,
+        sort=f'"created" {order}, "id" {order}',
+        limit=limit
+    )
+    return to_response(result, raw=True)
 
 
 @api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/", response_model=GetJobOut)
-async def get_job(id: str, db: Storage = Depends(get_internal_database)):
+async def get_job(id: str, db: Storage = Depends(get_internal_reader)):
     model = await Job.initialize(db)
     result = await model.get_record(id)
     return to_response(result)
 
 
+@api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/logs/", response_model=GetJobLogsOut)
+async def get_job_logs(
+    id: str,
+    db: Storage = Depends(get_internal_reader),
+    limit: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    ascending: bool = True
+):
+    """Get a job's log lines within a time window"""
+    if limit is None:
+        limit = settings.PAGE_SIZE
+    limit = max(1, min(limit, settings.MAX_PAGE_SIZE))
+
+    model = await Job.initialize(db)
+    log_file = await model.get_field('log', id)
+    if not log_file or not os.path.exists(log_file):
+        return to_response([])
+
+    # log reads are blocking, keep them off the event loop
+    result = await run_in_threadpool(
+        read_log,
+        log_file,
+        before=before,
+        after=after,
+        limit=limit,
+        ascending=ascending
+    )
+    return to_response(result)
+
+
+# job ID -> {"followers": count, "time": check time, "status": future}
+# shared by all followers of a job, so that the job table is polled
+# at most once per interval per job, no matter how many are attached;
+# removed when the last follower is done or disconnects
+_status_checks = {}
+
+
+async def _is_job_done(model, id, check):
+    time = asyncio.get_event_loop().time()
+    if (
+        check['status'] is None or
+        time - check['time'] >= settings.LOG_FOLLOW_INTERVAL
+    ):
+        check['time'] = time
+        check['status'] = asyncio.ensure_future(
+            model.key(id).field('status').one()
+        )
+
+    status = await asyncio.shield(check['status'])
+    return status in Job.TERMINAL_STATUSES
+
+
+async def _follow_job_log(model, id, log_file, offset):
+    check = _status_checks.get(id)
+    if check is None:
+        check = _status_checks[id] = {
+            'followers': 0, 'time': None, 'status': None
+        }
+    check['followers'] += 1
+
+    async def is_done():
+        return await _is_job_done(model, id, check)
+
+    try:
+        async for chunk in follow_log(
+            log_file, offset=offset, is_done=is_done
+        ):
+            yield chunk
+    finally:
+        check['followers'] -= 1
+        if not check['followers'] and _status_checks.get(id) is check:
+            _status_checks.pop(id)
+
+
+@api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/logs/follow/")
+async def follow_job_logs(
+    id: str,
+    offset: int = 0,
+    db: Storage = Depends(get_internal_reader)
+):
+    """Stream a job's log from a byte offset until the job completes
+
+    The response body is the raw JSONL log: clients can resume
+    from "offset" + the number of bytes received so far
+    """
+    model = await Job.initialize(db)
+    job = await model.get_record(id)
+    log_file = job['log']
+
+    if not log_file:
+        # job never started (e.g. failed before running)
+        return Response(status_code=204)
+
+    return StreamingResponse(
+        _follow_job_log(model, job['id'], log_file, offset),
+        media_type='application/x-ndjson'
+    )
+
+
 @api.delete(f'/{VERSION}/{ENDPOINT}/{{id}}/', status_code=204)
-async def delete_job(id: str, db: Storage = Depends(get_internal_database)):
+async def delete_job(id: str, db: Storage = Depends(get_internal_writer)):
     model = await Job.initialize(db)
     result = await model.delete_record(id)
     # return 204 (No Content) with empty body
@@ -8,7 +8,7 @@ from fastapi import Depends
 
 from cloudcopy.server.api import api
 from cloudcopy.server.models import Workflow
-from cloudcopy.server.storage import get_internal_database
+from cloudcopy.server.storage import get_internal_reader, get_internal_writer
 from ...utils import from_request, to_response
 
 VERSION = 'v0'
@@ -33,6 +33,8 @@ class WorkflowBase(BaseModel):
     schedule: Optional[dict] = None
     running_jobs: int = 0
     concurrency: int = 0
+    step_concurrency: int = 1
+    max_queued: Optional[int] = None
     cooldown: int = 0
 
 
@@ -45,6 +47,8 @@ class WorkflowIn(WorkflowBase):
     timeout: Optional[int] = 0
     running_jobs: Optional[int] = 0
     concurrency: Optional[int] = 0
+    step_concurrency: Optional[int] = 1
+    max_queued: Optional[int] = None
     cooldown: Optional[int] = 0
 
 
@@ -86,26 +90,73 @@ class EditWorkflowOut(SetWorkflowOut):
     pass
 
 
+class AddWorkflowsIn(In):
+    data: List[WorkflowBase]
+
+
+class WorkflowBatchIn(WorkflowIn):
+    id: str
+
+
+class EditWorkflowsIn(In):
+    data: List[WorkflowBatchIn]
+
+
+class DeleteWorkflowsIn(In):
+    # IDs or names
+    data: List[str]
+
+
 class DeleteWorkflowOut(Out):
     data: str
 
 
 @api.get(f"/{VERSION}/{ENDPOINT}/", response_model=GetWorkflowsOut)
-async def get_workflows(db: Storage = Depends(get_internal_database)):
+async def get_workflows(db: Storage = Depends(get_internal_reader)):
     model = await Workflow.initialize(db)
-    result = await model.get()
-    return to_response(result)
+    result = await model.get_json(fields=WorkflowOut.__fields__)
+    return to_response(result, raw=True)
+
+
+@api.post(f"/{VERSION}/{ENDPOINT}/batch/", response_model=GetWorkflowsOut, status_code=201)
+async def add_workflows(data: AddWorkflowsIn, db: Storage = Depends(get_internal_writer)):
+    items = from_request(data)
+
+    model = await Workflow.initialize(db)
+    records = [model.to_record(item) for item in items]
+    result = await model.add_records(records, fields=WorkflowOut.__fields__)
+
+    return to_response(result, raw=True)
+
+
+@api.patch(f"/{VERSION}/{ENDPOINT}/batch/", response_model=GetWorkflowsOut)
+async def edit_workflows(data: EditWorkflowsIn, db: Storage = Depends(get_internal_writer)):
+    items = from_request(data, patch=True)
+
+    model = await Workflow.initialize(db)
+    records = [model.to_record(item) for item in items]
+    result = await model.edit_records(records, fields=WorkflowOut.__fields__)
+
+    return to_response(result, raw=True)
+
+
+@api.delete(f"/{VERSION}/{ENDPOINT}/batch/", status_code=204)
+async def delete_workflows(data: DeleteWorkflowsIn, db: Storage = Depends(get_internal_writer)):
+    model = await Workflow.initialize(db)
+    await model.delete_records(from_request(data))
+    # return 204 (No Content) with empty body
+    return {}
 
 
 @api.get(f"/{VERSION}/{ENDPOINT}/{{id}}/", response_model=GetWorkflowOut)
-async def get_workflow(id: str, db: Storage = Depends(get_internal_database)):
+async def get_workflow(id: str, db: Storage = Depends(get_internal_reader)):
     model = await Workflow.initialize(db)
     result = await model.get_record(id)
     return to_response(result)
 
 
 @api.post(f"/{VERSION}/{ENDPOINT}/", response_model=AddWorkflowOut, status_code=201)
-async def add_workflow(item: AddWorkflowIn, db: Storage = Depends(get_internal_database)):
+async def add_workflow(item: AddWorkflowIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(item)
 
     model = await Workflow.initialize(db)
@@ -116,7 +167,7 @@ async def add_workflow(item: AddWorkflowIn, db: Storage = Depends(get_internal_d
 
 
 @api.put(f"/{VERSION}/{ENDPOINT}/{{id}}/", response_model=SetWorkflowOut)
-async def set_workflow(id: str, item: SetWorkflowIn, db: Storage = Depends(get_internal_database)):
+async def set_workflow(id: str, item: SetWorkflowIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(item)
 
     model = await Workflow.initialize(db)
@@ -127,7 +178,7 @@ async def set_workflow(id: str, item: SetWorkflowIn, db: Storage = Depends(get_i
 
 
 @api.patch(f'/{VERSION}/{ENDPOINT}/{{id}}/')
-async def edit_workflow(id: str, item: EditWorkflowIn, db: Storage = Depends(get_internal_database)):
+async def edit_workflow(id: str, item: EditWorkflowIn, db: Storage = Depends(get_internal_writer)):
     item = from_request(item, patch=True)
 
     model = await Workflow.initialize(db)
@@ -138,7 +189,7 @@ async def edit_workflow(id: str, item: EditWorkflowIn, db: Storage = Depends(get
 
 
 @api.delete(f'/{VERSION}/{ENDPOINT}/{{id}}/', status_code=204)
-async def delete_workflow(id: str, db: Storage = Depends(get_internal_database)):
+async def delete_workflow(id: str, db: Storage = Depends(get_internal_writer)):
     model = await Workflow.initialize(db)
     result = await model.delete_record(id)
     # return 204 (No Content) with empty body
@@ -19,12 +19,142 @@ DEBUG = os.environ.get(
     'CLCP_DEBUG', False
 )
 
+# TASK_DATABASE_FILE: path to the task queue's SQLite file
+# kept apart from INTERNAL_DATABASE_FILE so that queue polling
+# does not contend with job and API writes
+TASK_DATABASE_FILE = os.environ.get(
+    'CLCP_TASK_DATABASE_FILE', os.path.join(BASE_PATH, 'tasks.db')
+)
+
+# TASK_LANE_WEIGHTS: relative share of dequeues given to each task lane
+# when more than one lane has tasks waiting, see tasks.core.LaneStorage
+TASK_LANE_WEIGHTS = os.environ.get(
+    'CLCP_TASK_LANE_WEIGHTS', 'manual=6,retry=3,scheduled=1'
+)
+
+# INTERNAL_DATABASE_MODE: how the internal database is accessed
+# "wal": write-ahead log, with read-only handles for GET endpoints,
+# API writes on the same event loop take turns on one handle
+# "shared": one handle for reads and writes
+INTERNAL_DATABASE_MODE = os.environ.get(
+    'CLCP_INTERNAL_DATABASE_MODE', 'wal'
+)
+
+# INTERNAL_DATABASE_TIMEOUT: seconds an internal database connection
+# waits on a locked database before failing with "database is locked"
+INTERNAL_DATABASE_TIMEOUT = float(os.environ.get(
+    'CLCP_INTERNAL_DATABASE_TIMEOUT', 5
+))
+
+# TASK_DATABASE_TIMEOUT: seconds a task queue connection waits
+# on a locked database before failing with "database is locked"
+TASK_DATABASE_TIMEOUT = float(os.environ.get(
+    'CLCP_TASK_DATABASE_TIMEOUT', 5
+))
+
+# WORKER_LOOP: event loop lifetime for task workers
+# "thread": one long-lived loop per worker thread, reused across jobs
+# "job": a new loop per job
+WORKER_LOOP = os.environ.get(
+    'CLCP_WORKER_LOOP', 'thread'
+)
+
+# WORKER_PROCESSES: if set, workflows run in a pool of this many
+# worker processes instead of on the task worker's threads,
+# so that CPU-bound steps of concurrent jobs run in parallel
+WORKER_PROCESSES = int(os.environ.get(
+    'CLCP_WORKER_PROCESSES', 0
+))
+
+# LEASE_DURATION: seconds a running job holds its concurrency slot
+# without renewing it; running jobs renew every LEASE_DURATION / 3 seconds
+LEASE_DURATION = int(os.environ.get(
+    'CLCP_LEASE_DURATION', 60
+))
+
+# MAX_QUEUED_JOBS: default maximum number of queued jobs per workflow
+# triggers beyond this fail with a ConcurrencyError
+MAX_QUEUED_JOBS = int(os.environ.get(
+    'CLCP_MAX_QUEUED_JOBS', 100
+))
+
+# SCHEDULER_BATCH_SIZE: maximum scheduled runs claimed per statement
+SCHEDULER_BATCH_SIZE = int(os.environ.get(
+    'CLCP_SCHEDULER_BATCH_SIZE', 250
+))
+
+# REFERENCE_CACHE_INTERVAL: seconds between checks for database changes
+# made by other processes, see models.database.References
+REFERENCE_CACHE_INTERVAL = float(os.environ.get(
+    'CLCP_REFERENCE_CACHE_INTERVAL', 5
+))
+
+# COPY_BATCH_SIZE: default rows per batch of incremental and streamed copies
+COPY_BATCH_SIZE = int(os.environ.get(
+    'CLCP_COPY_BATCH_SIZE', 1000
+))
+
+# COPY_MAX_BUFFERED_BATCHES: default number of batches read ahead of writes
+COPY_MAX_BUFFERED_BATCHES = int(os.environ.get(
+    'CLCP_COPY_MAX_BUFFERED_BATCHES', 2
+))
+
+# DATABASE_INFO_TTL: seconds a cached database info result is served
+DATABASE_INFO_TTL = float(os.environ.get(
+    'CLCP_DATABASE_INFO_TTL', 300
+))
+
+# DATABASE_INFO_MAX_SCOPES: cached database info results kept per database
+DATABASE_INFO_MAX_SCOPES = int(os.environ.get(
+    'CLCP_DATABASE_INFO_MAX_SCOPES', 10
+))
+
+# CONNECTION_POOL_SIZE: maximum open handles per database URL, per worker
+CONNECTION_POOL_SIZE = int(os.environ.get(
+    'CLCP_CONNECTION_POOL_SIZE', 4
+))
+
+# CONNECTION_IDLE_TIMEOUT: seconds before an unused handle is closed
+CONNECTION_IDLE_TIMEOUT = float(os.environ.get(
+    'CLCP_CONNECTION_IDLE_TIMEOUT', 300
+))
+
+# CONNECTION_CHECK_INTERVAL: seconds idle before a handle is checked on reuse
+CONNECTION_CHECK_INTERVAL = float(os.environ.get(
+    'CLCP_CONNECTION_CHECK_INTERVAL', 30
+))
+
 # LOG_PATH: path to server's log files
 # TODO: support cloud logging in addition
 LOG_PATH = os.environ.get(
     'CLCP_LOG_PATH', os.path.join(BASE_PATH, 'logs')
 )
 
+# LOG_INDEX_INTERVAL: bytes of log between two entries of a log's time index
+LOG_INDEX_INTERVAL = int(os.environ.get(
+    'CLCP_LOG_INDEX_INTERVAL', 64 * 1024
+))
+
+# LOG_FOLLOW_BUFFER_SIZE: maximum bytes read at once when following a log
+LOG_FOLLOW_BUFFER_SIZE = int(os.environ.get(
+    'CLCP_LOG_FOLLOW_BUFFER_SIZE', 64 * 1024
+))
+
+# LOG_FOLLOW_INTERVAL: seconds between checks for new log lines and job status
+LOG_FOLLOW_INTERVAL = float(os.environ.get(
+    'CLCP_LOG_FOLLOW_INTERVAL', 1
+))
+
+# PAGE_SIZE: default number of records returned by paginated endpoints
+PAGE_SIZE = int(os.environ.get(
+    'CLCP_PAGE_SIZE', 100
+))
+
+# MAX_PAGE_SIZE: upper bound on the "limit" of paginated endpoints
+MAX_PAGE_SIZE = int(os.environ.get(
+    'CLCP_MAX_PAGE_SIZE', 1000
+))
+
 # all upper-case values in this file are added to a settings object
 # this object can be mocked in tests
 settings = Settings({
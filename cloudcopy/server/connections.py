@@ -0,0 +1,169 @@
+import time
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from adbc.store import Database
+
+from cloudcopy.server.config import settings
+
+
+# event loop -> {url: Pool}
+# like the internal database handles, connections are bound to the loop
+# that opened them, so each worker thread's loop keeps its own pools
+pools = weakref.WeakKeyDictionary()
+
+
+async def close_database(database):
+    # handles close their connections, if any were opened
+    close = getattr(database, 'close', None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception:
+        pass
+
+
+class Pool(object):
+    """Database handles on one URL, shared by the jobs of a worker
+
+    At most "size" handles are open at once: borrowers wait for
+    a free handle past that. Idle handles are closed after
+    "idle_timeout" seconds, and checked before reuse if idle for
+    more than "check_interval" seconds
+    """
+    def __init__(self, url, size=None, idle_timeout=None, check_interval=None):
+        self.url = url
+        self.size = size or settings.CONNECTION_POOL_SIZE
+        self.idle_timeout = (
+            settings.CONNECTION_IDLE_TIMEOUT
+            if idle_timeout is None else idle_timeout
+        )
+        self.check_interval = (
+            settings.CONNECTION_CHECK_INTERVAL
+            if check_interval is None else check_interval
+        )
+        # (handle, time released), most recently released last
+        self.idle = []
+        self.used = 0
+        self.available = asyncio.Condition()
+
+    @property
+    def opened(self):
+        return self.used + len(self.idle)
+
+    def open(self):
+        return Database(url=self.url, verbose=settings.DEBUG)
+
+    async def check(self, database):
+        """Whether a handle can still run queries"""
+        try:
+            await database.query_one_value('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    async def evict(self):
+        """Close handles idle for longer than the idle timeout"""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = [entry for entry in self.idle if entry[1] <= cutoff]
+        if not expired:
+            return
+        self.idle = [entry for entry in self.idle if entry[1] > cutoff]
+        for database, _ in expired:
+            await close_database(database)
+
+    async def acquire(self):
+        async with self.available:
+            while not self.idle and self.opened >= self.size:
+                await self.available.wait()
+            if self.idle:
+                database, released = self.idle.pop()
+            else:
+                database, released = self.open(), None
+            self.used += 1
+
+        try:
+            if released is not None and (
+                time.monotonic() - released > self.check_interval and
+                not await self.check(database)
+            ):
+                # the server may have dropped it: replace it
+                await close_database(database)
+                database = self.open()
+        except BaseException:
+            # e.g. cancelled during the check: give the slot back
+            async with self.available:
+                self.used -= 1
+                self.available.notify()
+            await close_database(database)
+            raise
+        return database
+
+    async def release(self, database, discard=False):
+        """Return a handle to the pool
+
+        Arguments:
+            discard: close the handle instead, e.g. after a failure
+        """
+        async with self.available:
+            self.used -= 1
+            if not discard:
+                self.idle.append((database, time.monotonic()))
+            self.available.notify()
+        if discard:
+            await close_database(database)
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for database, _ in idle:
+            await close_database(database)
+
+
+def get_pools():
+    """Get this loop's pools, by URL"""
+    loop = asyncio.get_event_loop()
+    loop_pools = pools.get(loop)
+    if loop_pools is None:
+        loop_pools = pools[loop] = {}
+    return loop_pools
+
+
+def get_pool(url):
+    """Get this loop's pool of handles on a database URL"""
+    loop_pools = get_pools()
+    pool = loop_pools.get(url)
+    if pool is None:
+        pool = loop_pools[url] = Pool(url)
+    return pool
+
+
+@asynccontextmanager
+async def borrow(url):
+    """Borrow a handle on a database URL from this loop's pool
+
+    Handles are returned to the pool on exit, or closed
+    if the block failed, in case the connection is broken
+    """
+    # worker loops only run during jobs: evict on use
+    for other in list(get_pools().values()):
+        await other.evict()
+    pool = get_pool(url)
+    database = await pool.acquire()
+    try:
+        yield database
+    except BaseException:
+        await pool.release(database, discard=True)
+        raise
+    else:
+        await pool.release(database)
+
+
+async def close_pools():
+    """Close this loop's idle handles, e.g. before the loop is closed"""
+    loop_pools = pools.pop(asyncio.get_event_loop(), None) or {}
+    for pool in loop_pools.values():
+        await pool.close()
@@ -0,0 +1,385 @@
+import json
+import time
+import asyncio
+
+from cloudcopy.server.config import settings
+from cloudcopy.server.connections import borrow
+from cloudcopy.server.utils import to_literal
+from cloudcopy.server.verify import verify_table, check_key
+
+
+def is_incremental(step):
+    """Whether a step is a copy with a watermark per table"""
+    return step.get('type') == 'copy' and bool(step.get('watermark'))
+
+
+def is_streamed(step):
+    """Whether a step is a copy of whole tables, streamed in key order"""
+    return step.get('type') == 'copy' and bool(step.get('stream'))
+
+
+def is_pipelined(step):
+    """Whether a step is run by copy_incremental rather than a runner"""
+    return is_incremental(step) or is_streamed(step)
+
+
+def get_tables(step):
+    """Get the tables of a pipelined copy step
+
+    Returns:
+        dict of table -> watermark column, or None if streamed
+    """
+    if is_incremental(step):
+        return dict(step['watermark'])
+    return {table: None for table in step.get('stream') or ()}
+
+
+def validate_copy_step(step):
+    """Check the options of a copy step with a "watermark" or "stream"
+
+    "watermark" is an object of table -> column,
+    "stream" is a list of tables, copied in full,
+    "batch_size", "max_buffered_batches" and "shard_concurrency"
+    are positive integers, "verify" is a boolean (watermark only)
+
+    Raises:
+        ValueError if an option is invalid
+    """
+    watermark = step.get('watermark')
+    stream = step.get('stream')
+    if watermark is None and stream is None:
+        for option in ('shard_concurrency', 'max_buffered_batches', 'verify'):
+            if step.get(option) is not None:
+                raise ValueError(
+                    f'"{option}" requires a "watermark" or "stream"'
+                )
+        return
+    if step.get('type') != 'copy':
+        option = 'watermark' if watermark is not None else 'stream'
+        raise ValueError(f'"{option}" is only supported by copy steps')
+    if watermark is not None and stream is not None:
+        raise ValueError('"watermark" and "stream" cannot be combined')
+    if watermark is not None and (
+        not isinstance(watermark, dict) or not all(
+            isinstance(table, str) and isinstance(column, str) and column
+            for table, column in watermark.items()
+        )
+    ):
+        raise ValueError(
+            f'Invalid watermark: "{watermark}", '
+            'expecting an object of table -> column'
+        )
+    if stream is not None and (
+        not isinstance(stream, list) or
+        not all(isinstance(table, str) and table for table in stream)
+    ):
+        raise ValueError(
+            f'Invalid stream: "{stream}", expecting a list of tables'
+        )
+    if step.get('verify') is not None and watermark is None:
+        raise ValueError('"verify" requires a "watermark"')
+    if not isinstance(step.get('verify', False), bool):
+        raise ValueError(f'Invalid verify: "{step["verify"]}"')
+    for option in ('batch_size', 'max_buffered_batches', 'shard_concurrency'):
+        value = step.get(option)
+        if value is not None and (
+            not isinstance(value, int) or
+            isinstance(value, bool) or
+            value <= 0
+        ):
+            raise ValueError(f'Invalid {option}: "{value}"')
+
+
+def get_size(rows):
+    """Get the size of rows in bytes, as compact JSON"""
+    return len(json.dumps(
+        rows, default=str, separators=(',', ':')
+    ).encode('utf-8'))
+
+
+def get_after(column, key, value, key_value):
+    """Get a condition matching rows past a (watermark, key) position"""
+    return {
+        'or': [
+            {'>': [column, to_literal(value)]},
+            {
+                'and': [
+                    {'=': [column, to_literal(value)]},
+                    {'>': [key, to_literal(key_value)]}
+                ]
+            }
+        ]
+    }
+
+
+async def copy_table(
+    source,
+    target,
+    table,
+    column,
+    key='id',
+    checkpoint=None,
+    save=None,
+    batch_size=None,
+    shard_concurrency=1,
+    max_buffered_batches=None
+):
+    """Copy a table's rows at or past a checkpoint, in shards
+
+    Rows are read in (watermark, key) order, one shard of "batch_size"
+    rows at a time, and replace target rows with the same key, so rows
+    updated since the last run are copied again. Without a watermark
+    column, all rows are streamed in key order
+
+    Reads and writes form a pipeline: a reader puts shards on a queue
+    of at most "max_buffered_batches" shards, taken by up to
+    "shard_concurrency" writers. The reader waits while the queue is
+    full, so at most max_buffered_batches + shard_concurrency + 1 shards
+    are held in memory, whatever the size of the table
+
+    A row updated during the copy can be read again by a later shard:
+    a shard sharing keys with earlier shards waits for their writes,
+    so the last version read is the one kept. Other shards are written
+    in any order; the checkpoint is only moved past a shard once it and
+    all shards before it are written: an interrupted copy restarts
+    from the last checkpoint
+
+    Arguments:
+        source: source database handle
+        target: target database handle
+        table: table name
+        column: watermark column, e.g. "updated_at" or "id", or None
+        key: unique key column
+        checkpoint: last copied watermark, or None to copy all rows
+        save: coroutine function of (watermark), called as it advances
+        batch_size: rows per shard, defaults to COPY_BATCH_SIZE
+        shard_concurrency: maximum number of shards written at once
+        max_buffered_batches: maximum number of shards read ahead
+            of writes, defaults to COPY_MAX_BUFFERED_BATCHES
+
+    Returns:
+        {
+            "rows": number of rows copied,
+            "watermark": last watermark, None without a watermark column,
+            "shards": [{"start", "end", "rows", "bytes", "duration"}],
+            "max_buffered": most shards waiting to be written at once
+        }
+        "start" and "end" are the first and last watermark of a shard
+        (or key, without a watermark column), "bytes" the size of
+        its rows, see get_size
+    """
+    batch_size = batch_size or settings.COPY_BATCH_SIZE
+    max_buffered_batches = (
+        max_buffered_batches or settings.COPY_MAX_BUFFERED_BATCHES
+    )
+    shard_concurrency = shard_concurrency or 1
+    order = column or key
+    source_model = await source.get_model(table)
+    target_model = await target.get_model(table)
+    queue = asyncio.Queue(maxsize=max_buffered_batches)
+    shards = []
+    # positions of written shards not yet covered by the checkpoint
+    written = set()
+    state = {'saved': 0, 'watermark': checkpoint, 'max_buffered': 0}
+    lock = asyncio.Lock()
+    # key -> position of the last shard holding it, until written
+    owners = {}
+    # position -> event set once the shard is written
+    done = {}
+
+    async def read():
+        position = None
+        while True:
+            query = source_model
+            if position and column:
+                query = query.where(get_after(column, key, *position))
+            elif position:
+                query = query.where({'>': [key, to_literal(position[1])]})
+            elif checkpoint is not None:
+                # rows at the checkpoint are copied again: rows written
+                # with the same watermark after the last run are not missed
+                query = query.where({'>=': [column, to_literal(checkpoint)]})
+            sort = (column, key) if column else (key, )
+            rows = await query.sort(*sort).limit(batch_size).get()
+            if not rows:
+                break
+
+            last = rows[-1]
+            position = (last[order], last[key])
+            index = len(shards)
+            shards.append({
+                'start': rows[0][order],
+                'end': last[order],
+                'rows': len(rows),
+                'bytes': get_size(rows),
+                'duration': None
+            })
+            # earlier shards with the same keys (rows updated since
+            # they were read) are written first
+            after = set()
+            for row in rows:
+                owner = owners.get(row[key])
+                if owner is not None:
+                    after.add(done[owner])
+                owners[row[key]] = index
+            done[index] = asyncio.Event()
+            # backpressure: wait for a writer to free a slot
+            await queue.put((index, rows, after))
+            state['max_buffered'] = max(state['max_buffered'], queue.qsize())
+            if len(rows) < batch_size:
+                break
+        for _ in range(shard_concurrency):
+            await queue.put(None)
+
+    async def write():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, rows, after = item
+            for event in after:
+                await event.wait()
+            started = time.monotonic()
+            keys = [to_literal(row[key]) for row in rows]
+            await target_model.where({'in': [key, keys]}).delete()
+            await target_model.values(rows).add()
+            shards[index]['duration'] = round(time.monotonic() - started, 3)
+            for row in rows:
+                if owners.get(row[key]) == index:
+                    del owners[row[key]]
+            done.pop(index).set()
+            if not column:
+                continue
+            async with lock:
+                written.add(index)
+                saved = state['saved']
+                while saved in written:
+                    written.remove(saved)
+                    state['watermark'] = shards[saved]['end']
+                    saved += 1
+                if saved != state['saved']:
+                    state['saved'] = saved
+                    if save:
+                        await save(state['watermark'])
+
+    tasks = [asyncio.ensure_future(read())] + [
+        asyncio.ensure_future(write()) for _ in range(shard_concurrency)
+    ]
+    try:
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION
+        )
+        for task in done:
+            # stop reading and writing if a shard failed
+            if task.exception():
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        'rows': sum(shard['rows'] for shard in shards),
+        'watermark': state['watermark'],
+        'shards': shards,
+        'max_buffered': state['max_buffered']
+    }
+
+
+async def copy_incremental(
+    step,
+    checkpoints=None,
+    save=None,
+    logger=None,
+    hashes=None
+):
+    """Run a copy step with a "watermark" or "stream", table by table
+
+    Database handles are borrowed from the worker's pools,
+    see connections.borrow, in URL order: steps copying in opposite
+    directions at the same time cannot each wait for the other's handle
+
+    Arguments:
+        step: copy step with resolved "source" and "target" URLs
+        checkpoints: dict of table -> (column, value), see Checkpoint
+        save: coroutine function of (table, column, value)
+        logger: logger, if any
+        hashes: (load, save) coroutine functions of the shard hash cache,
+            used if the step has "verify", see verify.verify_table
+
+    Returns:
+        dict of table -> copy_table result
+    """
+    args = (step, checkpoints or {}, save, logger, hashes)
+    urls = sorted({step['source'], step['target']})
+    async with borrow(urls[0]) as first:
+        if len(urls) == 1:
+            return await copy_tables(first, first, *args)
+        async with borrow(urls[1]) as second:
+            handles = dict(zip(urls, (first, second)))
+            return await copy_tables(
+                handles[step['source']], handles[step['target']], *args
+            )
+
+
+async def copy_tables(source, target, step, checkpoints, save, logger, hashes):
+    key = step.get('key', 'id')
+    result = {}
+    if step.get('verify'):
+        # fail before copying, rather than after
+        for table in get_tables(step):
+            await check_key(source, table, key)
+    for table, column in get_tables(step).items():
+        checkpoint = checkpoints.get(table) if column else None
+        # a checkpoint of another column does not apply
+        value = checkpoint[1] if checkpoint and checkpoint[0] == column else None
+
+        async def save_table(watermark, table=table, column=column):
+            if save:
+                await save(table, column, watermark)
+
+        if logger:
+            if column is None:
+                logger.info(f'Streaming all of {table} by {key}')
+            elif value is None:
+                logger.info(f'Copying all of {table}')
+            else:
+                logger.info(f'Copying {table} from {column} = {value}')
+        result[table] = await copy_table(
+            source,
+            target,
+            table,
+            column,
+            key=key,
+            checkpoint=value,
+            save=save_table,
+            batch_size=step.get('batch_size'),
+            shard_concurrency=step.get('shard_concurrency', 1),
+            max_buffered_batches=step.get('max_buffered_batches')
+        )
+        if logger:
+            copied = result[table]
+            upto = f', up to {column} = {copied["watermark"]}' if column else ''
+            logger.info(
+                f'Copied {copied["rows"]} rows of {table} '
+                f'in {len(copied["shards"])} shards{upto}'
+            )
+        if step.get('verify'):
+            load_hashes, save_hashes = hashes or (None, None)
+            verified = result[table]['verify'] = await verify_table(
+                source,
+                target,
+                table,
+                column,
+                key=key,
+                batch_size=step.get('batch_size'),
+                load=load_hashes,
+                save=save_hashes
+            )
+            if logger:
+                logger.info(
+                    f'Verified {verified["shards"]} shards of {table}: '
+                    f'{len(verified["mismatched"])} mismatched, '
+                    f'{verified["cached"]} unchanged since the last run'
+                )
+    return result
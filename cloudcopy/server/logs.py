@@ -0,0 +1,248 @@
+import os
+import json
+import asyncio
+import arrow
+from bisect import bisect_left, bisect_right
+from fastapi.concurrency import run_in_threadpool
+
+from cloudcopy.server.config import settings
+
+# fixed-width UTC format: log times sort lexicographically
+TIME_FORMAT = 'YYYY-MM-DDTHH:mm:ss.SSSSSSZZ'
+
+
+def to_log_time(value=None):
+    """Get a log timestamp for the given time (default: now)"""
+    value = arrow.utcnow() if value is None else arrow.get(value).to('UTC')
+    return value.format(TIME_FORMAT)
+
+
+def get_index_file(log_file):
+    """Get the path of the sparse time index for a log file"""
+    return f'{log_file}.idx'
+
+
+class LogWriter(object):
+    """File-like writer for structured job logs
+
+    Each line of the log is a JSON object: {"time": ..., "message": ...}
+
+    Every "interval" bytes, the time and byte offset of the next line
+    is appended to an index file next to the log, so that readers
+    can seek to a point in time without scanning the whole log
+    """
+    def __init__(self, log_file, interval=None, append=False):
+        self.log_file = log_file
+        self.index_file = get_index_file(log_file)
+        self.interval = interval or settings.LOG_INDEX_INTERVAL
+        # append: continue the log of a resumed job
+        append = append and os.path.exists(log_file)
+        self.offset = os.path.getsize(log_file) if append else 0
+        self.log = open(log_file, 'ab' if append else 'wb')
+        self.index = open(self.index_file, 'a' if append else 'w')
+        # force an index entry for the first line
+        self.indexed = -self.interval
+
+    def write(self, text):
+        for message in text.splitlines():
+            self.write_line(message)
+
+    def write_line(self, message, time=None):
+        time = time or to_log_time()
+        if self.offset - self.indexed >= self.interval:
+            self.index.write(f'{time} {self.offset}\n')
+            self.indexed = self.offset
+        line = json.dumps({'time': time, 'message': message}) + '\n'
+        line = line.encode('utf-8')
+        self.log.write(line)
+        self.offset += len(line)
+
+    def flush(self):
+        # flush the log first so that indexed offsets always exist
+        self.log.flush()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_index(log_file):
+    """Read the sparse index of a log file
+
+    Returns:
+        times: list of chunk start times
+        offsets: list of chunk start offsets
+    """
+    times = []
+    offsets = []
+    index_file = get_index_file(log_file)
+    if os.path.exists(index_file):
+        with open(index_file) as index:
+            for line in index:
+                time, _, offset = line.strip().partition(' ')
+                if not offset:
+                    # partial write
+                    break
+                times.append(time)
+                offsets.append(int(offset))
+
+    if not offsets:
+        # no index: the whole log is one chunk
+        times.append('')
+        offsets.append(0)
+    return times, offsets
+
+
+def _parse(lines):
+    for line in lines:
+        if not line.endswith(b'\n'):
+            # partial write in progress
+            break
+        yield json.loads(line)
+
+
+def read_log(
+    log_file,
+    before=None,
+    after=None,
+    limit=None,
+    ascending=True
+):
+    """Read log lines between two points in time
+
+    Arguments:
+        log_file: path to the log
+        before: only include lines strictly before this time
+        after: only include lines strictly after this time
+        limit: maximum number of lines to return
+        ascending: if False, return the latest lines first
+
+    Returns:
+        list of {"time": ..., "message": ...}
+    """
+    before = to_log_time(before) if before else None
+    after = to_log_time(after) if after else None
+    times, offsets = read_index(log_file)
+    result = []
+
+    with open(log_file, 'rb') as log:
+        if ascending:
+            # all lines before the last chunk starting at or before "after"
+            # are at or before "after"
+            start = bisect_right(times, after) - 1 if after else 0
+            log.seek(offsets[max(start, 0)])
+            for line in _parse(log):
+                time = line['time']
+                if after and time <= after:
+                    continue
+                if before and time >= before:
+                    break
+                result.append(line)
+                if limit and len(result) >= limit:
+                    break
+            return result
+
+        # descending: read chunks in reverse, starting from the last
+        # chunk that starts before "before"
+        end = bisect_left(times, before) if before else len(times)
+        log.seek(0, os.SEEK_END)
+        stop = log.tell()
+        if end < len(offsets):
+            stop = offsets[end]
+        for i in reversed(range(end)):
+            start = offsets[i]
+            log.seek(start)
+            chunk = log.read(stop - start).splitlines(keepends=True)
+            stop = start
+            for line in reversed(list(_parse(chunk))):
+                time = line['time']
+                if before and time >= before:
+                    continue
+                if after and time <= after:
+                    return result
+                result.append(line)
+                if limit and len(result) >= limit:
+                    return result
+    return result
+
+
+async def follow_log(
+    log_file,
+    offset=0,
+    is_done=None,
+    buffer_size=None,
+    interval=None
+):
+    """Tail a growing log, yielding raw chunks of complete lines
+
+    Each chunk is at most "buffer_size" bytes (unless a single line is longer).
+    Only new bytes are ever read; when there are none, waits "interval" seconds.
+    Stops once "is_done" resolves to True and the log is drained.
+
+    Arguments:
+        log_file: path to the log
+        offset: byte offset to start from
+        is_done: async callable, returns True when the log is complete
+        buffer_size: maximum read size
+        interval: idle poll interval in seconds
+    """
+    buffer_size = buffer_size or settings.LOG_FOLLOW_BUFFER_SIZE
+    interval = interval or settings.LOG_FOLLOW_INTERVAL
+    log = None
+    done = False
+    try:
+        while True:
+            # file reads run in the threadpool, not on the event loop
+            if log is None:
+                log = await run_in_threadpool(_open, log_file, offset)
+
+            data = (
+                await run_in_threadpool(_read_lines, log, offset, buffer_size)
+                if log else b''
+            )
+            if data:
+                # only complete lines, any partial line is re-read later
+                offset += len(data)
+                yield data
+                continue
+            if done:
+                # drained after completion
+                break
+            if is_done and await is_done():
+                # one more pass to pick up the last lines
+                done = True
+                continue
+            await asyncio.sleep(interval)
+    finally:
+        if log:
+            log.close()
+
+
+def _open(log_file, offset):
+    """Open a log for reading from "offset", or None if it does not exist"""
+    if not os.path.exists(log_file):
+        return None
+    log = open(log_file, 'rb')
+    log.seek(offset)
+    return log
+
+
+def _read_lines(log, offset, buffer_size):
+    """Read the complete lines after "offset", at most "buffer_size" bytes
+    (unless a single line is longer), and seek to the end of the last one"""
+    data = log.read(buffer_size)
+    end = data.rfind(b'\n') + 1
+    if not end and len(data) == buffer_size:
+        # a single line longer than the buffer
+        data += log.readline()
+        end = data.rfind(b'\n') + 1
+    log.seek(offset + end)
+    return data[:end]
@@ -1,3 +1,8 @@
 from .database import Database  # noqa
 from .workflow import Workflow  # noqa
 from .job import Job  # noqa
+from .lease import Lease  # noqa
+from .version import Version  # noqa
+from .checkpoint import Checkpoint  # noqa
+from .shard_hash import ShardHash  # noqa
+from .database_info import DatabaseInfo  # noqa
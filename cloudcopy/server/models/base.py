@@ -1,9 +1,8 @@
 import json
 import uuid
-from functools import wraps
 
 from copy import deepcopy
-from cloudcopy.server.utils import is_uuid, now
+from cloudcopy.server.utils import is_uuid, now, supports_returning
 from adbc.store import Table
 from adbc.zql.parsers.base import get_parser
 from adbc.zql.dialect import Backend
@@ -43,6 +42,59 @@ class ModelMethodProxy:
         return self.model.__class__(query)
 
 
+def command_method(key, pre, pre_command, post, post_command):
+    """Build a model command that calls the query command and its hooks
+
+    Hooks are resolved when the model class is defined, see Model
+    """
+    if not (pre or post or pre_command or post_command):
+        def command(self, *args, **kwargs):
+            return getattr(self._model, key)(*args, **kwargs)
+    else:
+        async def command(self, *args, **kwargs):
+            query = self._model
+            if pre:
+                await pre(self, key, query)
+            if pre_command:
+                await pre_command(self, query)
+            result = await getattr(query, key)(*args, **kwargs)
+            if post:
+                post_result = await post(self, key, query, result)
+                if post_result:
+                    result = post_result
+            if post_command:
+                post_result = await post_command(self, query, result)
+                if post_result:
+                    result = post_result
+            return result
+
+    command.__name__ = key
+    return command
+
+
+def state_method(key):
+    """Build a model method that returns a model for a new query state"""
+    def method(self, *args, **kwargs):
+        return self.__class__(getattr(self._model, key)(*args, **kwargs))
+
+    method.__name__ = key
+    return method
+
+
+def leveled_method(key):
+    """Build a model method for a top-level leveled query function
+
+    For a nested level, use ModelMethodProxy(model, key, leveled=True)
+    """
+    name = f'_{key}'
+
+    def method(self, *args, **kwargs):
+        return self.__class__(getattr(self._model, name)(None, *args, **kwargs))
+
+    method.__name__ = key
+    return method
+
+
 class Model:
     COLUMN_EXTRAS = {'uuid', 'created', 'updated', 'json'}
     COMMAND_FUNCTIONS = {
@@ -70,39 +122,48 @@ class Model:
         'join'
     }
     DIFFING = True
+    # bound parameters per statement, within SQLite's default limit
+    # (999 before 3.32): bulk statements are split to stay under it
+    MAX_PARAMETERS = 999
+    # model handles are cached on each database handle, as
+    # (generation, {model name: model}), so that they are dropped
+    # with it, e.g. with the loop of a job if WORKER_LOOP = "job"
+    # clear_cache starts a new generation
+    _generation = 0
+
     def __init__(self, model):
         self._model = model
         self._database = self._model.database
 
-    @property
-    def id_field(self):
-        if not hasattr(self, '_id_field'):
-            self._id_field = self._field_where(lambda column: column.get('primary'))
-        return self._id_field
-
-    @property
-    def name_field(self):
-        if not hasattr(self, '_name_field'):
-            self._name_field = self._field_where(
-                lambda column: column.get('unique') and not column.get('primary')
-            )
-        return self._name_field
-
-    @property
-    def created_field(self):
-        if not hasattr(self, '_created_field'):
-            self._created_field = self._field_where(
-                lambda column: column.get('created')
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # resolve query methods and their pre/post hooks once per class
+        pre = getattr(cls, 'pre', None)
+        post = getattr(cls, 'post', None)
+        # command -> (pre, pre_command, post, post_command)
+        cls._hooks = {}
+        for key in cls.COMMAND_FUNCTIONS:
+            hooks = cls._hooks[key] = (
+                pre,
+                getattr(cls, f'pre_{key}', None),
+                post,
+                getattr(cls, f'post_{key}', None)
             )
-        return self._created_field
+            setattr(cls, key, command_method(key, *hooks))
+        for key in cls.STATE_FUNCTIONS:
+            setattr(cls, key, state_method(key))
+        for key in cls.LEVELED_FUNCTIONS:
+            setattr(cls, key, leveled_method(key))
 
-    @property
-    def updated_field(self):
-        if not hasattr(self, '_updated_field'):
-            self._updated_field = self._field_where(
-                lambda column: column.get('updated')
-            )
-        return self._updated_field
+        if not hasattr(cls, 'columns'):
+            return
+        # resolve field metadata once per class
+        cls.id_field = cls._field_where(lambda column: column.get('primary'))
+        cls.name_field = cls._field_where(
+            lambda column: column.get('unique') and not column.get('primary')
+        )
+        cls.created_field = cls._field_where(lambda column: column.get('created'))
+        cls.updated_field = cls._field_where(lambda column: column.get('updated'))
 
     @classmethod
     def _field_where(cls, check):
@@ -113,69 +174,28 @@ class Model:
                 break
         return field
 
-    def __getattr__(self, key):
-        if key in self.COMMAND_FUNCTIONS:
-            pre_command = getattr(self, f'pre_{key}', None)
-            post_command = getattr(self, f'post_{key}', None)
-            pre = getattr(self, 'pre', None)
-            post = getattr(self, 'post', None)
-            query = self._model
-            command = getattr(query, key)
-            values = None
-            if not (pre or post or pre_command or post_command):
-                # return original command
-                return command
-
-            @wraps(command)
-            async def wrapped(*args, **kwargs):
-                if pre:
-                    await pre(key, query)
-                if pre_command:
-                    await pre_command(query)
-                result = await command(*args, **kwargs)
-                post_result = None
-                if post:
-                    post_result = await post(key, query, result)
-                    if post_result:
-                        result = post_result
-                if post_command:
-                    post_result = await post_command(query, result)
-                    if post_result:
-                        result = post_result
-
-                return result
-
-            # return a new callable that calls the original method
-            # and also the pre/post commands
-            return wrapped
-        elif key in self.STATE_FUNCTIONS:
-            return ModelMethodProxy(
-                model=self,
-                method=key
-            )
-        elif key in self.LEVELED_FUNCTIONS:
-            return ModelMethodProxy(
-                model=self,
-                method=key,
-                leveled=True
-            )
-        try:
-            # fallback to own property
-            result = self.__getattribute__(key)
-            return result
-        except KeyError:
-            # if no own property, fallback to query
-            return getattr(self._model, key)
-
     @classmethod
     async def initialize(cls, db):
-        model = await db.get_model(cls.name)
+        cached = getattr(db, '_cloudcopy_models', None)
+        if not cached or cached[0] != Model._generation:
+            cached = db._cloudcopy_models = (Model._generation, {})
+
+        models = cached[1]
+        model = models.get(cls.name)
+        if model is None:
+            model = models[cls.name] = await db.get_model(cls.name)
         return cls(model)
 
+    @classmethod
+    def clear_cache(cls):
+        """Forget all model handles, e.g. after a schema change"""
+        Model._generation += 1
+
     @classmethod
     def get_table_schema(cls):
         columns = []
         constraints = []
+        indexes = []
 
         for name, column in cls.columns.items():
             column = deepcopy(column)
@@ -191,12 +211,17 @@ class Model:
             constraint = G('constraint', **constraint)
             constraint['name'] = name
             constraints.append(constraint)
+        for name, index in getattr(cls, 'indexes', {}).items():
+            index = G('index', **index)
+            index['name'] = name
+            indexes.append(index)
 
         table = Table(
             cls.name,
             backend=get_parser(Backend.SQLITE),
             columns=columns,
-            constraints=constraints
+            constraints=constraints,
+            indexes=indexes
         )
 
         return {
@@ -313,6 +338,95 @@ class Model:
         # otherwise, anything can be an id
         return True
 
+    async def get_json(
+        self,
+        fields=None,
+        where=None,
+        params=(),
+        sort=None,
+        limit=None
+    ):
+        """Get records as a JSON array string, built by SQLite
+
+        Rows are never decoded into Python objects: JSON columns
+        are embedded as-is, and the whole array is one value
+
+        Arguments:
+            fields: names of fields to include (default: all)
+            where: SQL condition
+            params: parameters of the condition
+            sort: SQL ORDER BY expression
+            limit: maximum number of records
+        """
+        params = list(params)
+        query = f'SELECT * FROM "{self.name}"'
+        if where:
+            query += f' WHERE {where}'
+        if sort:
+            query += f' ORDER BY {sort}'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        return await self._database.query_one_value(
+            f'SELECT json_group_array({self.to_json_object(fields)}) '
+            f'FROM ({query})',
+            *params
+        )
+
+    def to_json_object(self, fields=None):
+        """Get a SQL expression building a record's JSON object"""
+        pairs = []
+        for name, column in self.columns.items():
+            if fields is not None and name not in fields:
+                continue
+            value = f'json("{name}")' if column.get('json') else f'"{name}"'
+            pairs.append(f"'{name}', {value}")
+        pairs = ', '.join(pairs)
+        return f'json_object({pairs})'
+
+    async def write_returning(self, key, query, statement, params):
+        """Execute a write as one statement that returns the written row
+
+        Runs the same pre/post hooks as the "add" or "set" commands
+
+        Arguments:
+            key: "add" or "set"
+            query: the query with values, passed to hooks
+            statement: callable, given the final values (after hooks),
+                returns the SQL statement; values are bound in order
+            params: extra parameters bound after the values
+
+        Returns:
+            the written record, or None if no row was written
+        """
+        pre, pre_command, post, post_command = self._hooks[key]
+        if pre:
+            await pre(self, key, query)
+        if pre_command:
+            await pre_command(self, query)
+
+        values = query.data('values')
+        sql = statement(values)
+        result = await self._database.query_one_value(
+            f'{sql} RETURNING {self.to_json_object()}',
+            *values.values(),
+            *params
+        )
+        if result is None:
+            return None
+
+        result = json.loads(result)
+        if post:
+            post_result = await post(self, key, query, result)
+            if post_result:
+                result = post_result
+        if post_command:
+            post_result = await post_command(self, query, result)
+            if post_result:
+                result = post_result
+        return result
+
     async def get_field(self, field, id):
         """Get field value by key"""
         key = self.id_field if self.is_id(id) else self.name_field
@@ -379,17 +493,32 @@ class Model:
         if name_field and name_field in record:
             name = record[name_field]
 
-        await self.values(record).add()
-        # fetch from DB for default values
-        # SQLite does not support RETURNING so we cannot do this in one statement
-        # for flexibility, support either ID or name
-        if id is None and name is None:
-            raise ValueError(
-                f'Add record failed: must pass either {self.id_field} or {self.name_field}'
+        if supports_returning():
+            # insert and fetch default values in one statement
+            result = await self.write_returning(
+                'add',
+                self.values(record)._model,
+                lambda values: (
+                    f'INSERT INTO "{self.name}" ('
+                    + ', '.join(f'"{column}"' for column in values)
+                    + ') VALUES ('
+                    + ', '.join('?' for _ in values)
+                    + ')'
+                ),
+                ()
             )
-
-        key, value = ('id', id) if id is not None else ('name', name)
-        result = await self.where({"=": [key, f"'{value}'"]}).one()
+        else:
+            await self.values(record).add()
+            # fetch from DB for default values
+            # SQLite < 3.35 does not support RETURNING
+            # for flexibility, support either ID or name
+            if id is None and name is None:
+                raise ValueError(
+                    f'Add record failed: must pass either {self.id_field} or {self.name_field}'
+                )
+
+            key, value = ('id', id) if id is not None else ('name', name)
+            result = await self.where({"=": [key, f"'{value}'"]}).one()
 
         new_result = None
         if post:
@@ -427,15 +556,32 @@ class Model:
         if pre:
             await pre(id, old, record)
 
-        # update results
-        await self.values(record).where(where).set()
-        if not is_id and self.name_field in record:
-            # refetching by name field, and it just changed
-            new_id = record[self.name_field]
-            where = {'=': [key, f"'{new_id}'"]}
+        if supports_returning():
+            # update and fetch the row in one statement
+            result = await self.write_returning(
+                'set',
+                self.values(record)._model,
+                lambda values: (
+                    f'UPDATE "{self.name}" SET '
+                    + ', '.join(f'"{column}" = ?' for column in values)
+                    + f' WHERE "{key}" = ?'
+                ),
+                (id, )
+            )
+            if result is None:
+                raise ValueError(
+                    f'Edit record failed: "{id}" does not exist'
+                )
+        else:
+            # update results
+            await self.values(record).where(where).set()
+            if not is_id and self.name_field in record:
+                # refetching by name field, and it just changed
+                new_id = record[self.name_field]
+                where = {'=': [key, f"'{new_id}'"]}
 
-        # refetch the row
-        result = await self.where(where).one()
+            # refetch the row
+            result = await self.where(where).one()
 
         new_result = None
         if post:
@@ -456,3 +602,168 @@ class Model:
             )
         query = self.where({"=": [key, f"'{id}'"]})
         await query.delete()
+
+    def where_ids(self, ids):
+        """Get a SQL condition matching records by IDs or names"""
+        marks = ', '.join('?' for _ in ids)
+        where = f'"{self.id_field}" IN ({marks})'
+        params = list(ids)
+        if self.name_field:
+            where = f'{where} OR "{self.name_field}" IN ({marks})'
+            params.extend(ids)
+        return where, params
+
+    def get_batches(self, items, parameters=1):
+        """Split items into batches that fit in one statement
+
+        Arguments:
+            parameters: bound parameters per item
+        """
+        size = max(1, self.MAX_PARAMETERS // parameters)
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    async def get_json_by_ids(self, ids, fields=None):
+        """Get records by ID as a JSON array string, in batches
+
+        Records are in the order of "ids" batches, and in insertion
+        order within a batch
+        """
+        arrays = []
+        for batch in self.get_batches(ids):
+            marks = ', '.join('?' for _ in batch)
+            array = await self.get_json(
+                fields=fields,
+                where=f'"{self.id_field}" IN ({marks})',
+                params=batch,
+                sort='rowid'
+            )
+            if array and array != '[]':
+                arrays.append(array[1:-1])
+        return f'[{",".join(arrays)}]'
+
+    async def add_records(
+        self,
+        records: list,
+        fields=None
+    ):
+        """Add many records, with one statement per batch
+
+        Returns:
+            JSON array of the added records, read with one query per batch
+        """
+        pre = getattr(self, 'pre_add_records', None)
+        post = getattr(self, 'post_add_records', None)
+
+        if pre:
+            await pre(records)
+
+        id_field = self.id_field
+        for record in records:
+            if id_field not in record:
+                if not self.columns[id_field].get('uuid', False):
+                    raise ValueError(
+                        f'Add records failed: must pass {id_field}'
+                    )
+                record[id_field] = str(uuid.uuid4())
+
+        columns = max((len(record) for record in records), default=1)
+        for batch in self.get_batches(records, columns):
+            # one multi-row insert per batch
+            await self.values(batch).add()
+
+        ids = [record[id_field] for record in records]
+        result = await self.get_json_by_ids(ids, fields=fields)
+        if post:
+            await post(records)
+        return result
+
+    async def edit_records(
+        self,
+        records: list,
+        fields=None
+    ):
+        """Edit many records, each identified by its ID
+
+        All records are checked, including by the "set" hooks and
+        for IDs that do not exist, before any is written: if one record
+        is invalid, none are changed. Records are written with one
+        statement per batch
+
+        Returns:
+            JSON array of the edited records, read with one query per batch
+        """
+        id_field = self.id_field
+        ids = []
+        for record in records:
+            id = record.pop(id_field, None)
+            if id is None or not self.is_id(id):
+                raise ValueError(
+                    f'Edit records failed: each record must have an {id_field}'
+                )
+            ids.append(id)
+
+        found = set()
+        for batch in self.get_batches(ids):
+            marks = ', '.join('?' for _ in batch)
+            rows = await self._database.query(
+                f'SELECT "{id_field}" FROM "{self.name}" '
+                f'WHERE "{id_field}" IN ({marks})',
+                *batch
+            )
+            found.update(row[0] for row in rows)
+        for id in ids:
+            if id not in found:
+                raise ValueError(f'Edit records failed: "{id}" does not exist')
+
+        pre, pre_command, post, post_command = self._hooks['set']
+        query = self.values(records)._model
+        if pre:
+            await pre(self, 'set', query)
+        if pre_command:
+            await pre_command(self, query)
+
+        columns = []
+        for record in records:
+            columns.extend(c for c in record if c not in columns)
+        if columns:
+            # one CASE per column, records without the column keep it
+            pairs = list(zip(ids, records))
+            for batch in self.get_batches(pairs, 2 * len(columns) + 1):
+                sets = []
+                params = []
+                for column in columns:
+                    cases = []
+                    for id, record in batch:
+                        if column in record:
+                            cases.append('WHEN ? THEN ?')
+                            params.extend((id, record[column]))
+                    if cases:
+                        sets.append(
+                            f'"{column}" = CASE "{id_field}" '
+                            f'{" ".join(cases)} ELSE "{column}" END'
+                        )
+                marks = ', '.join('?' for _ in batch)
+                await self._database.execute(
+                    f'UPDATE "{self.name}" SET {", ".join(sets)} '
+                    f'WHERE "{id_field}" IN ({marks})',
+                    *params,
+                    *[id for id, _ in batch]
+                )
+            if post:
+                await post(self, 'set', query, None)
+            if post_command:
+                await post_command(self, query, None)
+
+        return await self.get_json_by_ids(ids, fields=fields)
+
+    async def delete_records(
+        self,
+        ids: list,
+    ):
+        """Delete many records by ID or name, one statement per batch"""
+        parameters = 2 if self.name_field else 1
+        for batch in self.get_batches(ids, parameters):
+            where, params = self.where_ids(batch)
+            await self._database.execute(
+                f'DELETE FROM "{self.name}" WHERE {where}', *params
+            )
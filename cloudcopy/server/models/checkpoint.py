@@ -0,0 +1,91 @@
+import json
+
+from cloudcopy.server.utils import now
+from .base import Model
+
+
+class Checkpoint(Model):
+    """Last copied watermark of a table, per workflow
+
+    Copy steps with a "watermark" only read source rows
+    at or past their table's checkpoint, see incremental.copy_table
+    """
+    name = 'checkpoint'
+    columns = {
+        'id': {
+            'type': 'text',
+            'primary': True,
+            # "{workflow_id}/{table}", see get_id
+        },
+        'workflow_id': {
+            'type': 'text',
+            'related': {
+                'to': 'workflow',
+                'by': 'id'
+            },
+        },
+        'table_name': {
+            'type': 'text',
+        },
+        'column_name': {
+            'type': 'text',
+            # watermark column, a checkpoint of another column is ignored
+        },
+        'value': {
+            'type': 'text',
+            # JSON-encoded watermark value
+        },
+        'updated': {
+            'type': 'text',
+            'updated': True
+        }
+    }
+    indexes = {
+        'checkpoint__workflow_id__idx': {
+            'type': 'btree',
+            'columns': ['workflow_id']
+        }
+    }
+
+    @staticmethod
+    def get_id(workflow_id, table):
+        return f'{workflow_id}/{table}'
+
+    async def get_values(self, workflow_id):
+        """Get a workflow's checkpoints
+
+        Returns:
+            dict of table -> (column, value)
+        """
+        rows = await self._database.query(
+            'SELECT table_name, column_name, value FROM checkpoint '
+            'WHERE workflow_id = ?', workflow_id
+        )
+        return {
+            row[0]: (row[1], json.loads(row[2]))
+            for row in rows
+        }
+
+    async def save(self, workflow_id, table, column, value):
+        """Set a table's checkpoint, in one statement"""
+        await self._database.execute(
+            'INSERT INTO checkpoint '
+            '(id, workflow_id, table_name, column_name, value, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET '
+            'column_name = excluded.column_name, '
+            'value = excluded.value, '
+            'updated = excluded.updated',
+            self.get_id(workflow_id, table),
+            workflow_id,
+            table,
+            column,
+            json.dumps(value, default=str),
+            now()
+        )
+
+    async def reset(self, workflow_id):
+        """Forget a workflow's checkpoints: the next run copies everything"""
+        await self.where(
+            {'=': ['workflow_id', f"'{workflow_id}'"]}
+        ).delete()
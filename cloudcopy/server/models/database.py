@@ -1,7 +1,38 @@
+import json
+from time import monotonic
+
 from .base import Model
+from .version import Version
+from cloudcopy.server.config import settings
 from cloudcopy.server.utils import is_uuid, now
 
 
+class References(object):
+    """Process-wide cache of database references
+
+    Maps both IDs and names to {"url": ..., "scope": ...}
+    """
+    def __init__(self):
+        self.data = {}
+        # last seen value of the shared version counter
+        self.version = None
+        # last time the counter was checked
+        self.checked = float('-inf')
+
+    def get(self, reference):
+        return self.data.get(reference)
+
+    def set(self, id, name, value):
+        self.data[id] = value
+        self.data[name] = value
+
+    def clear(self):
+        self.data = {}
+
+
+reference_cache = References()
+
+
 class Database(Model):
     name = 'database'
     columns = {
@@ -31,3 +62,84 @@ class Database(Model):
             'updated': True
         },
     }
+
+    async def post_add(self, query, result):
+        reference_cache.clear()
+
+    async def post_set(self, query, result):
+        reference_cache.clear()
+
+    async def post_delete(self, query, result):
+        reference_cache.clear()
+
+    async def delete_records(self, ids):
+        await super().delete_records(ids)
+        reference_cache.clear()
+
+    async def check_references(self):
+        """Clear the reference cache if another process changed databases
+
+        Checks the shared version counter at most once per
+        REFERENCE_CACHE_INTERVAL seconds
+        """
+        time = monotonic()
+        if time - reference_cache.checked < settings.REFERENCE_CACHE_INTERVAL:
+            return
+
+        versions = await Version.initialize(self._database)
+        version = await versions.get_value(self.name)
+        reference_cache.checked = time
+        if version != reference_cache.version:
+            reference_cache.clear()
+            reference_cache.version = version
+
+    async def get_references(self, references):
+        """Resolve many database references, using the shared cache
+
+        Arguments:
+            references: database IDs or names
+
+        Returns:
+            dict of reference -> {"url": ..., "scope": ...},
+            for each reference that exists
+        """
+        await self.check_references()
+        result = {}
+        missing = set()
+        for reference in references:
+            value = reference_cache.get(reference)
+            if value is None:
+                missing.add(reference)
+            else:
+                result[reference] = value
+        if not missing:
+            return result
+
+        # look up all missing references in one query
+        missing = list(missing)
+        marks = ', '.join('?' for _ in missing)
+        rows = await self._database.query(
+            f'SELECT id, name, url, scope FROM database '
+            f'WHERE id IN ({marks}) OR name IN ({marks})',
+            *missing,
+            *missing
+        )
+        for id, name, url, scope in rows:
+            value = {
+                'url': url,
+                'scope': json.loads(scope) if scope else None
+            }
+            reference_cache.set(id, name, value)
+            for key in (id, name):
+                if key in missing:
+                    result[key] = value
+        return result
+
+    async def get_urls(self, references):
+        """Resolve many database references to URLs
+
+        Returns:
+            dict of reference -> URL, for each reference that exists
+        """
+        result = await self.get_references(references)
+        return {key: value['url'] for key, value in result.items()}
@@ -0,0 +1,135 @@
+import json
+import hashlib
+
+import arrow
+
+from cloudcopy.server.utils import now
+from .base import Model
+
+
+class DatabaseInfo(Model):
+    """Cached introspection result of a database, per scope
+
+    Entries are dropped by triggers when their database
+    is changed or deleted, see get_triggers, and once expired
+    or past a database's limit of scopes, see evict
+    """
+    name = 'database_info'
+    columns = {
+        'id': {
+            'type': 'text',
+            'primary': True,
+            # "{database_id}/{scope hash}", see get_id
+        },
+        'database_id': {
+            'type': 'text',
+            'related': {
+                'to': 'database',
+                'by': 'id'
+            },
+        },
+        'scope': {
+            'type': 'text',
+            'null': True,
+            # JSON-encoded scope, with sorted keys
+        },
+        'value': {
+            'type': 'text',
+            # JSON-encoded info result
+        },
+        'fetched': {
+            'type': 'text',
+        }
+    }
+    indexes = {
+        'database_info__database_id__idx': {
+            'type': 'btree',
+            'columns': ['database_id']
+        }
+    }
+
+    @staticmethod
+    def get_triggers():
+        """Get SQL statements that invalidate entries of changed databases"""
+        return [
+            f'CREATE TRIGGER IF NOT EXISTS database__{event.lower()}__info '
+            f'AFTER {event} ON "database" BEGIN '
+            'DELETE FROM database_info WHERE database_id = OLD.id; '
+            'END'
+            for event in ('UPDATE', 'DELETE')
+        ]
+
+    @staticmethod
+    def get_id(database_id, scope):
+        digest = hashlib.sha256(scope.encode()).hexdigest()[:16]
+        return f'{database_id}/{digest}'
+
+    @staticmethod
+    def to_scope(scope):
+        return json.dumps(scope, sort_keys=True)
+
+    async def get_value(self, database_id, scope, ttl):
+        """Get a cached info result, if fetched within "ttl" seconds
+
+        Returns:
+            (info, fetched time) or None
+        """
+        row = await self._database.query(
+            'SELECT value, fetched FROM database_info WHERE id = ?',
+            self.get_id(database_id, self.to_scope(scope))
+        )
+        if not row:
+            return None
+        value, fetched = row[0]
+        age = (arrow.utcnow() - arrow.get(fetched)).total_seconds()
+        if age >= ttl:
+            return None
+        return json.loads(value), fetched
+
+    async def save(self, database_id, url, scope, value):
+        """Cache an info result, in one statement
+
+        Not cached if the database's URL changed during introspection:
+        the triggers only drop entries that exist at the time
+
+        Returns:
+            fetched time
+        """
+        scope = self.to_scope(scope)
+        fetched = now()
+        await self._database.execute(
+            'INSERT INTO database_info '
+            '(id, database_id, scope, value, fetched) '
+            'SELECT ?, ?, ?, ?, ? WHERE EXISTS ('
+            'SELECT 1 FROM database WHERE id = ? AND url = ?'
+            ') ON CONFLICT (id) DO UPDATE SET '
+            'value = excluded.value, '
+            'fetched = excluded.fetched',
+            self.get_id(database_id, scope),
+            database_id,
+            scope,
+            json.dumps(value, default=str),
+            fetched,
+            database_id,
+            url
+        )
+        return fetched
+
+    async def evict(self, database_id, ttl, max_scopes):
+        """Drop expired entries, and a database's oldest past "max_scopes"
+
+        Scopes are supplied by callers: without a limit,
+        each new scope would add an entry that is never dropped
+        """
+        cutoff = arrow.utcnow().shift(seconds=-ttl).isoformat()
+        await self._database.execute(
+            'DELETE FROM database_info WHERE fetched < ? OR ('
+            'database_id = ? AND id NOT IN ('
+            'SELECT id FROM database_info WHERE database_id = ? '
+            'ORDER BY fetched DESC LIMIT ?'
+            '))',
+            cutoff,
+            database_id,
+            database_id,
+            max_scopes
+        )
@@ -1,3 +1,6 @@
+import json
+
+from cloudcopy.server.utils import now, supports_returning
 from .base import Model
 
 
@@ -8,6 +11,7 @@ class Job(Model):
     SUCCEEDED = 'Succeeded'
     FAILED = 'Failed'
     STATUS_CHOICES = [QUEUED, STARTED, SUCCEEDED, FAILED]
+    TERMINAL_STATUSES = {SUCCEEDED, FAILED}
     columns = {
         'id': {
             'type': 'text',
@@ -51,4 +55,151 @@ class Job(Model):
             'type': 'text',
             'null': True
         },
+        'progress': {
+            'type': 'text',
+            'null': True,
+            'json': True
+            # results of the completed steps of an unfinished job
+            # JSON object of step position -> step result
+            # a resumed job skips these steps, see requeue_interrupted
+        },
+        'priority': {
+            'type': 'integer',
+            'null': True
+            # task lane of the trigger, see tasks.core.LANES
+            # a queued job is dispatched in the same lane
+        },
     }
+    indexes = {
+        # keyset pagination over all jobs, see get_jobs
+        # by created, not started: queued jobs have not started
+        'job__created__id__idx': {
+            'type': 'btree',
+            'columns': ['created', 'id']
+        },
+        # keyset pagination over one workflow's jobs
+        'job__workflow_id__created__id__idx': {
+            'type': 'btree',
+            'columns': ['workflow_id', 'created', 'id']
+        },
+        # a workflow's queue, in order
+        'job__workflow_id__status__created__idx': {
+            'type': 'btree',
+            'columns': ['workflow_id', 'status', 'created']
+        }
+    }
+
+    def where_queued(self, workflow_id):
+        return self.where({
+            'and': [
+                {'=': ['workflow_id', f"'{workflow_id}'"]},
+                {'=': ['status', f"'{self.QUEUED}'"]}
+            ]
+        })
+
+    async def enqueue(self, workflow_id, job_id, max_queued, priority=None):
+        """Add a queued job, unless the workflow's queue is full
+
+        The depth check and insert are one statement,
+        so concurrent triggers cannot overfill the queue
+
+        Returns:
+            True if the job was queued
+        """
+        time = now()
+        enqueue = (
+            'INSERT INTO job '
+            '(id, workflow_id, status, priority, created, updated) '
+            'SELECT ?, ?, ?, ?, ?, ? WHERE ('
+            'SELECT count(*) FROM job WHERE workflow_id = ? AND status = ?'
+            ') < ?'
+        )
+        params = [
+            job_id, workflow_id, self.QUEUED, priority, time, time,
+            workflow_id, self.QUEUED, max_queued
+        ]
+        if supports_returning():
+            queued = await self._database.query_one_value(
+                f'{enqueue} RETURNING id', *params
+            )
+            return queued is not None
+
+        await self._database.execute(enqueue, *params)
+        count = await self.key(job_id).count()
+        return count > 0
+
+    async def count_queued(self, workflow_id):
+        return await self.where_queued(workflow_id).count()
+
+    async def get_priority(self, job_id):
+        """Get the task lane a job was triggered in, if any"""
+        return await self._database.query_one_value(
+            'SELECT priority FROM job WHERE id = ?', job_id
+        )
+
+    async def get_queued_workflows(self):
+        """Get the IDs of all workflows with queued jobs"""
+        ids = await self.where(
+            {'=': ['status', f"'{self.QUEUED}'"]}
+        ).field('workflow_id').get()
+        return set(ids)
+
+    async def get_progress(self, job_id):
+        """Get the results of a job's completed steps
+
+        Returns:
+            dict of step position (str) -> step result
+        """
+        progress = await self._database.query_one_value(
+            'SELECT progress FROM job WHERE id = ?', job_id
+        )
+        return (json.loads(progress) if progress else None) or {}
+
+    async def save_step(self, job_id, index, result):
+        """Record a completed step of a running job, in one statement
+
+        Concurrent steps of the same job update their own key
+        """
+        await self._database.execute(
+            "UPDATE job SET progress = json_set("
+            "coalesce(progress, '{}'), ?, json(?)) WHERE id = ?",
+            f'$."{index}"',
+            json.dumps(result, default=str),
+            job_id
+        )
+
+    async def requeue_interrupted(self):
+        """Queue started jobs again if their worker is gone
+
+        A started job without a live lease is no longer running:
+        its worker died or lost its lease. The status change is
+        one statement, so each job is requeued once
+
+        Returns:
+            set of IDs of the workflows with requeued jobs
+        """
+        time = now()
+        # an expired lease would keep the requeued job from being admitted
+        await self._database.execute(
+            'DELETE FROM lease WHERE expires <= ?', time
+        )
+        requeue = (
+            'UPDATE job SET status = ?, updated = ? '
+            'WHERE status = ? AND NOT EXISTS ('
+            'SELECT 1 FROM lease l WHERE l.id = job.id)'
+        )
+        params = [self.QUEUED, time, self.STARTED]
+        if supports_returning():
+            rows = await self._database.query(
+                f'{requeue} RETURNING workflow_id', *params
+            )
+            return {row[0] for row in rows}
+
+        # older SQLite: read the jobs first, assumes a single process
+        rows = await self._database.query(
+            'SELECT workflow_id FROM job WHERE status = ? AND NOT EXISTS ('
+            'SELECT 1 FROM lease l WHERE l.id = job.id)',
+            self.STARTED
+        )
+        await self._database.execute(requeue, *params)
+        return {row[0] for row in rows}
@@ -0,0 +1,217 @@
+import arrow
+
+from cloudcopy.server.config import settings
+from cloudcopy.server.utils import now, supports_returning, get_uuid
+from .base import Model
+from .job import Job
+
+
+class Lease(Model):
+    """A running job's claim on one of its workflow's concurrency slots
+
+    Leases expire unless renewed by the running job, so a slot held by
+    a worker that dies is reclaimed after at most LEASE_DURATION seconds
+    """
+    name = 'lease'
+    columns = {
+        'id': {
+            'type': 'text',
+            'primary': True,
+            # same as the job ID
+        },
+        'workflow_id': {
+            'type': 'text',
+            'related': {
+                'to': 'workflow',
+                'by': 'id'
+            },
+        },
+        'expires': {
+            'type': 'text',
+            # leases with expires <= now are not counted
+        },
+        'token': {
+            'type': 'text',
+            'null': True,
+            # unique per admission, tells which dispatcher took the lease
+        },
+    }
+    indexes = {
+        # counting live leases during admission
+        'lease__workflow_id__expires__idx': {
+            'type': 'btree',
+            'columns': ['workflow_id', 'expires']
+        }
+    }
+
+    # the workflow "w" has a free concurrency slot at time "?"
+    FREE_SLOT = (
+        '(w.concurrency IS NULL OR w.concurrency <= 0 OR ('
+        'SELECT count(*) FROM lease l '
+        'WHERE l.workflow_id = w.id AND l.expires > ?'
+        ') < w.concurrency)'
+    )
+
+    @staticmethod
+    def get_expires(time=None):
+        time = arrow.get(time) if time else arrow.utcnow()
+        return time.shift(seconds=settings.LEASE_DURATION).isoformat()
+
+    async def acquire(self, workflow_id, job_id):
+        """Try to take a concurrency slot for a new job, in one statement
+
+        A lease is only inserted if the workflow has no concurrency limit,
+        or fewer live leases than its limit. SQLite serializes writers,
+        so concurrent admissions cannot both see the same free slot.
+        New jobs are not admitted ahead of queued jobs: they are queued
+        too, and admitted in order by admit_next
+
+        Arguments:
+            workflow_id: workflow ID
+            job_id: job ID
+
+        Returns:
+            lease token if the job was admitted, otherwise None
+        """
+        time = now()
+        token = get_uuid()
+        admit = (
+            'INSERT OR IGNORE INTO lease (id, workflow_id, expires, token) '
+            'SELECT ?, w.id, ?, ? FROM workflow w '
+            'WHERE w.id = ? AND NOT EXISTS ('
+            'SELECT 1 FROM job j '
+            'WHERE j.workflow_id = w.id AND j.status = ?'
+            f') AND {self.FREE_SLOT}'
+        )
+        params = [
+            job_id, self.get_expires(time), token,
+            workflow_id, Job.QUEUED, time
+        ]
+        if supports_returning():
+            # an ignored insert (already leased) returns no rows
+            admitted = await self._database.query_one_value(
+                f'{admit} RETURNING id', *params
+            )
+            return token if admitted is not None else None
+
+        # older SQLite: check that this call inserted the lease
+        await self._database.execute(admit, *params)
+        owner = await self._database.query_one_value(
+            'SELECT token FROM lease WHERE id = ?', job_id
+        )
+        return token if owner == token else None
+
+    async def admit_next(self, workflow_id):
+        """Take a concurrency slot for a workflow's oldest queued job
+
+        The job is picked and leased in one statement, so concurrent
+        dispatchers admit different jobs. Jobs already admitted
+        (with a live lease) are skipped; a lease that expired before
+        its job started is replaced
+
+        Returns:
+            (job ID, lease token) if a job was admitted, otherwise None
+        """
+        time = now()
+        token = get_uuid()
+        admit = (
+            'INSERT OR REPLACE INTO lease (id, workflow_id, expires, token) '
+            'SELECT j.id, w.id, ?, ? FROM workflow w '
+            'JOIN job j ON j.workflow_id = w.id '
+            'WHERE w.id = ? AND j.status = ? AND NOT EXISTS ('
+            'SELECT 1 FROM lease l WHERE l.id = j.id AND l.expires > ?'
+            f') AND {self.FREE_SLOT} '
+            'ORDER BY j.created, j.id LIMIT 1'
+        )
+        params = [
+            self.get_expires(time), token,
+            workflow_id, Job.QUEUED, time, time
+        ]
+        if supports_returning():
+            job_id = await self._database.query_one_value(
+                f'{admit} RETURNING id', *params
+            )
+        else:
+            await self._database.execute(admit, *params)
+            job_id = await self._database.query_one_value(
+                'SELECT id FROM lease WHERE token = ?', token
+            )
+        return (job_id, token) if job_id is not None else None
+
+    async def claim(self, job_id, token):
+        """Start an admitted queued job, if it still holds its lease
+
+        The lease may have expired (and been given to another dispatch
+        of the same job) while the job waited for a worker
+
+        Returns:
+            True if the lease was renewed for this job
+        """
+        time = now()
+        expires = self.get_expires(time)
+        claim = (
+            'UPDATE lease SET expires = ? '
+            'WHERE id = ? AND token = ? AND expires > ? AND EXISTS ('
+            'SELECT 1 FROM job j WHERE j.id = ? AND j.status = ?)'
+        )
+        params = [expires, job_id, token, time, job_id, Job.QUEUED]
+        if supports_returning():
+            claimed = await self._database.query_one_value(
+                f'{claim} RETURNING id', *params
+            )
+            return claimed is not None
+
+        await self._database.execute(claim, *params)
+        renewed = await self._database.query_one_value(
+            'SELECT expires FROM lease WHERE id = ? AND token = ?',
+            job_id,
+            token
+        )
+        return renewed == expires
+
+    async def renew(self, job_id, token):
+        """Extend a running job's lease, if it has not expired
+
+        Returns:
+            True if the lease was renewed, False if it expired
+            (and its slot may have been given to another job)
+        """
+        time = now()
+        expires = self.get_expires(time)
+        renew = (
+            'UPDATE lease SET expires = ? '
+            'WHERE id = ? AND token = ? AND expires > ?'
+        )
+        params = [expires, job_id, token, time]
+        if supports_returning():
+            renewed = await self._database.query_one_value(
+                f'{renew} RETURNING id', *params
+            )
+            return renewed is not None
+
+        await self._database.execute(renew, *params)
+        renewed = await self._database.query_one_value(
+            'SELECT expires FROM lease WHERE id = ? AND token = ?',
+            job_id,
+            token
+        )
+        return renewed == expires
+
+    async def release(self, workflow_id, job_id):
+        """Free a job's slot, and any slots of expired leases"""
+        await self._database.execute(
+            'DELETE FROM lease WHERE id = ? OR '
+            '(workflow_id = ? AND expires <= ?)',
+            job_id,
+            workflow_id,
+            now()
+        )
+
+    async def count_running(self, workflow_id):
+        """Get the number of live leases of a workflow"""
+        return await self.where({
+            'and': [
+                {'=': ['workflow_id', f"'{workflow_id}'"]},
+                {'>': ['expires', f"'{now()}'"]}
+            ]
+        }).count()
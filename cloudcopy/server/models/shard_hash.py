@@ -0,0 +1,125 @@
+import json
+
+from cloudcopy.server.utils import now
+from .base import Model
+
+
+class ShardHash(Model):
+    """Cached data hash of a fixed key range of a table, per workflow
+
+    A shard's hash is reused while its change indicators (row count
+    and maximum watermark) are unchanged, see verify.get_hashes
+    """
+    name = 'shard_hash'
+    columns = {
+        'id': {
+            'type': 'text',
+            'primary': True,
+            # "{workflow_id}/{table}/{side}/{position}"
+        },
+        'workflow_id': {
+            'type': 'text',
+            'related': {
+                'to': 'workflow',
+                'by': 'id'
+            },
+        },
+        'table_name': {
+            'type': 'text',
+        },
+        'side': {
+            'type': 'text',
+            # "source" or "target"
+        },
+        'start_key': {
+            'type': 'text',
+            # JSON-encoded first key of the shard's range
+        },
+        'end_key': {
+            'type': 'text',
+            # JSON-encoded last key of the shard's range
+        },
+        'row_count': {
+            'type': 'integer',
+        },
+        'watermark': {
+            'type': 'text',
+            'null': True,
+            # JSON-encoded maximum watermark of the shard
+        },
+        'hash': {
+            'type': 'text',
+        },
+        'updated': {
+            'type': 'text',
+            'updated': True
+        }
+    }
+    indexes = {
+        'shard_hash__workflow_id__table_name__idx': {
+            'type': 'btree',
+            'columns': ['workflow_id', 'table_name']
+        }
+    }
+    # rows per insert statement, within SQLite's parameter limit
+    BATCH_SIZE = 50
+
+    @staticmethod
+    def to_text(value):
+        return json.dumps(value, default=str)
+
+    async def get_hashes(self, workflow_id, table):
+        """Get the cached shard hashes of a table
+
+        Returns:
+            dict of side -> {(start, end): (row count, watermark, hash)}
+            with JSON-encoded start, end and watermark
+        """
+        rows = await self._database.query(
+            'SELECT side, start_key, end_key, row_count, watermark, hash '
+            'FROM shard_hash WHERE workflow_id = ? AND table_name = ?',
+            workflow_id, table
+        )
+        hashes = {}
+        for side, start, end, count, watermark, hash in rows:
+            hashes.setdefault(side, {})[(start, end)] = (count, watermark, hash)
+        return hashes
+
+    async def replace(self, workflow_id, table, shards):
+        """Replace the cached shard hashes of a table
+
+        Arguments:
+            shards: dict of side -> list of shards,
+                each with "start", "end", "count", "watermark" and "hash"
+        """
+        await self._database.execute(
+            'DELETE FROM shard_hash WHERE workflow_id = ? AND table_name = ?',
+            workflow_id, table
+        )
+        time = now()
+        values = []
+        for side, side_shards in shards.items():
+            for position, shard in enumerate(side_shards):
+                values.append([
+                    f'{workflow_id}/{table}/{side}/{position}',
+                    workflow_id,
+                    table,
+                    side,
+                    self.to_text(shard['start']),
+                    self.to_text(shard['end']),
+                    shard['count'],
+                    self.to_text(shard['watermark']),
+                    shard['hash'],
+                    time
+                ])
+        for i in range(0, len(values), self.BATCH_SIZE):
+            batch = values[i:i + self.BATCH_SIZE]
+            marks = ', '.join(
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' for _ in batch
+            )
+            params = [value for row in batch for value in row]
+            await self._database.execute(
+                'INSERT INTO shard_hash (id, workflow_id, table_name, side, '
+                'start_key, end_key, row_count, watermark, hash, updated) '
+                f'VALUES {marks}', *params
+            )
@@ -0,0 +1,41 @@
+from .base import Model
+
+
+class Version(Model):
+    """Change counters, shared by all server and worker processes
+
+    Each counter is incremented by triggers on the table it tracks,
+    so processes can cheaply tell whether their caches are stale
+    """
+    name = 'version'
+    columns = {
+        'id': {
+            'type': 'text',
+            'primary': True,
+            # name of the tracked table
+        },
+        'value': {
+            'type': 'integer',
+            'default': 0
+        },
+    }
+
+    @staticmethod
+    def get_triggers(table):
+        """Get SQL statements that count changes to a table"""
+        statements = [
+            f"INSERT OR IGNORE INTO version (id, value) VALUES ('{table}', 0)"
+        ]
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            statements.append(
+                f'CREATE TRIGGER IF NOT EXISTS {table}__{event.lower()}__version '
+                f'AFTER {event} ON "{table}" BEGIN '
+                f"UPDATE version SET value = value + 1 WHERE id = '{table}'; "
+                'END'
+            )
+        return statements
+
+    async def get_value(self, table):
+        return await self._database.query_one_value(
+            'SELECT value FROM version WHERE id = ?', table
+        )
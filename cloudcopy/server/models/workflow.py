@@ -2,7 +2,12 @@ import json
 
 from adbc.generators import G
 
-from cloudcopy.server.utils import is_uuid, is_url, to_seconds
+from cloudcopy.server.utils import (
+    is_uuid, is_url, to_seconds, now, supports_returning
+)
+from cloudcopy.server.scheduler import is_recurring, get_next_run
+from cloudcopy.server.steps import get_dependencies
+from cloudcopy.server.incremental import validate_copy_step
 from cloudcopy.server.config import settings
 from .database import Database
 from .base import Model
@@ -32,6 +37,19 @@ class Workflow(Model):
             #   source: str (Database ID)
             #   target: Optional[str] (Other Database ID)
             #   scope: Optional[dict]
+            #   name: Optional[str] (unique step name)
+            #   depends_on: Optional[list] (step names or positions)
+            #   watermark: Optional[dict] (copy only, table -> column)
+            #   stream: Optional[list] (copy only, tables copied in full)
+            #   key: Optional[str] (copy with watermark or stream,
+            #       unique key column)
+            #   batch_size: Optional[int] (copy with watermark or stream)
+            #   max_buffered_batches: Optional[int]
+            #       (copy with watermark or stream)
+            #   shard_concurrency: Optional[int]
+            #       (copy with watermark or stream: other copies are
+            #       run by adbc in one pass, without shards)
+            #   verify: Optional[bool] (copy with watermark, integer key)
         },
         'max_retries': {
             'type': 'integer',
@@ -63,10 +81,19 @@ class Workflow(Model):
             'null': True,
             'json': True
             # JSON object with either "rate" or "cron" key:
-            # rate: "5 minutes" (or seconds, hours, days)
-            # cron: ["*", "*", "*", "*", "0", "1"]
+            # rate: "5 minutes" (or seconds, hours, days), alias: "every"
+            # cron: ["0", "1", "*", "*", "*"] (or "0 1 * * *")
             # if set, the workflow will be triggered on the schedule
             # if not set, the workflow can still be triggered manually
+            # one-off keys:
+            # immediate: true (trigger once when added)
+            # delay: "1 minute" (trigger once, after a delay)
+        },
+        'next_run': {
+            'type': 'text',
+            'null': True,
+            # next time a "rate" or "cron" schedule fires
+            # maintained by the scheduler, reset when the schedule changes
         },
         'task_id': {
             'type': 'text',
@@ -85,7 +112,26 @@ class Workflow(Model):
             # number of simultaneous job executions
             # default of 0 = unlimited
             # if a workflow is triggered when the concurrency limit is reached,
-            # the job will immediately fail
+            # the job will be queued until a running job completes
+        },
+        'step_concurrency': {
+            'type': 'integer',
+            'null': True,
+            'default': 1
+            # number of steps of a job that can run at the same time
+            # default of 1 = one step at a time, in order
+            # 0 means unlimited
+            # steps without "depends_on" can start right away
+            # unless this is 1 and no step has "depends_on"
+        },
+        'max_queued': {
+            'type': 'integer',
+            'null': True,
+            'default': None
+            # maximum number of queued jobs
+            # default of null = settings.MAX_QUEUED_JOBS
+            # 0 means do not queue: fail at the concurrency limit
+            # if the queue is full, the job will immediately fail
         },
         'cooldown': {
             'type': 'integer',
@@ -104,17 +150,37 @@ class Workflow(Model):
         }
     }
 
-    async def resolve_steps(self, steps):
+    @staticmethod
+    def get_references(steps):
+        """Get all database references (IDs or names) of workflow steps"""
+        if not steps:
+            return []
+
+        steps = json.loads(steps) if isinstance(steps, str) else steps
+        return [
+            step[key]
+            for step in steps
+            for key in ('source', 'target')
+            if key in step and not is_url(step[key])
+        ]
+
+    async def resolve_steps(self, steps, resolved=None):
         """Get workflow.steps as an object
 
         Resolve all database references, either by ID or name
+
+        Arguments:
+            steps: workflow steps
+            resolved: dict of reference -> URL, if already looked up
         """
         if not steps:
             return None
 
         steps = json.loads(steps) if isinstance(steps, str) else steps
-        resolved = {}
-        db = await Database.initialize(self._database)
+        if resolved is None:
+            db = await Database.initialize(self._database)
+            resolved = await db.get_urls(self.get_references(steps))
+
         for step in steps:
             # look for database references and resolve them
             for key in ('source', 'target'):
@@ -123,22 +189,14 @@ class Workflow(Model):
                 value = step[key]
                 if is_url(value):
                     continue
-                if value in resolved:
-                    step[key] = resolved[value]
-                else:
-                    # memoize lookups
-                    try:
-                        step[key] = await db.get_field(
-                            'url', value
-                        )
-                        resolved[value] = step[key]
-                    except Exception as e:
-                        raise ValueError(
-                            f'Error resolving {key} for step: {step}\nMessage: {e}'
-                        )
+                if value not in resolved:
+                    raise ValueError(
+                        f'Error resolving {key} for step: {step}\n'
+                        f'Message: database "{value}" does not exist'
+                    )
+                step[key] = resolved[value]
         return steps
 
-
     async def pre_add(self, query):
         # validate steps
         parent = super()
@@ -154,31 +212,134 @@ class Workflow(Model):
             return await self.pre_add_one(values)
 
     async def pre_add_many(self, values):
+        # resolve references of all workflows in one query
+        references = []
         for value in values:
-            await self.pre_add_one(value)
+            references.extend(self.get_references(value.get('steps')))
+        db = await Database.initialize(self._database)
+        resolved = await db.get_urls(references)
+        for value in values:
+            await self.pre_add_one(value, resolved)
 
-    async def pre_add_one(self, values):
+    async def pre_add_one(self, values, resolved=None):
         steps = values.get('steps')
-        await self.resolve_steps(steps)
+        self.validate_steps(steps)
+        await self.resolve_steps(steps, resolved)
+        self.validate_schedule(values.get('schedule'))
+
+    def validate_steps(self, steps):
+        steps = json.loads(steps) if isinstance(steps, str) else steps
+        if steps:
+            # raises ValueError if a dependency is invalid
+            get_dependencies(steps)
+            for step in steps:
+                validate_copy_step(step)
+
+    def validate_schedule(self, schedule):
+        schedule = json.loads(schedule) if isinstance(schedule, str) else schedule
+        if is_recurring(schedule):
+            # raises ValueError if invalid
+            get_next_run(schedule, now())
+
+    async def pre_set(self, query):
+        await super().pre_set(query)
+
+        data = query.data('values')
+        if not isinstance(data, list):
+            data = [data]
+
+        for d in data:
+            if 'steps' in d:
+                self.validate_steps(d['steps'])
+            if 'schedule' in d:
+                self.validate_schedule(d['schedule'])
+                # let the scheduler compute the next run
+                d['next_run'] = None
+
+    async def advance(self, next_runs, time):
+        """Claim due scheduled runs and move them to their next run time
+
+        The claim is one statement per batch and only succeeds for workflows
+        that are still due, so a run is never fired by two schedulers
+
+        Arguments:
+            next_runs: dict of workflow ID -> next run time
+            time: current time
+
+        Returns:
+            set of IDs of claimed workflows
+        """
+        if not next_runs:
+            return set()
+
+        ids = list(next_runs.keys())
+        cases = ' '.join('WHEN ? THEN ?' for _ in ids)
+        marks = ', '.join('?' for _ in ids)
+        advance = (
+            f'UPDATE workflow SET next_run = CASE id {cases} END '
+            f'WHERE id IN ({marks}) AND paused = 0 AND '
+            '(next_run IS NULL OR next_run <= ?)'
+        )
+        params = []
+        for id in ids:
+            params.extend((id, next_runs[id]))
+        params.extend(ids)
+        params.append(time)
+
+        if supports_returning():
+            rows = await self._database.query(
+                f'{advance} RETURNING id', *params
+            )
+            return {row[0] for row in rows}
+
+        # older SQLite: read the rows that are still due, then keep
+        # those that this update moved to their next run; a scheduler
+        # advancing the same rows to the same times at the same instant
+        # cannot be told apart
+        rows = await self._database.query(
+            f'SELECT id FROM workflow WHERE id IN ({marks}) AND paused = 0 '
+            'AND (next_run IS NULL OR next_run <= ?)',
+            *ids,
+            time
+        )
+        due = {row[0] for row in rows}
+        await self._database.execute(advance, *params)
+        rows = await self._database.query(
+            f'SELECT id, next_run FROM workflow WHERE id IN ({marks})', *ids
+        )
+        return {
+            id for id, next_run in rows
+            if id in due and next_run == next_runs[id]
+        }
 
     async def post_add_record(self, record, result):
+        await self.schedule_once(result['id'], result['schedule'])
+
+    async def post_add_records(self, records):
+        for record in records:
+            schedule = record.get('schedule')
+            if isinstance(schedule, str):
+                schedule = json.loads(schedule)
+            await self.schedule_once(record['id'], schedule)
+
+    async def schedule_once(self, id, schedule):
+        """Trigger a new workflow with an "immediate" or "delay" schedule"""
         # IMPORTANT: this import deferred to avoid circular import
         # between the co-dependent model and workflow
         from cloudcopy.server.tasks.workflow import execute, _execute
+        from cloudcopy.server.tasks.core import MANUAL
 
-        id = result['id']
-        schedule = result['schedule']
         task = None
         if schedule:
             if schedule.get('immediate'):
                 if settings.ASYNC_TASKS:
-                    task = execute(id)
+                    task = execute(id, priority=MANUAL)
                 else:
                     # running in test mode
                     task = await _execute(id)
             if 'delay' in schedule:
                 delay = to_seconds(schedule['delay'])
-                task = execute.schedule((id, ), delay=delay)
+                task = execute.schedule((id, ), delay=delay, priority=MANUAL)
             if task:
                 # save current task ID onto the workflow
                 # so that it can be revoked later
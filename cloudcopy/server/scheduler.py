@@ -0,0 +1,183 @@
+import heapq
+import arrow
+from datetime import timedelta
+
+from cloudcopy.server.utils import to_seconds
+
+# (name, min, max) of each cron field
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('day_of_week', 0, 6),
+)
+# stop looking for a cron match after this many years
+CRON_MAX_YEARS = 5
+
+
+def is_recurring(schedule):
+    """Whether a workflow schedule fires repeatedly"""
+    return bool(schedule) and any(
+        key in schedule for key in ('rate', 'every', 'cron')
+    )
+
+
+def parse_cron_field(value, low, high, sunday=False):
+    """Parse one cron field into the set of values it matches
+
+    Supports "*", "n", "a-b", "a,b" and steps ("*/n", "a-b/n", "n/n")
+    If "sunday" is set (day of week), 7 is an alias for 0
+    """
+    value = str(value)
+    top = high + 1 if sunday else high
+    result = set()
+    for part in value.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > top or start > end or step < 1:
+            raise ValueError(f'Invalid cron field: "{value}"')
+        values = range(start, end + 1, step)
+        if sunday:
+            values = (v % 7 for v in values)
+        result.update(values)
+    return result
+
+
+class Cron(object):
+    """A standard 5-field cron expression
+
+    Fields are: minute, hour, day (of month), month, day of week (0 = Sunday)
+    Can be passed as a string ("0 * * * *") or a list (["0", "*", "*", "*", "*"])
+    """
+    def __init__(self, value):
+        fields = value.split() if isinstance(value, str) else list(value)
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(
+                f'Invalid cron: "{value}", expecting {len(CRON_FIELDS)} fields'
+            )
+        for (name, low, high), field in zip(CRON_FIELDS, fields):
+            setattr(self, name, parse_cron_field(
+                field, low, high, sunday=name == 'day_of_week'
+            ))
+        # if both day fields are restricted, either may match
+        self.any_day = str(fields[2]) == '*' or str(fields[4]) == '*'
+
+    def matches_day(self, time):
+        dom = time.day in self.day
+        dow = (time.weekday() + 1) % 7 in self.day_of_week
+        return (dom and dow) if self.any_day else (dom or dow)
+
+    def next(self, after):
+        """Get the first matching minute strictly after a datetime"""
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = time.year + CRON_MAX_YEARS
+        while time.year <= limit:
+            if time.month not in self.month:
+                # first day of the next month
+                year, month = divmod(time.month, 12)
+                time = time.replace(
+                    year=time.year + year, month=month + 1,
+                    day=1, hour=0, minute=0
+                )
+                continue
+            if not self.matches_day(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if time.hour not in self.hour:
+                time = time.replace(minute=0) + timedelta(hours=1)
+                continue
+            if time.minute not in self.minute:
+                time += timedelta(minutes=1)
+                continue
+            return time
+        raise ValueError('Cron never matches')
+
+
+def get_next_run(schedule, after, previous=None):
+    """Get the next fire time of a recurring schedule
+
+    Arguments:
+        schedule: workflow schedule, with "rate" (or "every") or "cron"
+        after: time (ISO string) after which the next run must be
+        previous: time of the previous run, if any;
+            rates are kept aligned to it, skipping missed runs
+
+    Returns:
+        ISO string, or None if the schedule is not recurring
+    """
+    after = arrow.get(after)
+    rate = schedule.get('rate') or schedule.get('every')
+    if rate:
+        rate = to_seconds(rate)
+        if rate <= 0:
+            raise ValueError(f'Invalid rate: "{rate}"')
+        if not previous:
+            return after.shift(seconds=rate).isoformat()
+        previous = arrow.get(previous)
+        missed = max(0, int((after - previous).total_seconds() // rate))
+        return previous.shift(seconds=rate * (missed + 1)).isoformat()
+
+    cron = schedule.get('cron')
+    if cron:
+        return arrow.get(Cron(cron).next(after.datetime)).isoformat()
+    return None
+
+
+class Scheduler(object):
+    """In-memory min-heap of the next run time of every scheduled workflow
+
+    Updating or removing a workflow is O(log n): replaced heap entries
+    are left in place and skipped when they reach the top
+    """
+    def __init__(self):
+        self.heap = []
+        # workflow ID -> (next run, schedule)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def set(self, id, next_run, schedule):
+        self.entries[id] = (next_run, schedule)
+        heapq.heappush(self.heap, (next_run, id))
+
+    def remove(self, id):
+        self.entries.pop(id, None)
+
+    def get(self, id):
+        return self.entries.get(id)
+
+    def peek(self):
+        """Get the earliest next run time, if any"""
+        while self.heap:
+            next_run, id = self.heap[0]
+            entry = self.entries.get(id)
+            if entry and entry[0] == next_run:
+                return next_run
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, time):
+        """Remove and return all entries due at or before a time
+
+        Returns:
+            dict of workflow ID -> (next run, schedule)
+        """
+        due = {}
+        while self.heap and self.heap[0][0] <= time:
+            next_run, id = heapq.heappop(self.heap)
+            entry = self.entries.get(id)
+            if entry and entry[0] == next_run:
+                due[id] = self.entries.pop(id)
+        return due
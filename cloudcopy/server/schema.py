@@ -1,10 +1,65 @@
-from .models import Database, Workflow, Job
+import json
+import hashlib
+
+from .models import (
+    Database,
+    Workflow,
+    Job,
+    Lease,
+    Version,
+    Checkpoint,
+    ShardHash,
+    DatabaseInfo
+)
+
+
+MODELS = (
+    Database,
+    Workflow,
+    Job,
+    Lease,
+    Version,
+    Checkpoint,
+    ShardHash,
+    DatabaseInfo
+)
 
 
 def get_schema():
     """Get application model schema"""
     main = {}
-    for model in (Database, Workflow, Job):
+    for model in MODELS:
         main[model.name] = model.get_table_schema()
     schema = {'main': main}
     return schema
+
+
+def get_triggers():
+    """Get SQL statements to set up triggers, applied after the schema"""
+    statements = []
+    for model in (Database, ):
+        # change counters, see Version
+        statements.extend(Version.get_triggers(model.name))
+    statements.extend(DatabaseInfo.get_triggers())
+    return statements
+
+
+def get_fingerprint():
+    """Get a content hash of the application schema and triggers
+
+    Hashes the model definitions that get_schema is built from,
+    as a positive 31-bit integer that fits in SQLite's user_version
+    """
+    content = json.dumps({
+        'models': [
+            [
+                model.name,
+                model.columns,
+                getattr(model, 'constraints', {}),
+                getattr(model, 'indexes', {})
+            ] for model in MODELS
+        ],
+        'triggers': get_triggers()
+    }, sort_keys=True)
+    digest = hashlib.sha256(content.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') & 0x7fffffff
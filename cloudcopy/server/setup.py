@@ -4,3 +4,6 @@ from .config import settings
 def setup_environment():
     os.makedirs(settings.BASE_PATH, exist_ok=True)
     os.makedirs(settings.LOG_PATH, exist_ok=True)
+    directory = os.path.dirname(settings.TASK_DATABASE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
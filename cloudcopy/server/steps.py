@@ -0,0 +1,147 @@
+import asyncio
+
+from cloudcopy.server.utils import now
+
+# step keys used to order steps, not passed on to the runner
+GRAPH_KEYS = ('name', 'depends_on')
+
+
+def is_graph(steps, concurrency=None):
+    """Whether workflow steps should run as a dependency graph
+
+    Steps run in order, without per-step timings, unless a step has
+    "depends_on" or the workflow's step concurrency allows more than one
+    step at a time
+    """
+    if concurrency is not None and concurrency != 1:
+        return True
+    return any(step.get('depends_on') for step in steps or ())
+
+
+def get_step_key(steps, index):
+    """Get a step's name, or its position if it has none"""
+    name = steps[index].get('name')
+    return index if name is None else name
+
+
+def get_dependencies(steps):
+    """Get the positions of the steps that each step depends on
+
+    A step's "depends_on" is a list of step names or positions (from 0)
+
+    Raises:
+        ValueError if a dependency does not exist or steps form a cycle
+    """
+    names = {}
+    for i, step in enumerate(steps):
+        name = step.get('name')
+        if name is None:
+            continue
+        if name in names:
+            raise ValueError(f'Duplicate step name: "{name}"')
+        names[name] = i
+
+    dependencies = []
+    for i, step in enumerate(steps):
+        depends_on = step.get('depends_on') or []
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        indexes = set()
+        for reference in depends_on:
+            if isinstance(reference, str) and reference in names:
+                index = names[reference]
+            elif (
+                isinstance(reference, int) and
+                not isinstance(reference, bool) and
+                0 <= reference < len(steps)
+            ):
+                index = reference
+            else:
+                raise ValueError(
+                    f'Invalid dependency of step {get_step_key(steps, i)}: '
+                    f'"{reference}" does not exist'
+                )
+            if index == i:
+                raise ValueError(
+                    f'Step {get_step_key(steps, i)} depends on itself'
+                )
+            indexes.add(index)
+        dependencies.append(indexes)
+
+    # remove steps with no remaining dependencies until none are left
+    remaining = {i: set(d) for i, d in enumerate(dependencies)}
+    while remaining:
+        ready = [i for i, d in remaining.items() if not d]
+        if not ready:
+            cycle = ', '.join(
+                str(get_step_key(steps, i)) for i in sorted(remaining)
+            )
+            raise ValueError(f'Steps have a dependency cycle: {cycle}')
+        for i in ready:
+            remaining.pop(i)
+        for d in remaining.values():
+            d.difference_update(ready)
+    return dependencies
+
+
+def to_runner_step(step):
+    """Get a step without the keys used only for ordering"""
+    return {k: v for k, v in step.items() if k not in GRAPH_KEYS}
+
+
+async def run_graph(steps, execute_step, concurrency=1, timings=None):
+    """Run each step as soon as the steps it depends on have completed
+
+    Arguments:
+        steps: workflow steps
+        execute_step: coroutine function of (position, step) -> step result
+        concurrency: maximum number of steps running at once,
+            0, None or less means unlimited
+        timings: if set, a list that is extended with one
+            {"step", "start", "end"} object per step, in step order;
+            steps that never started keep a null start
+
+    Returns:
+        list of step results, in step order
+
+    Raises:
+        the first step error: steps that have not started are skipped
+        and running steps are cancelled
+    """
+    dependencies = get_dependencies(steps)
+    semaphore = (
+        asyncio.Semaphore(concurrency)
+        if concurrency and concurrency > 0 else None
+    )
+    if timings is None:
+        timings = []
+    offset = len(timings)
+    timings.extend(
+        {'step': get_step_key(steps, i), 'start': None, 'end': None}
+        for i in range(len(steps))
+    )
+    tasks = []
+
+    async def run_step(i):
+        if dependencies[i]:
+            await asyncio.gather(*(tasks[d] for d in dependencies[i]))
+        if semaphore:
+            await semaphore.acquire()
+        timing = timings[offset + i]
+        timing['start'] = now()
+        try:
+            return await execute_step(i, to_runner_step(steps[i]))
+        finally:
+            timing['end'] = now()
+            if semaphore:
+                semaphore.release()
+
+    # all tasks exist before any step starts waiting on another
+    tasks.extend(asyncio.ensure_future(run_step(i)) for i in range(len(steps)))
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -1,26 +1,131 @@
-from cloudcopy.server.schema import get_schema
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from cloudcopy.server.schema import get_schema, get_triggers, get_fingerprint
 from cloudcopy.server.config import settings
+from cloudcopy.server.models.base import Model
 from adbc.store import Database
 
 
-database = None
+# event loop -> database handle
+# connections are bound to the loop that opened them,
+# so each loop (e.g. each worker thread's loop) keeps its own handle
+databases = weakref.WeakKeyDictionary()
+# event loop -> read-only database handle, see get_internal_reader
+readers = weakref.WeakKeyDictionary()
+# event loop -> lock serializing writes, see get_internal_writer
+writers = weakref.WeakKeyDictionary()
+# whether the schema has been applied by this process
+applied = False
+
+
+def is_wal():
+    return settings.INTERNAL_DATABASE_MODE == 'wal'
+
+
+def open_internal_database():
+    return Database(
+        scope={'schemas': get_schema()},
+        url=f'file:{settings.INTERNAL_DATABASE_FILE}',
+        verbose=settings.DEBUG
+    )
+
+
+async def configure(database, readonly=False):
+    """Set connection options of an internal database handle
+
+    Each handle runs these once it is opened: jobs, schedules,
+    leases and API requests all wait up to INTERNAL_DATABASE_TIMEOUT
+    on SQLite's write lock, instead of failing at once
+    """
+    timeout = int(settings.INTERNAL_DATABASE_TIMEOUT * 1000)
+    await database.execute(f'PRAGMA busy_timeout = {timeout}')
+    if readonly:
+        await database.execute('PRAGMA query_only = ON')
+
+
+async def get_fingerprint_of(database):
+    """Get the schema fingerprint last applied to a database"""
+    return await database.query_one_value('PRAGMA user_version')
 
 
 async def get_internal_database(reset=False):
-    global database
+    global applied
 
+    loop = asyncio.get_event_loop()
+    database = databases.get(loop)
     if database is None or reset:
+        if reset:
+            Model.clear_cache()
+            readers.pop(loop, None)
         schema = get_schema()
-        scope = {'schemas': schema}
         # try to get a handle on the local database
-        database = Database(
-            scope=scope,
-            url=f'file:{settings.INTERNAL_DATABASE_FILE}',
-            verbose=settings.DEBUG
-        )
-        # try to apply schema changes, if any
-        await database.apply(schema)
-        # reset the database to trigger a schema refresh
-        database.reset()
+        database = open_internal_database()
+        await configure(database)
+        if reset or not applied:
+            if is_wal():
+                # persistent: readers no longer block on the writer
+                await database.execute('PRAGMA journal_mode = WAL')
+            fingerprint = get_fingerprint()
+            # skip introspection unless the models changed
+            if reset or await get_fingerprint_of(database) != fingerprint:
+                # try to apply schema changes, if any
+                await database.apply(schema)
+                for statement in get_triggers():
+                    await database.execute(statement)
+                await database.execute(f'PRAGMA user_version = {fingerprint}')
+                # reset the database to trigger a schema refresh
+                database.reset()
+            applied = True
+        databases[loop] = database
 
     return database
+
+
+async def get_internal_reader():
+    """Get a handle on the internal database for reading
+
+    In "wal" mode, reads use their own read-only handle: they see
+    the last committed state and do not wait on job or API writes
+    """
+    database = await get_internal_database()
+    if not is_wal():
+        return database
+
+    loop = asyncio.get_event_loop()
+    reader = readers.get(loop)
+    if reader is None:
+        reader = open_internal_database()
+        await configure(reader, readonly=True)
+        readers[loop] = reader
+    return reader
+
+
+@asynccontextmanager
+async def internal_writer():
+    """Hold the internal database handle for writing
+
+    In "wal" mode, API writers on the same loop take turns, so that
+    they queue here instead of contending for SQLite's write lock.
+    Jobs, leases and schedules write from worker threads or processes,
+    which a lock of this loop cannot order: their writes wait on
+    SQLite's write lock instead, see configure
+    """
+    database = await get_internal_database()
+    if not is_wal():
+        yield database
+        return
+
+    loop = asyncio.get_event_loop()
+    lock = writers.get(loop)
+    if lock is None:
+        lock = writers[loop] = asyncio.Lock()
+    async with lock:
+        yield database
+
+
+async def get_internal_writer():
+    """Get the internal database handle for writing, see internal_writer"""
+    async with internal_writer() as database:
+        yield database
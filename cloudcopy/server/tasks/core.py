@@ -1,11 +1,196 @@
+import os
+import asyncio
+import random
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 from huey import SqliteHuey
+from huey.storage import SqliteStorage, to_bytes
 from cloudcopy.server.config import settings
+from cloudcopy.server.setup import setup_environment
+
+# task lanes, stored as Huey task priorities
+# tasks enqueued without a priority (e.g. periodic tasks) are "scheduled"
+MANUAL = 2
+RETRY = 1
+SCHEDULED = 0
+LANES = {
+    'manual': MANUAL,
+    'retry': RETRY,
+    'scheduled': SCHEDULED
+}
+
+
+def get_lane_weights(value=None):
+    """Parse lane weights, e.g. "manual=6,retry=3,scheduled=1"
+
+    Returns:
+        dict of lane priority -> weight
+    """
+    if value is None:
+        value = settings.TASK_LANE_WEIGHTS
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in LANES:
+            raise ValueError(f'Invalid task lane: "{name}"')
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError(f'Invalid weight for task lane "{name}"')
+        weights[LANES[name]] = weight
+    return weights
+
+
+class LaneStorage(SqliteStorage):
+    """Huey storage that pulls from priority lanes by weight
+
+    Each dequeue picks one of the lanes that have waiting tasks,
+    with odds proportional to the lane's weight, and takes that lane's
+    oldest task: manual runs start quickly even behind a deep backlog
+    of scheduled runs, which still get their share
+    """
+    def __init__(self, name='huey', filename='huey.db', weights=None,
+                 **kwargs):
+        # parsed once, not on every dequeue
+        self.weights = weights or get_lane_weights()
+        # the queue's file is opened as soon as the storage is created
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        super().__init__(name, filename=filename, **kwargs)
+
+    def dequeue(self):
+        with self.db(commit=True) as curs:
+            curs.execute(
+                'select priority, min(id) from task where queue = ? '
+                'group by priority', (self.name,)
+            )
+            heads = curs.fetchall()
+            if not heads:
+                return None
+            if len(heads) == 1:
+                tid = heads[0][1]
+            else:
+                tid = random.choices(
+                    [head[1] for head in heads],
+                    weights=[self.weights.get(head[0], 1) for head in heads]
+                )[0]
+            curs.execute('select data from task where id = ?', (tid, ))
+            result = curs.fetchone()
+            curs.execute('delete from task where id = ?', (tid, ))
+            if result is not None and curs.rowcount == 1:
+                return to_bytes(result[0])
+
 
 # if ASYNC_TASKS is False (e.g. in testing)
 # async tasks will be executed immediately
 # or added to an in-memory schedule registry
 app = SqliteHuey(
     'tasks',
-    filename=settings.INTERNAL_DATABASE_FILE,
+    filename=settings.TASK_DATABASE_FILE,
+    storage_class=LaneStorage,
+    journal_mode='wal',
+    timeout=settings.TASK_DATABASE_TIMEOUT,
     immediate=not settings.ASYNC_TASKS
 )
+
+
+@app.on_startup()
+def prepare_worker():
+    # create required directories, e.g. for job logs
+    setup_environment()
+
+
+# per worker thread state, e.g. the worker's event loop
+local = threading.local()
+
+
+def get_worker_loop():
+    """Get this worker thread's long-lived event loop"""
+    loop = getattr(local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = local.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    return loop
+
+
+def run(coroutine):
+    """Run a coroutine to completion from a (synchronous) task
+
+    With WORKER_LOOP = "thread", every worker thread keeps one event loop
+    across tasks, so that state bound to the loop (e.g. database connections)
+    is reused between jobs; with "job", each task gets a new loop
+    """
+    if settings.WORKER_LOOP == 'job':
+        return asyncio.run(closing_pools(coroutine))
+    return get_worker_loop().run_until_complete(coroutine)
+
+
+async def closing_pools(coroutine):
+    """Await a coroutine, then close the connections it pooled"""
+    from cloudcopy.server.connections import close_pools
+    try:
+        return await coroutine
+    finally:
+        await close_pools()
+
+
+# process pool shared by this process's worker threads
+pool = {'executor': None}
+pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Get this process's pool of WORKER_PROCESSES worker processes"""
+    with pool_lock:
+        if pool['executor'] is None:
+            # spawned, not forked: children must not inherit
+            # open SQLite connections or the parent's event loops
+            pool['executor'] = ProcessPoolExecutor(
+                max_workers=settings.WORKER_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return pool['executor']
+
+
+def run_in_process(function, *args):
+    """Run a function in the worker process pool and wait for its result
+
+    The function must be importable by name (e.g. module-level)
+    If a worker process dies, the pool is replaced for later calls
+    """
+    executor = get_worker_pool()
+    try:
+        return executor.submit(function, *args).result()
+    except BrokenProcessPool:
+        with pool_lock:
+            if pool['executor'] is executor:
+                pool['executor'] = None
+        executor.shutdown(wait=False)
+        raise
+
+
+@app.on_shutdown()
+def close_worker_pool():
+    with pool_lock:
+        executor = pool['executor']
+        pool['executor'] = None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+@app.on_shutdown()
+def close_worker_loop():
+    loop = getattr(local, 'loop', None)
+    if loop is None or loop.is_closed():
+        return
+    from cloudcopy.server.connections import close_pools
+    try:
+        loop.run_until_complete(close_pools())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+        local.loop = None
@@ -1,2 +1,3 @@
 def load():
     from .workflow import execute
+    from .schedule import schedule
@@ -0,0 +1,113 @@
+import threading
+
+from huey import crontab
+
+from cloudcopy.server.tasks.core import app, run, SCHEDULED
+from cloudcopy.server.tasks.workflow import execute, _execute
+from cloudcopy.server.scheduler import Scheduler, is_recurring, get_next_run
+from cloudcopy.server.storage import get_internal_database
+from cloudcopy.server.models import Workflow
+from cloudcopy.server.config import settings
+from cloudcopy.server.utils import now
+
+FIELDS = ('id', 'schedule', 'paused', 'next_run', 'updated')
+
+# this process's view of all scheduled workflows
+scheduler = Scheduler()
+# latest "updated" time seen: only workflows changed since are re-read
+state = {'watermark': None}
+# ticks that overlap with a slow tick are skipped
+lock = threading.Lock()
+
+
+def apply(row, time):
+    """Add, update or remove a workflow in the scheduler"""
+    id = row['id']
+    schedule = row['schedule']
+    if row['paused'] or not is_recurring(schedule):
+        scheduler.remove(id)
+        return
+
+    next_run = row['next_run']
+    if not next_run:
+        current = scheduler.get(id)
+        if current and current[1] == schedule:
+            # already scheduled, keep the next run
+            return
+        try:
+            next_run = get_next_run(schedule, time)
+        except ValueError:
+            scheduler.remove(id)
+            return
+
+    scheduler.set(id, next_run, schedule)
+
+
+async def refresh(model, time):
+    """Apply workflows added or changed since the last refresh"""
+    query = model
+    watermark = state['watermark']
+    if watermark:
+        # >= so that rows written in the same instant are not missed
+        query = query.where({'>=': ['updated', f"'{watermark}'"]})
+
+    for row in await query.take(*FIELDS).get():
+        apply(row, time)
+        if not watermark or row['updated'] > watermark:
+            watermark = row['updated']
+    state['watermark'] = watermark
+
+
+async def refresh_one(model, id, time):
+    try:
+        row = await model.key(id).take(*FIELDS).one()
+    except Exception:
+        row = None
+    if row is None:
+        # deleted
+        scheduler.remove(id)
+        return
+    apply(row, time)
+
+
+async def trigger(id):
+    if settings.ASYNC_TASKS:
+        execute(id, priority=SCHEDULED)
+    else:
+        await _execute(id)
+
+
+async def _schedule():
+    db = await get_internal_database()
+    model = await Workflow.initialize(db)
+    time = now()
+    await refresh(model, time)
+
+    due = scheduler.pop_due(time)
+    ids = list(due.keys())
+    size = settings.SCHEDULER_BATCH_SIZE
+    for i in range(0, len(ids), size):
+        batch = ids[i:i + size]
+        next_runs = {
+            id: get_next_run(due[id][1], time, previous=due[id][0])
+            for id in batch
+        }
+        claimed = await model.advance(next_runs, time)
+        for id in batch:
+            if id in claimed:
+                scheduler.set(id, next_runs[id], due[id][1])
+                await trigger(id)
+            else:
+                # paused, deleted, or claimed by another scheduler
+                await refresh_one(model, id, time)
+
+
+@app.periodic_task(crontab(minute='*'), name='workflow-schedule')
+def schedule():
+    """Trigger workflows with due "rate" or "cron" schedules"""
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        return run(_schedule())
+    finally:
+        lock.release()
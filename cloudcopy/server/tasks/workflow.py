@@ -4,18 +4,27 @@ import asyncio
 import sys
 
 from adbc.workflow import Workflow as Runner
+from huey import crontab
 
-from cloudcopy.server.tasks.core import app
+from cloudcopy.server.tasks.core import app, run, run_in_process, RETRY
 from cloudcopy.server.utils import get_uuid, now
 from cloudcopy.server.storage import get_internal_database
-from cloudcopy.server.models import Job, Workflow
+from cloudcopy.server.models import (
+    Job, Workflow, Lease, Checkpoint, ShardHash
+)
 from cloudcopy.server.config import settings
+from cloudcopy.server.logs import LogWriter
+from cloudcopy.server.steps import is_graph, get_step_key, run_graph
+from cloudcopy.server.incremental import (
+    is_incremental, is_pipelined, copy_incremental
+)
 
 
 class Logger(object):
-    def __init__(self, verbose=False, stdout=None):
+    def __init__(self, verbose=False, stdout=None, prefix=''):
         self.verbose = verbose
         self.stdout = stdout or sys.stdout
+        self.prefix = prefix
 
     def setLevel(self, level, *args):
         self._level = level
@@ -24,7 +33,7 @@ class Logger(object):
         if self.verbose and self.stdout != sys.stdout:
             print(*args)
         arg = args[0]
-        self.stdout.write(f'{arg}\n')
+        self.stdout.write(f'{self.prefix}{arg}\n')
         if hasattr(self.stdout, 'flush'):
             self.stdout.flush()
 
@@ -35,7 +44,147 @@ class Logger(object):
         return self.log(*args, **kwargs)
 
 
-async def _execute(workflow_id: str):
+def loop_time():
+    return asyncio.get_event_loop().time()
+
+
+async def renew_lease(lease_model, job_id, token, logger):
+    """Keep a running job's lease alive until cancelled
+
+    Failed renewals are logged and retried until the lease expires
+
+    Raises:
+        ValueError if the lease expired: its slot may have been given
+        to another job, so this job must stop
+    """
+    interval = settings.LEASE_DURATION / 3
+    renewed = loop_time()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await lease_model.renew(job_id, token):
+                renewed = loop_time()
+                continue
+        except Exception as e:
+            logger.info(f'Failed to renew lease: {e}')
+            if loop_time() - renewed < settings.LEASE_DURATION:
+                continue
+        raise ValueError(f'Lease of job "{job_id}" expired while running')
+
+
+async def dispatch(workflow_id: str):
+    """Start a workflow's queued jobs, oldest first, while slots are free"""
+    db = await get_internal_database()
+    job_model = await Job.initialize(db)
+    lease_model = await Lease.initialize(db)
+    while True:
+        # admitted here, so concurrent dispatchers start different jobs
+        admitted = await lease_model.admit_next(workflow_id)
+        if not admitted:
+            return
+
+        job_id, token = admitted
+        if settings.ASYNC_TASKS:
+            # in the lane it was triggered in, e.g. manual
+            priority = await job_model.get_priority(job_id)
+            execute(workflow_id, job_id, token, priority=priority)
+        else:
+            await _execute(workflow_id, job_id, token=token)
+
+
+async def execute_graph(
+    name,
+    steps,
+    log,
+    concurrency,
+    timings,
+    checkpoints=None,
+    completed=None,
+    on_step=None,
+    hash_model=None
+):
+    """Run workflow steps one runner per step, see steps.run_graph
+
+    Arguments:
+        checkpoints: (checkpoint model, workflow ID), used by copy steps
+            with a "watermark", see incremental.copy_incremental
+        hash_model: shard hash model, used by copy steps with "verify"
+        completed: dict of step position (str) -> result of steps
+            completed before the job was resumed, these are skipped
+        on_step: coroutine function of (position, result),
+            called when a step completes
+
+    Returns:
+        list of step results, in step order
+    """
+    checkpoint_model, workflow_id = checkpoints or (None, None)
+    values = None
+    if checkpoint_model and any(is_incremental(step) for step in steps):
+        values = await checkpoint_model.get_values(workflow_id)
+
+    async def save(table, column, value):
+        await checkpoint_model.save(workflow_id, table, column, value)
+
+    async def load_hashes(table):
+        return await hash_model.get_hashes(workflow_id, table)
+
+    async def save_hashes(table, shards):
+        await hash_model.replace(workflow_id, table, shards)
+
+    async def execute_step(index, step):
+        key = get_step_key(steps, index)
+        logger = Logger(
+            stdout=log,
+            verbose=settings.DEBUG,
+            prefix=f'[{key}] '
+        )
+        position = str(index)
+        if completed and position in completed:
+            logger.info('Completed before the job was resumed, skipping')
+            return completed[position]
+
+        if is_pipelined(step):
+            result = await copy_incremental(
+                step,
+                checkpoints=values,
+                save=save if checkpoint_model else None,
+                logger=logger,
+                hashes=(
+                    (load_hashes, save_hashes)
+                    if hash_model and checkpoint_model else None
+                )
+            )
+        else:
+            runner = Runner(
+                f'{name}.{key}',
+                steps=[step],
+                logger=logger,
+                verbose=settings.DEBUG
+            )
+            result = await runner.execute()
+            result = result[0] if result else None
+        if on_step:
+            await on_step(index, result)
+        return result
+
+    return await run_graph(steps, execute_step, concurrency, timings)
+
+
+async def _execute(
+    workflow_id: str,
+    job_id: str = None,
+    priority: int = None,
+    token: str = None
+):
+    """Execute a workflow
+
+    Arguments:
+        workflow_id: workflow ID or name
+        job_id: ID of a queued job admitted by dispatch,
+            or None to trigger a new job
+        priority: task lane of a new job, see tasks.core.LANES
+        token: lease token of the admitted queued job
+    """
     db = await get_internal_database()
     workflow_model = await Workflow.initialize(db)
     job_model = await Job.initialize(db)
@@ -55,22 +204,45 @@ async def _execute(workflow_id: str):
         # in this case we have nothing to log against
         return
 
-    job_id = get_uuid()
+    workflow_id = workflow['id']
+    queued = job_id is not None
+    if not queued:
+        job_id = get_uuid()
     concurrency = workflow['concurrency']
-    running_jobs = workflow['running_jobs']
     time = now()
-    # TODO: solve race condition:
-    # implement a lock on WorkflowID
-    # to prevent running_jobs from being double-incremented beyond the limit
-    if concurrency > 0 and running_jobs >= concurrency:
-        # fail with concurrency error
+    lease_model = await Lease.initialize(db)
+    if queued:
+        # lost its lease while waiting for a worker (and was admitted
+        # again by another dispatch), or already started
+        if not await lease_model.claim(job_id, token):
+            return
+    else:
+        # admission is a single conditional insert of a lease
+        # so the concurrency limit holds across threads and processes
+        token = await lease_model.acquire(workflow_id, job_id)
+    if not token:
+        max_queued = workflow['max_queued']
+        if max_queued is None:
+            max_queued = settings.MAX_QUEUED_JOBS
+        if await job_model.enqueue(
+            workflow_id, job_id, max_queued, priority=priority
+        ):
+            # admitted in order with the jobs queued before it,
+            # now if slots are free, or when running jobs complete
+            await dispatch(workflow_id)
+            return
+
+        # queue is full: fail with concurrency error
         await job_model.values({
             'id': job_id,
             'workflow_id': workflow_id,
             'result': json.dumps({
                 'error': {
                     'type': 'ConcurrencyError',
-                    'message': f'At concurrency limit: {concurrency}'
+                    'message': (
+                        f'At concurrency limit: {concurrency}, '
+                        f'queue limit: {max_queued}'
+                    )
                 }
             }),
             'status': job_model.FAILED,
@@ -79,32 +251,6 @@ async def _execute(workflow_id: str):
         }).add()
         return
 
-    log_file = os.path.join(
-        settings.LOG_PATH,
-        f"W_{workflow_id}_J_{job_id}.log"
-    )
-
-    await job_model.values({
-        'id': job_id,
-        'workflow_id': workflow_id,
-        'log': log_file,
-        'status': job_model.STARTED,
-        'started': time
-    }).add()
-    job = await job_model.key(job_id).one()
-    # using the current value + 1
-    # guarantees that running jobs will be incremented properly
-    # even if this code were running in different threads
-    await workflow_model.key(workflow_id).values({
-        "running_jobs": {
-            '+': [
-                "running_jobs",
-                1
-            ]
-        }
-    }).set()
-
-    steps = await workflow_model.resolve_steps(workflow['steps'])
     name = workflow['name']
     timeout = workflow['timeout']
     if not timeout:
@@ -112,70 +258,187 @@ async def _execute(workflow_id: str):
 
     max_retries = workflow['max_retries']
     recent_errors = workflow['recent_errors']
-    with open(log_file, 'w') as log:
-        logger = Logger(
-            stdout=log,
-            verbose=settings.DEBUG
-        )
-        runner = Runner(
-            name,
-            steps=steps,
-            logger=logger,
-            verbose=settings.DEBUG
-        )
-        success = False
-        result = None
+    log_file = os.path.join(
+        settings.LOG_PATH,
+        f"W_{workflow_id}_J_{job_id}.jsonl"
+    )
+    success = False
+    result = None
+    # per-step start and end times, if steps run one by one
+    timings = None
+    running = renewal = None
+    # from here on, the job holds a lease: any error fails the job
+    # and releases the lease, so that it is not resumed forever
+    try:
+        values = {
+            'log': log_file,
+            'status': job_model.STARTED,
+            'started': time
+        }
+        if queued:
+            await job_model.key(job_id).values(values).set()
+        else:
+            values['id'] = job_id
+            values['workflow_id'] = workflow_id
+            values['priority'] = priority
+            await job_model.values(values).add()
+        # running_jobs is informational, the leases are the source of truth
+        await workflow_model.key(workflow_id).values({
+            'running_jobs': await lease_model.count_running(workflow_id)
+        }).set()
 
-        try:
-            result = await asyncio.wait_for(runner.execute(), timeout=timeout)
+        steps = await workflow_model.resolve_steps(workflow['steps']) or []
+        step_concurrency = workflow['step_concurrency']
+        if step_concurrency is None:
+            # in order, as before step_concurrency existed
+            step_concurrency = 1
+        graph = is_graph(steps, step_concurrency)
+        # steps completed before an interruption, see Job.requeue_interrupted
+        completed = await job_model.get_progress(job_id) if queued else {}
+        with LogWriter(log_file, append=queued) as log:
+            logger = Logger(
+                stdout=log,
+                verbose=settings.DEBUG
+            )
+            # steps run one by one, also in order, so that completed steps
+            # are recorded and skipped if the job is interrupted and resumed
+            if completed:
+                logger.info(f'Resuming: {len(completed)} steps completed')
+
+            async def on_step(index, result):
+                await job_model.save_step(job_id, index, result)
+
+            # only dependency graphs report per-step timings
+            timings = [] if graph else None
+            execution = execute_graph(
+                name,
+                steps,
+                log,
+                step_concurrency,
+                timings,
+                checkpoints=(await Checkpoint.initialize(db), workflow_id),
+                completed=completed,
+                on_step=on_step,
+                hash_model=await ShardHash.initialize(db)
+            )
+
+            running = asyncio.ensure_future(
+                asyncio.wait_for(execution, timeout=timeout)
+            )
+            renewal = asyncio.ensure_future(
+                renew_lease(lease_model, job_id, token, logger)
+            )
+            await asyncio.wait(
+                [running, renewal],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not running.done():
+                # the lease expired: stop the job and fail it
+                running.cancel()
+                await asyncio.wait([running])
+                renewal.result()
+            result = running.result()
             success = True
-        except Exception as e:
-            result = {
-                'error': {
-                    'type': e.__class__.__name__,
-                    'message': str(e)
-                }
-            }
-            recent_errors += 1
-        finally:
-            # update job with status and completion time
-            status = job_model.SUCCEEDED if success else job_model.FAILED
-            time = now()
-            values = {
-                'result': json.dumps({'data': result}),
-                'status': status,
-                'updated': time,
-                'completed': time
+    except Exception as e:
+        result = {
+            'error': {
+                'type': e.__class__.__name__,
+                'message': str(e)
             }
-            # update job
-            await job_model.key(job_id).values(values).set()
+        }
+        recent_errors += 1
+    finally:
+        if running:
+            running.cancel()
+        if renewal:
+            renewal.cancel()
+        # update job with status and completion time
+        status = job_model.SUCCEEDED if success else job_model.FAILED
+        time = now()
+        result = {'data': result}
+        if timings is not None:
+            result['steps'] = timings
+        values = {
+            # e.g. watermarks may be dates
+            'result': json.dumps(result, default=str),
+            'progress': None,
+            'status': status,
+            'updated': time,
+            'completed': time
+        }
+        # update job
+        await job_model.key(job_id).values(values).set()
+
+        retry = False
+        delay = 2 ** recent_errors
+        if not success:
+            if recent_errors <= max_retries:
+                # retry this task with exponential back-off
+                # TODO: make back-off configurable?
+                retry = True
+        else:
+            # reset recent_errors
+            recent_errors = 0
+        await lease_model.release(workflow_id, job_id)
+        await workflow_model.key(workflow_id).values({
+            'recent_errors': recent_errors,
+            'running_jobs': await lease_model.count_running(workflow_id)
+        }).set()
+        if retry:
+            execute.schedule(
+                (workflow_id, ), delay=delay, priority=RETRY
+            )
+        # a slot is now free
+        await dispatch(workflow_id)
 
-            retry = False
-            delay = 2 ** recent_errors
-            if not success:
-                if recent_errors <= max_retries:
-                    # retry this task with exponential back-off
-                    # TODO: make back-off configurable?
-                    retry = True
-            else:
-                # reset recent_errors
-                recent_errors = 0
-            await workflow_model.key(workflow_id).values({
-                'recent_errors': recent_errors,
-                'running_jobs': {
-                    '-': [
-                        'running_jobs',
-                        1
-                    ]
-                }
-            }).set()
-            if retry:
-                execute.schedule(
-                    (workflow_id, ), delay=delay
-                )
 
+def execute_in_process(workflow_id, job_id=None, priority=None, token=None):
+    """Execute a workflow, in a pooled worker process"""
+    return run(_execute(workflow_id, job_id, priority, token))
 
-@app.task(name='workflow-execute')
-def execute(workflow_id):
-    result = asyncio.run(_execute(workflow_id))
+
+@app.task(name='workflow-execute', context=True)
+def execute(workflow_id, job_id=None, token=None, task=None):
+    # the lane this task was enqueued in, kept by the job if it is queued
+    priority = task.priority if task is not None else None
+    if settings.WORKER_PROCESSES > 0:
+        # admission, leases and job status all go through the
+        # internal database, so they hold across processes
+        return run_in_process(
+            execute_in_process, workflow_id, job_id, priority, token
+        )
+    result = run(_execute(workflow_id, job_id, priority, token))
     return result
+
+
+async def _dispatch_queued():
+    db = await get_internal_database()
+    job_model = await Job.initialize(db)
+    # jobs of dead workers are queued first, in their original order
+    await job_model.requeue_interrupted()
+    for workflow_id in await job_model.get_queued_workflows():
+        await dispatch(workflow_id)
+
+
+async def _resume_interrupted():
+    db = await get_internal_database()
+    job_model = await Job.initialize(db)
+    for workflow_id in await job_model.requeue_interrupted():
+        await dispatch(workflow_id)
+
+
+@app.periodic_task(crontab(minute='*'), name='workflow-dispatch-queued')
+def dispatch_queued():
+    """Dispatch queued jobs whose slots were freed by expired leases
+
+    Also resumes jobs whose worker died while running them
+    """
+    return run(_dispatch_queued())
+
+
+@app.on_startup()
+def resume_interrupted():
+    """Resume jobs left started by a previous run of the server"""
+    if not settings.ASYNC_TASKS:
+        return
+    return run(_resume_interrupted())
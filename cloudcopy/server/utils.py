@@ -1,6 +1,7 @@
 import re
 import arrow
 import uuid
+import sqlite3
 from adbc.store import Database
 from adbc.utils import is_url
 
@@ -14,6 +15,11 @@ def now(as_str=True):
     return result.isoformat() if as_str else result.datetime()
 
 
+def supports_returning():
+    """Whether the internal SQLite database supports RETURNING (3.35+)"""
+    return sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
 def is_uuid(uid, version=4):
     # TODO: real uuid check
     try:
@@ -43,3 +49,11 @@ def to_seconds(value):
             'day': 60*60*24
         }[increment]
         return value * multiplier
+
+
+def to_literal(value):
+    """Get a query literal of a column value"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    value = str(value).replace("'", "''")
+    return f"'{value}'"
@@ -0,0 +1,181 @@
+import json
+import hashlib
+
+from cloudcopy.server.config import settings
+from cloudcopy.server.utils import to_literal
+
+SIDES = ('source', 'target')
+
+
+def to_text(value):
+    return json.dumps(value, default=str)
+
+
+def hash_rows(rows):
+    """Get a hash of rows, independent of column order"""
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(json.dumps(row, sort_keys=True, default=str).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def quote(name):
+    """Quote a table or column name, e.g. of the form schema.table"""
+    return '.'.join(f'"{part}"' for part in name.split('.'))
+
+
+async def check_key(database, table, key):
+    """Check that a table's key can be verified, before it is copied
+
+    Raises:
+        ValueError if the key is not an integer
+    """
+    model = await database.get_model(table)
+    rows = await model.take(key).sort(key).limit(1).get()
+    value = rows[0][key] if rows else 0
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(
+            f'Cannot verify {table} by key "{key}": '
+            f'"{value}" is not an integer'
+        )
+
+
+async def get_shards(database, table, key, column, batch_size):
+    """Split a table into fixed key ranges of "batch_size" keys
+
+    Shard n holds the keys from n * batch_size to (n + 1) * batch_size - 1,
+    so inserts and deletes only change the shards of their own keys.
+    Each shard's change indicators, row count and maximum watermark,
+    are aggregated by the database: one row per shard is read
+
+    Returns:
+        list of {"start", "end", "count", "watermark"}, in key order
+    """
+    size = int(batch_size)
+    key, column = quote(key), quote(column)
+    # floor division, also for negative keys
+    bucket = (
+        f'CASE WHEN {key} >= 0 THEN {key} / {size} '
+        f'ELSE ({key} + 1) / {size} - 1 END'
+    )
+    rows = await database.query(
+        f'SELECT {bucket}, count(*), max({column}) FROM {quote(table)} '
+        'GROUP BY 1 ORDER BY 1'
+    )
+    return [{
+        'start': row[0] * size,
+        'end': (row[0] + 1) * size - 1,
+        'count': row[1],
+        'watermark': row[2]
+    } for row in rows]
+
+
+async def hash_shard(model, key, shard):
+    rows = await model.where({
+        'and': [
+            {'>=': [key, to_literal(shard['start'])]},
+            {'<=': [key, to_literal(shard['end'])]}
+        ]
+    }).sort(key).get()
+    return hash_rows(rows)
+
+
+async def get_hashes(database, table, key, column, batch_size, cached=None):
+    """Get the hash of each shard of a table
+
+    A cached hash is reused if the shard has the same row count
+    and maximum watermark: only changed shards are read in full
+
+    Arguments:
+        cached: dict of (start, end) -> (row count, watermark, hash),
+            JSON-encoded as in ShardHash.get_hashes
+
+    Returns:
+        list of shards, see get_shards, with "hash" and "cached"
+    """
+    cached = cached or {}
+    shards = await get_shards(database, table, key, column, batch_size)
+    model = await database.get_model(table)
+    for shard in shards:
+        entry = cached.get((to_text(shard['start']), to_text(shard['end'])))
+        if (
+            entry and
+            entry[0] == shard['count'] and
+            entry[1] == to_text(shard['watermark'])
+        ):
+            shard['hash'] = entry[2]
+            shard['cached'] = True
+        else:
+            shard['hash'] = await hash_shard(model, key, shard)
+            shard['cached'] = False
+    return shards
+
+
+async def verify_table(
+    source,
+    target,
+    table,
+    column,
+    key='id',
+    batch_size=None,
+    load=None,
+    save=None
+):
+    """Compare a table's source and target data, shard by shard
+
+    Cached hashes are only used if the watermark is not the key:
+    an update in place does not change the maximum key of a shard,
+    so it would not be noticed. Watermarks set on every update
+    (e.g. "updated_at") are expected
+
+    Arguments:
+        source: source database handle
+        target: target database handle
+        table: table name
+        column: watermark column, used to detect changed shards
+        key: unique integer key column, shards are ranges of this column,
+            see check_key
+        batch_size: keys per shard, defaults to COPY_BATCH_SIZE
+        load: coroutine function of (table) -> cached hashes by side
+        save: coroutine function of (table, shards by side)
+
+    Returns:
+        {
+            "shards": number of shards with rows on either side,
+            "cached": number of shards not read in full (both sides),
+            "mismatched": [{"start", "end"}] of shards
+        }
+    """
+    batch_size = batch_size or settings.COPY_BATCH_SIZE
+    if column == key:
+        load = save = None
+    cached = await load(table) if load else {}
+    shards = {}
+    for side, database in zip(SIDES, (source, target)):
+        shards[side] = await get_hashes(
+            database, table, key, column, batch_size, cached.get(side)
+        )
+    if save:
+        await save(table, shards)
+
+    by_start = {
+        side: {shard['start']: shard for shard in shards[side]}
+        for side in SIDES
+    }
+    starts = sorted(set(by_start['source']) | set(by_start['target']))
+    mismatched = []
+    for start in starts:
+        shard = by_start['source'].get(start)
+        other = by_start['target'].get(start)
+        if not shard or not other or shard['hash'] != other['hash']:
+            shard = shard or other
+            mismatched.append({'start': shard['start'], 'end': shard['end']})
+
+    return {
+        'shards': len(starts),
+        'cached': sum(
+            1 for side in SIDES for shard in shards[side] if shard['cached']
+        ),
+        'mismatched': mismatched
+    }
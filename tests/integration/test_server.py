@@ -263,6 +263,36 @@ async def test_server():
                 assert response['url'] == 'file:test1'
                 assert response['updated'] >= updated
 
+                # info: introspected once, then cached
+                response = await client.get(f'/v0/databases/{id}/info/')
+                assert response.status_code == 200
+                info = response.json()['data']
+                assert info['id'] == id
+                assert info['cached'] is False
+                assert info['info']
+
+                response = await client.get(f'/v0/databases/{id}/info/')
+                assert response.status_code == 200
+                response = response.json()['data']
+                assert response['cached'] is True
+                assert response['info'] == info['info']
+                assert response['fetched'] == info['fetched']
+
+                response = await client.get(
+                    f'/v0/databases/{id}/info/', params={'refresh': 'true'}
+                )
+                assert response.status_code == 200
+                assert response.json()['data']['cached'] is False
+
+                # edits drop cached info
+                response = await client.patch(
+                    f'/v0/databases/{id}/',
+                    data=json.dumps({'data': {'url': 'file:test1'}})
+                )
+                assert response.status_code == 200
+                response = await client.get(f'/v0/databases/{id}/info/')
+                assert response.json()['data']['cached'] is False
+
                 # Workflows
                 response = await client.get(
                     f'/v0/workflows'
@@ -331,6 +361,83 @@ async def test_server():
                 assert data['status'] == 'Succeeded'
                 result = data['result']
                 assert result == diff_0_1_result
+
+                # keyset pagination
+                cursor = f"{data['created']},{data['id']}"
+                response = await client.get('/v0/jobs/', params={'limit': 1})
+                assert response.status_code == 200
+                assert len(response.json()['data']) == 1
+
+                response = await client.get(
+                    '/v0/jobs/', params={'before': cursor}
+                )
+                assert response.status_code == 200
+                assert response.json()['data'] == []
+
+                response = await client.get(
+                    '/v0/jobs/',
+                    params={'after': data['created'], 'ascending': 'true'}
+                )
+                assert response.status_code == 200
+                assert response.json()['data'] == []
+
+                # batch POST
+                batch = [
+                    {'name': 'batch0', 'url': 'file:batch0'},
+                    {'name': 'batch1', 'url': 'file:batch1'}
+                ]
+                response = await client.post(
+                    '/v0/databases/batch/',
+                    data=json.dumps({'data': batch})
+                )
+                assert response.status_code == 201
+                response = response.json()['data']
+                assert [r['name'] for r in response] == ['batch0', 'batch1']
+                ids = [r['id'] for r in response]
+
+                response = await client.post(
+                    '/v0/workflows/batch/',
+                    data=json.dumps({'data': [{
+                        'name': f'batch-info-{i}',
+                        'steps': [{'type': 'info', 'source': name}]
+                    } for i, name in enumerate(('batch0', ids[1]))]})
+                )
+                assert response.status_code == 201
+                assert len(response.json()['data']) == 2
+
+                # batch PATCH
+                response = await client.patch(
+                    '/v0/databases/batch/',
+                    data=json.dumps({'data': [
+                        {'id': ids[0], 'url': 'file:batch2'}
+                    ]})
+                )
+                assert response.status_code == 200
+                response = response.json()['data']
+                assert response[0]['name'] == 'batch0'
+                assert response[0]['url'] == 'file:batch2'
+
+                # batch PATCH with an invalid record: nothing is changed
+                with pytest.raises(ValueError):
+                    await client.patch(
+                        '/v0/databases/batch/',
+                        data=json.dumps({'data': [
+                            {'id': ids[0], 'url': 'file:batch3'},
+                            {'id': 'batch1', 'url': 'file:batch3'}
+                        ]})
+                    )
+                response = await client.get(f'/v0/databases/{ids[0]}/')
+                assert response.json()['data']['url'] == 'file:batch2'
+
+                # batch DELETE (by ID and name)
+                response = await client.request(
+                    'DELETE',
+                    '/v0/databases/batch/',
+                    data=json.dumps({'data': [ids[0], 'batch1']})
+                )
+                assert response.status_code == 204
+                response = await client.get('/v0/databases/')
+                assert len(response.json()['data']) == len(databases) - 1
         finally:
             # clean up test sqlite DB
             if os.path.exists(settings.INTERNAL_DATABASE_FILE):
@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+
+from cloudcopy.server.connections import Pool
+
+
+class FakeHandle(object):
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+        self.delay = 0
+
+    async def query_one_value(self, query):
+        await asyncio.sleep(self.delay)
+        if not self.healthy:
+            raise ConnectionError('closed by the server')
+        return 1
+
+    async def close(self):
+        self.closed = True
+
+
+class FakePool(Pool):
+    def open(self):
+        return FakeHandle()
+
+
+@pytest.mark.asyncio
+async def test_pool():
+    pool = FakePool('test', size=2, idle_timeout=60, check_interval=0)
+    first = await pool.acquire()
+    second = await pool.acquire()
+    assert first is not second
+
+    # at the maximum size, borrowers wait for a release
+    waiting = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    await pool.release(first)
+    assert await waiting is first
+    assert pool.opened == 2
+
+    # a handle that fails its check is replaced
+    await pool.release(second)
+    second.healthy = False
+    third = await pool.acquire()
+    assert third is not second and second.closed
+
+    # a handle released after a failure is closed
+    await pool.release(third, discard=True)
+    assert third.closed and pool.opened == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_evict():
+    pool = FakePool('test', size=2, idle_timeout=0.01)
+    handle = await pool.acquire()
+    await pool.release(handle)
+    await pool.evict()
+    assert not handle.closed
+    await asyncio.sleep(0.02)
+    await pool.evict()
+    assert handle.closed and pool.opened == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_cancel():
+    pool = FakePool('test', size=1, check_interval=0)
+    handle = await pool.acquire()
+    await pool.release(handle)
+
+    # cancelled during the check of an idle handle
+    handle.delay = 1
+    checking = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0.01)
+    checking.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await checking
+    # the slot is free again, the unchecked handle is closed
+    assert pool.used == 0 and handle.closed
+    assert await asyncio.wait_for(pool.acquire(), 1) is not handle
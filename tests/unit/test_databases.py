@@ -0,0 +1,66 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from cloudcopy.server.api.v0.endpoints import database
+
+
+class FakeInfo(object):
+    """Stand-in for the database info model"""
+    saved = []
+
+    @classmethod
+    async def initialize(cls, db):
+        return cls()
+
+    @staticmethod
+    def to_scope(scope):
+        return str(scope)
+
+    async def save(self, database_id, url, scope, value):
+        self.saved.append((database_id, scope))
+        return 'fetched'
+
+    async def evict(self, database_id, ttl, max_scopes):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_get_info_single_flight(monkeypatch):
+    introspected = []
+
+    async def introspect(url, scope=None):
+        introspected.append(scope)
+        await asyncio.sleep(0.01)
+        return {'url': url}
+
+    @asynccontextmanager
+    async def internal_writer():
+        yield None
+
+    monkeypatch.setattr(database, 'introspect', introspect)
+    monkeypatch.setattr(database, 'internal_writer', internal_writer)
+    monkeypatch.setattr(database, 'DatabaseInfo', FakeInfo)
+    monkeypatch.setattr(FakeInfo, 'saved', [])
+
+    record = {'id': 'test', 'url': 'file:test'}
+    results = await asyncio.gather(*(
+        database._get_info(record, scope)
+        for scope in ('a', 'a', 'a', 'b')
+    ))
+    # one introspection per scope, shared by concurrent callers
+    assert sorted(introspected) == ['a', 'b']
+    assert sorted(FakeInfo.saved) == [('test', 'a'), ('test', 'b')]
+    assert results[0] == results[2] == ({'url': 'file:test'}, 'fetched')
+    assert not database._introspections
+
+    # a caller that gives up does not cancel the others
+    waiting = [
+        asyncio.ensure_future(database._get_info(record, 'c'))
+        for _ in range(2)
+    ]
+    await asyncio.sleep(0)
+    waiting[0].cancel()
+    assert await waiting[1] == ({'url': 'file:test'}, 'fetched')
+    assert introspected.count('c') == 1
@@ -0,0 +1,214 @@
+import asyncio
+import pytest
+
+from cloudcopy.server.incremental import (
+    copy_table, validate_copy_step, to_literal, get_size
+)
+from tests.utils import FakeQuery, FakeDatabase
+
+
+def test_validate_copy_step():
+    validate_copy_step({'type': 'copy', 'watermark': {'test': 'updated'}})
+    validate_copy_step({'type': 'info'})
+    with pytest.raises(ValueError):
+        validate_copy_step({'type': 'info', 'watermark': {'test': 'id'}})
+    with pytest.raises(ValueError):
+        validate_copy_step({'type': 'copy', 'watermark': 'id'})
+    with pytest.raises(ValueError):
+        validate_copy_step({
+            'type': 'copy', 'watermark': {'test': 'id'}, 'batch_size': 0
+        })
+    validate_copy_step({
+        'type': 'copy', 'stream': ['test'], 'max_buffered_batches': 1
+    })
+    with pytest.raises(ValueError):
+        validate_copy_step({'type': 'copy', 'stream': 'test'})
+    with pytest.raises(ValueError):
+        validate_copy_step({
+            'type': 'copy', 'stream': ['test'], 'watermark': {'test': 'id'}
+        })
+    with pytest.raises(ValueError):
+        validate_copy_step({'type': 'copy', 'stream': ['test'], 'verify': True})
+    with pytest.raises(ValueError):
+        validate_copy_step({'type': 'copy', 'max_buffered_batches': 1})
+    assert to_literal(1) == '1'
+    assert to_literal("it's") == "'it''s'"
+
+
+@pytest.mark.asyncio
+async def test_copy_table():
+    # three rows per watermark value, split across batches
+    source = [{'id': i, 'updated': i // 3} for i in range(10)]
+    target = []
+    saved = []
+
+    async def save(watermark):
+        saved.append(watermark)
+
+    result = await copy_table(
+        FakeDatabase(source),
+        FakeDatabase(target),
+        'test',
+        'updated',
+        save=save,
+        batch_size=2
+    )
+    assert result['rows'] == 10
+    assert result['watermark'] == 3
+    assert [shard['rows'] for shard in result['shards']] == [2] * 5
+    assert result['shards'][0]['bytes'] == get_size(source[:2]) == 43
+    assert result['shards'][-1]['end'] == 3
+    assert sorted(row['id'] for row in target) == list(range(10))
+    assert saved[-1] == 3
+
+    # one update and one insert since the checkpoint
+    source[1]['updated'] = 5
+    source.append({'id': 10, 'updated': 5})
+    result = await copy_table(
+        FakeDatabase(source),
+        FakeDatabase(target),
+        'test',
+        'updated',
+        checkpoint=3,
+        save=save,
+        batch_size=2
+    )
+    # the row at the checkpoint is copied again, older rows are not
+    assert (result['rows'], result['watermark']) == (3, 5)
+    assert sorted(row['id'] for row in target) == list(range(11))
+    assert [r for r in target if r['id'] == 1][0]['updated'] == 5
+
+
+class SlowQuery(FakeQuery):
+    """Writes of the first shard are slower than the others"""
+    async def add(self):
+        writing = self.state['writing']
+        writing.append(self.data[0]['id'])
+        self.state['peak'] = max(self.state['peak'], len(writing))
+        await asyncio.sleep(0.03 if self.data[0]['id'] == 0 else 0.01)
+        writing.remove(self.data[0]['id'])
+        await super().add()
+
+
+class SlowDatabase(FakeDatabase):
+    query_class = SlowQuery
+
+
+@pytest.mark.asyncio
+async def test_copy_table_shards():
+    state = {'writing': [], 'peak': 0}
+    source = [{'id': i, 'updated': i} for i in range(8)]
+    target = []
+    saved = []
+
+    async def save(watermark):
+        saved.append(watermark)
+
+    result = await copy_table(
+        FakeDatabase(source),
+        SlowDatabase(target, state),
+        'test',
+        'updated',
+        save=save,
+        batch_size=2,
+        shard_concurrency=3
+    )
+    assert state['peak'] == 3
+    assert sorted(row['id'] for row in target) == list(range(8))
+    # the checkpoint waits for the slow first shard
+    assert saved == sorted(saved)
+    assert saved[0] >= 3 and saved[-1] == 7
+    assert [(s['start'], s['end']) for s in result['shards']] == [
+        (0, 1), (2, 3), (4, 5), (6, 7)
+    ]
+    assert all(s['duration'] >= 0 for s in result['shards'])
+
+
+class CountingQuery(FakeQuery):
+    """Counts shards read from the source and written to the target"""
+    async def get(self):
+        rows = await super().get()
+        if rows:
+            self.state['read'] += 1
+            self.state['ahead'] = max(
+                self.state['ahead'], self.state['read'] - self.state['written']
+            )
+        return rows
+
+    async def add(self):
+        await asyncio.sleep(0.01)
+        await super().add()
+        self.state['written'] += 1
+
+
+class CountingDatabase(FakeDatabase):
+    query_class = CountingQuery
+
+
+@pytest.mark.asyncio
+async def test_copy_table_stream():
+    state = {'read': 0, 'written': 0, 'ahead': 0}
+    source = [{'id': i, 'name': str(i)} for i in range(20)]
+    target = [{'id': 3, 'name': 'old'}]
+    max_buffered_batches = 1
+    shard_concurrency = 1
+
+    result = await copy_table(
+        CountingDatabase(source, state),
+        CountingDatabase(target, state),
+        'test',
+        None,
+        batch_size=2,
+        shard_concurrency=shard_concurrency,
+        max_buffered_batches=max_buffered_batches
+    )
+    assert sorted(target, key=lambda row: row['id']) == source
+    assert (result['rows'], result['watermark']) == (20, None)
+    assert [s['end'] for s in result['shards']] == list(range(1, 20, 2))
+    assert result['max_buffered'] == 1
+    # reads wait for writes: buffered, writing, and one being read
+    assert state['ahead'] == max_buffered_batches + shard_concurrency + 1
+
+
+class UpdatingQuery(FakeQuery):
+    """Updates the first row once the first shard is read"""
+    async def get(self):
+        rows = await super().get()
+        if rows and rows[0]['name'] == 'old' and rows[0]['id'] == 0:
+            self.rows[0].update({'updated': 10, 'name': 'new'})
+        return rows
+
+
+class UpdatingDatabase(FakeDatabase):
+    query_class = UpdatingQuery
+
+
+class StaleQuery(FakeQuery):
+    """Writes of the stale version of the first row are slow"""
+    async def add(self):
+        if self.data[0]['name'] == 'old' and self.data[0]['id'] == 0:
+            await asyncio.sleep(0.03)
+        await super().add()
+
+
+class StaleDatabase(FakeDatabase):
+    query_class = StaleQuery
+
+
+@pytest.mark.asyncio
+async def test_copy_table_updated():
+    source = [{'id': i, 'updated': i, 'name': 'old'} for i in range(6)]
+    target = []
+
+    result = await copy_table(
+        UpdatingDatabase(source),
+        StaleDatabase(target),
+        'test',
+        'updated',
+        batch_size=2,
+        shard_concurrency=4
+    )
+    # the row is read twice: by the first shard, then by the last
+    assert [s['rows'] for s in result['shards']] == [2, 2, 2, 1]
+    # the last version read is kept, once
+    assert sorted(target, key=lambda row: row['id']) == source
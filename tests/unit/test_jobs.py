@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from cloudcopy.server.api.v0.endpoints import job
+from cloudcopy.server.models import Job
+from tests.utils import SqliteDatabase
+
+
+def get_jobs_database():
+    columns = ', '.join(f'"{name}"' for name in Job.columns)
+    db = SqliteDatabase(f'CREATE TABLE job ({columns});')
+    # started is null for queued jobs, and jobs that failed admission
+    for i, started in enumerate(['01', None, '03', None, None]):
+        db.connection.execute(
+            'INSERT INTO job (id, status, workflow_id, created, updated, '
+            'started) VALUES (?, ?, ?, ?, ?, ?)',
+            (f'j{i}', 'Queued', 'w', f'2000-01-0{i + 1}', '', started)
+        )
+    return db
+
+
+async def get_pages(db, ascending=False, **kwargs):
+    """Get the IDs of all jobs, page by page"""
+    pages = []
+    cursor = None
+    # bounded, a cursor that does not advance would loop forever
+    for _ in range(10):
+        if ascending:
+            kwargs['after'] = cursor
+        else:
+            kwargs['before'] = cursor
+        response = await job.get_jobs(
+            db=db, limit=2, ascending=ascending, **kwargs
+        )
+        page = json.loads(response.body)['data']
+        if not page:
+            return pages
+        pages.append([row['id'] for row in page])
+        cursor = f"{page[-1]['created']},{page[-1]['id']}"
+    return pages
+
+
+class FakeStatus(object):
+    """Stand-in for a job model's status query"""
+    def key(self, id):
+        return self
+
+    def field(self, name):
+        return self
+
+    async def one(self):
+        return 'Started'
+
+
+@pytest.mark.asyncio
+async def test_follow_disconnect(tmp_path):
+    log_file = tmp_path / 'log.jsonl'
+    log_file.write_bytes(b'{"message": "started"}\n')
+
+    followers = [
+        job._follow_job_log(FakeStatus(), 'test', str(log_file), 0)
+        for _ in range(2)
+    ]
+    for follower in followers:
+        assert await follower.__anext__() == b'{"message": "started"}\n'
+    assert job._status_checks['test']['followers'] == 2
+
+    # followers that disconnect before the job is done
+    await followers[0].aclose()
+    assert job._status_checks['test']['followers'] == 1
+    await followers[1].aclose()
+    assert 'test' not in job._status_checks
+
+
+@pytest.mark.asyncio
+async def test_get_jobs_pages():
+    db = get_jobs_database()
+    assert await get_pages(db) == [['j4', 'j3'], ['j2', 'j1'], ['j0']]
+    assert await get_pages(db, ascending=True) == [
+        ['j0', 'j1'], ['j2', 'j3'], ['j4']
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_jobs_json():
+    db = get_jobs_database()
+    db.connection.execute("UPDATE job SET workflow_id = 'v' WHERE id = 'j2'")
+    # the JSON built by SQLite keeps null fields, and pages
+    # of one workflow step past jobs that have not started
+    response = await job.get_jobs(db=db, f__workflow_id='w', limit=2)
+    page = json.loads(response.body)['data']
+    assert [(row['id'], row['started']) for row in page] == [
+        ('j4', None), ('j3', None)
+    ]
+    assert await get_pages(db, f__workflow_id='w') == [
+        ['j4', 'j3'], ['j1', 'j0']
+    ]
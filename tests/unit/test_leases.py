@@ -0,0 +1,137 @@
+import pytest
+
+from cloudcopy.server.models import Job, Lease
+from cloudcopy.server.models import job as job_module, lease as lease_module
+from tests.utils import SqliteDatabase
+
+SCHEMA = '''
+CREATE TABLE workflow (id text PRIMARY KEY, concurrency integer);
+CREATE TABLE job (
+    id text PRIMARY KEY,
+    workflow_id text,
+    status text,
+    priority integer,
+    created text,
+    updated text
+);
+CREATE TABLE lease (
+    id text PRIMARY KEY,
+    workflow_id text,
+    expires text,
+    token text
+);
+'''
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'fallback'])
+def db(request, monkeypatch):
+    # with and without RETURNING (SQLite < 3.35)
+    monkeypatch.setattr(
+        lease_module, 'supports_returning', lambda: request.param
+    )
+    database = SqliteDatabase(SCHEMA)
+    database.connection.execute("INSERT INTO workflow VALUES ('w', 2)")
+    return database
+
+
+async def run(db, job_id, max_queued=10):
+    """Trigger a job, like _execute: admit it or queue it"""
+    token = await db.model(Lease).acquire('w', job_id)
+    if token:
+        return 'running'
+    if await db.model(Job).enqueue('w', job_id, max_queued):
+        return 'queued'
+    return 'failed'
+
+
+@pytest.mark.asyncio
+async def test_acquire_limit(db):
+    leases = db.model(Lease)
+    assert await leases.acquire('w', 'a')
+    assert await leases.acquire('w', 'b')
+    # at the limit
+    assert await leases.acquire('w', 'c') is None
+    # already leased
+    assert await leases.acquire('w', 'a') is None
+
+    await leases.release('w', 'a')
+    assert await leases.acquire('w', 'c')
+
+    # no limit
+    db.connection.execute("UPDATE workflow SET concurrency = NULL")
+    for i in range(5):
+        assert await leases.acquire('w', f'd{i}')
+
+
+@pytest.mark.asyncio
+async def test_queue_limit(db):
+    results = [await run(db, f'j{i}', max_queued=2) for i in range(5)]
+    assert results == ['running', 'running', 'queued', 'queued', 'failed']
+
+
+@pytest.mark.asyncio
+async def test_admit_drain(db):
+    leases = db.model(Lease)
+    results = [await run(db, f'j{i}') for i in range(5)]
+    assert results == ['running'] * 2 + ['queued'] * 3
+    assert await leases.admit_next('w') is None
+
+    # both slots are freed: the two oldest queued jobs are admitted
+    await leases.release('w', 'j0')
+    await leases.release('w', 'j1')
+    # new triggers do not jump the queue
+    assert await run(db, 'j5') == 'queued'
+    admitted = [await leases.admit_next('w') for _ in range(3)]
+    assert [a[0] for a in admitted[:2]] == ['j2', 'j3']
+    assert admitted[2] is None
+
+    # the first of them completes
+    assert await leases.claim(*admitted[0])
+    db.connection.execute("UPDATE job SET status = 'Started' WHERE id = 'j2'")
+    await leases.release('w', 'j2')
+    assert (await leases.admit_next('w'))[0] == 'j4'
+
+
+@pytest.mark.asyncio
+async def test_admit_once(db):
+    leases = db.model(Lease)
+    results = [await run(db, f'j{i}') for i in range(4)]
+    assert results == ['running'] * 2 + ['queued'] * 2
+
+    # two dispatchers, one free slot: the job is admitted once
+    await leases.release('w', 'j0')
+    first = await leases.admit_next('w')
+    assert first[0] == 'j2'
+    assert await leases.admit_next('w') is None
+
+    # the admitted job starts once
+    job_id, token = first
+    assert await leases.claim(job_id, 'other') is False
+    assert await leases.claim(job_id, token) is True
+    db.connection.execute("UPDATE job SET status = 'Started' WHERE id = 'j2'")
+    assert await leases.claim(job_id, token) is False
+
+    # a lease that expired before its job started is admitted again,
+    # and the first dispatch of the job no longer starts it
+    await leases.release('w', 'j1')
+    job_id, token = await leases.admit_next('w')
+    assert job_id == 'j3'
+    db.connection.execute("UPDATE lease SET expires = '' WHERE id = 'j3'")
+    job_id, again = await leases.admit_next('w')
+    assert job_id == 'j3' and again != token
+    assert await leases.claim(job_id, token) is False
+    assert await leases.claim(job_id, again) is True
+
+
+@pytest.mark.asyncio
+async def test_renew(db):
+    leases = db.model(Lease)
+    token = await leases.acquire('w', 'a')
+    assert await leases.acquire('w', 'b')
+    assert await leases.renew('a', token) is True
+    assert await leases.renew('a', 'other') is False
+
+    # an expired lease is not renewed: its slot may be given to another job
+    db.connection.execute("UPDATE lease SET expires = '' WHERE id = 'a'")
+    assert await leases.acquire('w', 'c')
+    assert await leases.renew('a', token) is False
@@ -0,0 +1,143 @@
+import os
+import pytest
+import tempfile
+
+from cloudcopy.server.logs import (
+    LogWriter, read_index, read_log, follow_log, to_log_time
+)
+
+
+def write_log(path, count=100, interval=256):
+    times = [
+        to_log_time(f'2020-10-01T00:{i // 60:02d}:{i % 60:02d}Z')
+        for i in range(count)
+    ]
+    with LogWriter(path, interval=interval) as log:
+        for i, time in enumerate(times):
+            log.write_line(f'line {i}', time=time)
+    return times
+
+
+def test_log_index():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.jsonl')
+        times = write_log(path)
+
+        index_times, offsets = read_index(path)
+        # sparse: more than one chunk, far fewer entries than lines
+        assert 1 < len(offsets) < len(times)
+        assert offsets[0] == 0
+        assert index_times == sorted(index_times)
+
+        # every indexed offset is the start of the indexed line
+        with open(path, 'rb') as log:
+            for time, offset in zip(index_times, offsets):
+                log.seek(offset)
+                assert f'"time": "{time}"'.encode() in log.readline()
+
+
+def test_read_log():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.jsonl')
+        times = write_log(path)
+
+        lines = read_log(path)
+        assert [line['message'] for line in lines] == [
+            f'line {i}' for i in range(100)
+        ]
+
+        # window, ascending
+        lines = read_log(path, after=times[10], before=times[20])
+        assert [line['message'] for line in lines] == [
+            f'line {i}' for i in range(11, 20)
+        ]
+
+        # window, descending with limit
+        lines = read_log(
+            path, after=times[10], before=times[90], limit=5, ascending=False
+        )
+        assert [line['message'] for line in lines] == [
+            f'line {i}' for i in range(89, 84, -1)
+        ]
+
+        # window, descending, crossing many chunks
+        lines = read_log(path, after=times[10], before=times[90], ascending=False)
+        assert [line['message'] for line in lines] == [
+            f'line {i}' for i in range(89, 10, -1)
+        ]
+
+        # "Z" timestamps are normalized
+        lines = read_log(path, after='2020-10-01T00:01:38Z')
+        assert [line['message'] for line in lines] == ['line 99']
+
+
+def test_read_log_without_index():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.jsonl')
+        times = write_log(path, count=10)
+        os.remove(f'{path}.idx')
+
+        lines = read_log(path, before=times[5], ascending=False, limit=2)
+        assert [line['message'] for line in lines] == ['line 4', 'line 3']
+
+
+def test_append_log():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.jsonl')
+        write_log(path, count=50)
+        # a resumed job continues its log
+        with LogWriter(path, interval=256, append=True) as log:
+            for i in range(50, 100):
+                log.write_line(
+                    f'line {i}',
+                    time=to_log_time(f'2020-10-01T00:{i // 60:02d}:{i % 60:02d}Z')
+                )
+
+        index_times, offsets = read_index(path)
+        assert offsets == sorted(offsets)
+        with open(path, 'rb') as log:
+            for time, offset in zip(index_times, offsets):
+                log.seek(offset)
+                assert f'"time": "{time}"'.encode() in log.readline()
+
+        lines = read_log(path, after='2020-10-01T00:00:45Z', limit=10)
+        assert [line['message'] for line in lines] == [
+            f'line {i}' for i in range(46, 56)
+        ]
+
+
+@pytest.mark.asyncio
+async def test_follow_log():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.jsonl')
+        writer = LogWriter(path)
+        state = {'done': False}
+
+        async def is_done():
+            # complete the log while the follower is idle
+            if not state['done']:
+                writer.write('last\n')
+                writer.close()
+                state['done'] = True
+                return False
+            return True
+
+        writer.write('first\nsecond\n')
+        writer.flush()
+        chunks = []
+        async for chunk in follow_log(
+            path, is_done=is_done, buffer_size=100, interval=0.01
+        ):
+            chunks.append(chunk)
+
+        data = b''.join(chunks)
+        with open(path, 'rb') as log:
+            assert data == log.read()
+        # bounded reads
+        assert all(len(chunk) <= 100 for chunk in chunks)
+        assert data.count(b'\n') == 3
+
+        # resume from an offset
+        offset = len(chunks[0])
+        chunks = [chunk async for chunk in follow_log(path, offset=offset, is_done=is_done)]
+        assert b''.join(chunks) == data[offset:]
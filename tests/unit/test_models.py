@@ -0,0 +1,89 @@
+import gc
+import json
+import weakref
+
+import pytest
+
+from cloudcopy.server.models import Job
+from cloudcopy.server.models.base import Model
+from tests.utils import SqliteDatabase
+
+
+class FakeHandle(object):
+    """Database handle whose query models refer back to it"""
+    def __init__(self):
+        self.opened = 0
+
+    async def get_model(self, name):
+        self.opened += 1
+
+        class Query(object):
+            database = self
+        return Query()
+
+
+@pytest.mark.asyncio
+async def test_model_cache():
+    handle = FakeHandle()
+    first = await Job.initialize(handle)
+    assert (await Job.initialize(handle))._model is first._model
+    assert handle.opened == 1
+
+    # a new handle does not reuse another handle's models
+    other = FakeHandle()
+    assert (await Job.initialize(other))._model is not first._model
+
+    # models are opened again after a schema change
+    Job.clear_cache()
+    assert (await Job.initialize(handle))._model is not first._model
+
+    # models do not keep their handle alive
+    ref = weakref.ref(handle)
+    del handle, first
+    gc.collect()
+    assert ref() is None
+
+
+class Item(Model):
+    name = 'item'
+    columns = {
+        'id': {'type': 'text', 'primary': True},
+        'name': {'type': 'text', 'unique': True},
+        'value': {'type': 'text', 'null': True}
+    }
+    MAX_PARAMETERS = 10
+
+
+@pytest.mark.asyncio
+async def test_edit_records_batches():
+    db = SqliteDatabase(
+        'CREATE TABLE item (id text PRIMARY KEY, name text UNIQUE, value text)'
+    )
+    items = db.model(Item)
+    result = await items.add_records([
+        {'id': str(i), 'name': f'n{i}'} for i in range(7)
+    ])
+    assert [row['id'] for row in json.loads(result)] == [
+        str(i) for i in range(7)
+    ]
+
+    # two parameters per column and record, and one per ID
+    db.executed.clear()
+    result = await items.edit_records([
+        {'id': str(i), 'value': f'v{i}'} for i in range(7)
+    ])
+    assert len(db.executed) == 3
+    assert [row['value'] for row in json.loads(result)] == [
+        f'v{i}' for i in range(7)
+    ]
+
+    # unknown IDs fail the whole edit
+    db.executed.clear()
+    with pytest.raises(ValueError, match='"8" does not exist'):
+        await items.edit_records([
+            {'id': '0', 'value': 'changed'}, {'id': '8', 'value': 'new'}
+        ])
+    assert db.executed == []
+
+    await items.delete_records([str(i) for i in range(6)] + ['n6'])
+    assert json.loads(await items.get_json()) == []
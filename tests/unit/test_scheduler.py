@@ -0,0 +1,127 @@
+import pytest
+from datetime import datetime
+
+from cloudcopy.server.scheduler import Cron, Scheduler, get_next_run
+from cloudcopy.server.tasks import schedule
+from tests.utils import override_settings
+
+
+def test_cron():
+    # every day at 01:30
+    assert get_next_run(
+        {'cron': '30 1 * * *'}, '2020-10-01T01:30:00+00:00'
+    ) == '2020-10-02T01:30:00+00:00'
+    assert get_next_run(
+        {'cron': ['30', '1', '*', '*', '*']}, '2020-10-01T00:00:00+00:00'
+    ) == '2020-10-01T01:30:00+00:00'
+
+    # every 15 minutes on Sundays (7 = 0)
+    assert get_next_run(
+        {'cron': '*/15 * * * 7'}, '2020-10-01T00:00:00+00:00'
+    ) == '2020-10-04T00:00:00+00:00'
+
+    # day of month or day of week, at the end of the year
+    assert get_next_run(
+        {'cron': '0 0 1 1 1'}, '2020-12-29T00:00:00+00:00'
+    ) == '2021-01-01T00:00:00+00:00'
+
+    with pytest.raises(ValueError):
+        Cron('* * *')
+    with pytest.raises(ValueError):
+        Cron('60 * * * *')
+    with pytest.raises(ValueError):
+        # February 30th
+        Cron('0 0 30 2 *').next(datetime(2020, 1, 1))
+
+
+def test_rate():
+    assert get_next_run(
+        {'rate': '5 minutes'}, '2020-10-01T00:00:00+00:00'
+    ) == '2020-10-01T00:05:00+00:00'
+    # missed runs are skipped, staying aligned to the previous run
+    assert get_next_run(
+        {'every': '1 hour'},
+        '2020-10-01T03:30:00+00:00',
+        previous='2020-10-01T00:00:00+00:00'
+    ) == '2020-10-01T04:00:00+00:00'
+    assert get_next_run({'immediate': True}, '2020-10-01T00:00:00+00:00') is None
+
+
+def test_scheduler():
+    scheduler = Scheduler()
+    scheduler.set('a', '2020-10-01T00:05:00+00:00', {'rate': '5 minutes'})
+    scheduler.set('b', '2020-10-01T00:01:00+00:00', {'rate': '1 minute'})
+    scheduler.set('c', '2020-10-01T00:02:00+00:00', {'rate': '1 minute'})
+    # update: the old entry is skipped
+    scheduler.set('b', '2020-10-01T00:10:00+00:00', {'rate': '10 minutes'})
+    scheduler.remove('c')
+    assert len(scheduler) == 2
+    assert scheduler.peek() == '2020-10-01T00:05:00+00:00'
+
+    due = scheduler.pop_due('2020-10-01T00:05:00+00:00')
+    assert list(due.keys()) == ['a']
+    assert 'a' not in scheduler
+    assert scheduler.pop_due('2020-10-01T00:09:00+00:00') == {}
+    assert list(scheduler.pop_due('2020-10-01T00:10:00+00:00')) == ['b']
+    assert scheduler.peek() is None
+
+
+class FakeWorkflows(object):
+    """Workflow rows by ID, for the scheduler"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.id = None
+
+    def key(self, id):
+        other = FakeWorkflows(self.rows)
+        other.id = id
+        return other
+
+    def take(self, *fields):
+        return self
+
+    async def get(self):
+        # nothing changed since the last refresh
+        return []
+
+    async def one(self):
+        return self.rows.get(self.id)
+
+    async def advance(self, next_runs, time):
+        return {id for id in next_runs if id in self.rows}
+
+
+@pytest.mark.asyncio
+async def test_schedule_deleted(monkeypatch):
+    rate = {'rate': '1 minute'}
+    scheduler = Scheduler()
+    scheduler.set('a', '2020-10-01T00:00:00+00:00', rate)
+    scheduler.set('b', '2020-10-01T00:01:00+00:00', rate)
+    # "a" was deleted after it was scheduled
+    model = FakeWorkflows({'b': {'id': 'b'}})
+    triggered = []
+
+    async def get_internal_database():
+        return None
+
+    async def initialize(db):
+        return model
+
+    async def trigger(id):
+        triggered.append(id)
+
+    monkeypatch.setattr(schedule, 'scheduler', scheduler)
+    monkeypatch.setattr(schedule, 'state', {'watermark': None})
+    monkeypatch.setattr(
+        schedule, 'get_internal_database', get_internal_database
+    )
+    monkeypatch.setattr(schedule.Workflow, 'initialize', initialize)
+    monkeypatch.setattr(schedule, 'trigger', trigger)
+    monkeypatch.setattr(schedule, 'now', lambda: '2020-10-01T00:02:00+00:00')
+    with override_settings(SCHEDULER_BATCH_SIZE=1):
+        await schedule._schedule()
+
+    # the deleted workflow is dropped, and the due runs after it still fire
+    assert 'a' not in scheduler
+    assert triggered == ['b']
+    assert scheduler.get('b') == ('2020-10-01T00:03:00+00:00', rate)
@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+
+from cloudcopy.server.steps import (
+    is_graph, get_dependencies, run_graph, to_runner_step
+)
+
+
+def test_dependencies():
+    steps = [
+        {'type': 'info', 'name': 'a'},
+        {'type': 'info', 'depends_on': ['a']},
+        {'type': 'copy', 'depends_on': ['a', 1]},
+    ]
+    assert get_dependencies(steps) == [set(), {0}, {0, 1}]
+    assert to_runner_step(steps[2]) == {'type': 'copy'}
+
+    assert not is_graph([{'type': 'info'}])
+    assert not is_graph([{'type': 'info'}], 1)
+    assert is_graph([{'type': 'info'}], 2)
+    assert is_graph(steps)
+
+    with pytest.raises(ValueError):
+        get_dependencies([{'type': 'info', 'depends_on': ['b']}])
+    with pytest.raises(ValueError):
+        get_dependencies([{'type': 'info', 'depends_on': [0]}])
+    with pytest.raises(ValueError):
+        # cycle
+        get_dependencies([
+            {'name': 'a', 'depends_on': ['b']},
+            {'name': 'b', 'depends_on': ['a']},
+        ])
+
+
+@pytest.mark.asyncio
+async def test_run_graph():
+    steps = [
+        {'name': 'slow'},
+        {'name': 'fast'},
+        {'name': 'after', 'depends_on': ['slow', 'fast']},
+    ]
+    running = []
+    peak = []
+    order = []
+
+    async def execute_step(index, step):
+        # ordering keys are not passed on
+        assert 'name' not in step
+        name = steps[index]['name']
+        running.append(index)
+        peak.append(len(running))
+        await asyncio.sleep(0.02 if name == 'slow' else 0.01)
+        running.remove(index)
+        order.append(name)
+        return name.upper()
+
+    timings = []
+    result = await run_graph(steps, execute_step, 0, timings)
+    assert result == ['SLOW', 'FAST', 'AFTER']
+    # independent steps overlap, the dependent step waits for both
+    assert order == ['fast', 'slow', 'after']
+    assert max(peak) == 2
+    assert [t['step'] for t in timings] == ['slow', 'fast', 'after']
+    assert timings[2]['start'] >= timings[0]['end']
+
+    # bounded
+    peak.clear()
+    order.clear()
+    await run_graph(steps, execute_step, 1)
+    assert max(peak) == 1
+
+    async def fail_step(index, step):
+        if index == 1:
+            raise ValueError('failed')
+        return await execute_step(index, step)
+
+    timings = []
+    with pytest.raises(ValueError):
+        await run_graph(steps, fail_step, 0, timings)
+    # never started
+    assert timings[2]['start'] is None
@@ -0,0 +1,62 @@
+import os
+import random
+import tempfile
+
+import pytest
+
+from tests.utils import override_settings
+from cloudcopy.server.tasks.core import (
+    LaneStorage, get_lane_weights, run_in_process, close_worker_pool,
+    MANUAL, RETRY, SCHEDULED
+)
+
+
+def test_lane_weights():
+    assert get_lane_weights('manual=6, retry=3,scheduled=1') == {
+        MANUAL: 6, RETRY: 3, SCHEDULED: 1
+    }
+    with pytest.raises(ValueError):
+        get_lane_weights('urgent=1')
+    with pytest.raises(ValueError):
+        get_lane_weights('manual=0')
+
+
+def test_lane_storage():
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LaneStorage(
+            'test',
+            filename=os.path.join(directory, 'tasks.db'),
+            weights={MANUAL: 9, RETRY: 1, SCHEDULED: 1}
+        )
+        assert storage.dequeue() is None
+
+        # FIFO within a lane
+        for i in range(3):
+            storage.enqueue(f'scheduled-{i}'.encode(), SCHEDULED)
+        assert storage.dequeue() == b'scheduled-0'
+
+        # a deep scheduled backlog does not hold up manual runs
+        for i in range(100):
+            storage.enqueue(f'scheduled-{i + 3}'.encode(), SCHEDULED)
+        for i in range(10):
+            storage.enqueue(f'manual-{i}'.encode(), MANUAL)
+
+        taken = [storage.dequeue() for _ in range(20)]
+        manual = [t for t in taken if t.startswith(b'manual')]
+        assert len(manual) >= 7
+        assert manual == sorted(manual, key=lambda t: int(t.split(b'-')[1]))
+
+        # lower-weight lanes are still drained
+        rest = [storage.dequeue() for _ in range(storage.queue_size())]
+        assert len(taken) + len(rest) == 112
+        assert storage.dequeue() is None
+
+
+def test_run_in_process():
+    with override_settings(WORKER_PROCESSES=2):
+        try:
+            assert run_in_process(os.getpid) != os.getpid()
+            assert run_in_process(abs, -1) == 1
+        finally:
+            close_worker_pool()
@@ -0,0 +1,104 @@
+import pytest
+
+from cloudcopy.server.incremental import copy_tables
+from cloudcopy.server.verify import verify_table, check_key, to_text
+from tests.utils import FakeQuery, FakeDatabase
+
+
+class ReadingQuery(FakeQuery):
+    """Counts rows read through the query model"""
+    async def get(self):
+        rows = await super().get()
+        self.state['read'] += len(rows)
+        return rows
+
+
+class ReadingDatabase(FakeDatabase):
+    query_class = ReadingQuery
+
+
+@pytest.mark.asyncio
+async def test_verify_table():
+    source = [{'id': i, 'updated': i, 'name': f'n{i}'} for i in range(10)]
+    target = [dict(row) for row in source]
+    cache = {}
+    state = {'read': 0}
+
+    async def load(table):
+        return cache.get(table, {})
+
+    async def save(table, shards):
+        # as stored and read back by ShardHash
+        cache[table] = {
+            side: {
+                (to_text(s['start']), to_text(s['end'])): (
+                    s['count'], to_text(s['watermark']), s['hash']
+                ) for s in side_shards
+            } for side, side_shards in shards.items()
+        }
+
+    def verify(column='updated'):
+        return verify_table(
+            ReadingDatabase(source, state),
+            ReadingDatabase(target, state),
+            'test',
+            column,
+            batch_size=4,
+            load=load,
+            save=save
+        )
+
+    result = await verify()
+    assert result == {'shards': 3, 'cached': 0, 'mismatched': []}
+
+    # nothing changed: no shard is read in full,
+    # and change indicators are aggregated by the database
+    state['read'] = 0
+    result = await verify()
+    assert result == {'shards': 3, 'cached': 6, 'mismatched': []}
+    assert state['read'] == 0
+
+    # a source update moves the watermark of one shard
+    source[5].update({'updated': 20, 'name': 'changed'})
+    result = await verify()
+    assert result['cached'] == 5
+    assert result['mismatched'] == [{'start': 4, 'end': 7}]
+
+    # an extra target row
+    target.append({'id': 10, 'updated': 10, 'name': 'extra'})
+    target[5].update(source[5])
+    result = await verify()
+    assert result['mismatched'] == [{'start': 8, 'end': 11}]
+
+    target.pop()
+    result = await verify()
+    assert result == {'shards': 3, 'cached': 5, 'mismatched': []}
+
+    # shards are fixed key ranges: deleting the first row
+    # only changes the first shard
+    del source[0], target[0]
+    result = await verify()
+    assert result == {'shards': 3, 'cached': 4, 'mismatched': []}
+
+    # an update in place is not seen by the key: never cached
+    source[1]['name'] = 'changed'
+    result = await verify('id')
+    assert result['cached'] == 0
+    assert result['mismatched'] == [{'start': 0, 'end': 3}]
+
+
+@pytest.mark.asyncio
+async def test_verify_key():
+    await check_key(FakeDatabase([{'id': 1}]), 'test', 'id')
+    await check_key(FakeDatabase([]), 'test', 'id')
+
+    # rejected before anything is copied
+    source = [{'id': 'a', 'updated': 1}]
+    target = []
+    step = {'type': 'copy', 'watermark': {'test': 'updated'}, 'verify': True}
+    with pytest.raises(ValueError):
+        await copy_tables(
+            FakeDatabase(source), FakeDatabase(target), step,
+            {}, None, None, None
+        )
+    assert target == []
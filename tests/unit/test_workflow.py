@@ -0,0 +1,264 @@
+import asyncio
+
+import pytest
+
+from cloudcopy.server.tasks import workflow as tasks
+from cloudcopy.server.tasks.core import MANUAL
+from tests.utils import override_settings
+
+
+class FakeRows(object):
+    """In-memory stand-in for a model's rows, by ID"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.id = None
+        self.data = None
+
+    def copy(self, **kwargs):
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.__dict__.update(kwargs)
+        return other
+
+    def key(self, id):
+        return self.copy(id=id)
+
+    def values(self, data):
+        return self.copy(data=data)
+
+    async def set(self):
+        self.rows[self.id].update(self.data)
+
+    async def add(self):
+        self.rows[self.data['id']] = dict(self.data)
+
+
+class FakeWorkflows(FakeRows):
+    id_field = 'id'
+    name_field = 'name'
+
+    def is_id(self, value):
+        return True
+
+    def where(self, condition):
+        return self.copy(id=condition['='][1].strip('"'))
+
+    async def one(self):
+        return dict(self.rows[self.id])
+
+    async def resolve_steps(self, steps):
+        if any(step.get('source') == 'deleted' for step in steps or ()):
+            raise ValueError('database "deleted" does not exist')
+        # like Workflow.resolve_steps
+        return steps or None
+
+
+class FakeJobs(FakeRows):
+    STARTED = 'Started'
+    SUCCEEDED = 'Succeeded'
+    FAILED = 'Failed'
+
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.progress = {}
+
+    async def get_progress(self, job_id):
+        return dict(self.progress.get(job_id, {}))
+
+    async def save_step(self, job_id, index, result):
+        self.progress.setdefault(job_id, {})[str(index)] = result
+
+    async def get_priority(self, job_id):
+        return self.rows[job_id].get('priority')
+
+
+class FakeLeases(object):
+    """Leases without a concurrency limit"""
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.held = set()
+
+    async def acquire(self, workflow_id, job_id):
+        self.held.add(job_id)
+        return 'token'
+
+    async def claim(self, job_id, token):
+        return True
+
+    async def renew(self, job_id, token):
+        return True
+
+    async def admit_next(self, workflow_id):
+        for job in self.jobs.rows.values():
+            if job['status'] == 'Queued' and job['id'] not in self.held:
+                self.held.add(job['id'])
+                return job['id'], 'token'
+        return None
+
+    async def release(self, workflow_id, job_id):
+        self.held.discard(job_id)
+
+    async def count_running(self, workflow_id):
+        return len(self.held)
+
+
+class FakeRunner(object):
+    names = []
+
+    def __init__(self, name, steps=None, **kwargs):
+        self.steps = steps
+        FakeRunner.names.append(name)
+
+    async def execute(self):
+        for step in self.steps:
+            await asyncio.sleep(step.get('seconds', 0))
+        return [{} for _ in self.steps]
+
+
+def fake_model(instance):
+    class Model(object):
+        @staticmethod
+        async def initialize(db):
+            return instance
+    return Model
+
+
+@pytest.fixture
+def models(monkeypatch, tmp_path):
+    workflows = FakeWorkflows({})
+    jobs = FakeJobs({})
+    leases = FakeLeases(jobs)
+
+    async def get_internal_database():
+        return None
+
+    monkeypatch.setattr(tasks, 'get_internal_database', get_internal_database)
+    monkeypatch.setattr(tasks, 'Workflow', fake_model(workflows))
+    monkeypatch.setattr(tasks, 'Job', fake_model(jobs))
+    monkeypatch.setattr(tasks, 'Lease', fake_model(leases))
+    monkeypatch.setattr(tasks, 'Checkpoint', fake_model(None))
+    monkeypatch.setattr(tasks, 'ShardHash', fake_model(None))
+    monkeypatch.setattr(tasks, 'Runner', FakeRunner)
+    monkeypatch.setattr(FakeRunner, 'names', [])
+    with override_settings(LOG_PATH=str(tmp_path), ASYNC_TASKS=False):
+        yield workflows, jobs, leases
+
+
+def add_workflow(workflows, steps):
+    workflows.rows['w'] = {
+        'id': 'w',
+        'name': 'test',
+        'steps': steps,
+        'concurrency': 1,
+        'step_concurrency': None,
+        'timeout': None,
+        'max_retries': 0,
+        'recent_errors': 0,
+        'running_jobs': 0
+    }
+
+
+@pytest.mark.asyncio
+async def test_execute_empty_steps(models):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [])
+
+    await tasks._execute('w')
+    job = next(iter(jobs.rows.values()))
+    assert job['status'] == 'Succeeded'
+    assert job['result'] == '{"data": []}'
+    assert not leases.held
+    assert workflows.rows['w']['recent_errors'] == 0
+
+
+@pytest.mark.asyncio
+async def test_execute_setup_error(models):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [{'type': 'info', 'source': 'deleted'}])
+
+    await tasks._execute('w')
+    job = next(iter(jobs.rows.values()))
+    # failed rather than left started, so it is not resumed
+    assert job['status'] == 'Failed'
+    assert 'ValueError' in job['result']
+    assert not leases.held
+    assert workflows.rows['w']['recent_errors'] == 1
+
+
+@pytest.mark.asyncio
+async def test_execute_in_order(models):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [
+        {'type': 'info', 'source': 'a'},
+        {'type': 'info', 'source': 'b'}
+    ])
+
+    await tasks._execute('w')
+    job = next(iter(jobs.rows.values()))
+    # one runner per step, so that each step's progress is recorded
+    assert FakeRunner.names == ['test.0', 'test.1']
+    assert job['result'] == '{"data": [{}, {}]}'
+    assert jobs.progress[job['id']] == {'0': {}, '1': {}}
+
+
+@pytest.mark.asyncio
+async def test_execute_resume(models):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [
+        {'type': 'info', 'source': 'a'},
+        {'type': 'info', 'source': 'b'}
+    ])
+    jobs.rows['j'] = {'id': 'j', 'status': 'Queued'}
+    jobs.progress['j'] = {'0': {'done': True}}
+
+    await tasks._execute('w', 'j', token='token')
+    job = jobs.rows['j']
+    # a resumed plain workflow only runs the steps it had not completed
+    assert FakeRunner.names == ['test.1']
+    assert job['status'] == 'Succeeded'
+    assert job['result'] == '{"data": [{"done": true}, {}]}'
+
+
+@pytest.mark.parametrize('renewal', ['expired', 'error'])
+@pytest.mark.asyncio
+async def test_execute_lease_expired(models, monkeypatch, renewal):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [{'type': 'info', 'source': 'a', 'seconds': 5}])
+
+    async def renew(job_id, token):
+        if renewal == 'error':
+            raise ValueError('database is locked')
+        return False
+
+    monkeypatch.setattr(leases, 'renew', renew)
+    with override_settings(LEASE_DURATION=0.03):
+        await asyncio.wait_for(tasks._execute('w'), timeout=1)
+    job = next(iter(jobs.rows.values()))
+    # stopped, rather than running on without a slot
+    assert job['status'] == 'Failed'
+    assert 'expired while running' in job['result']
+    assert not leases.held
+    with open(job['log']) as log:
+        logged = log.read()
+    assert ('Failed to renew lease' in logged) == (renewal == 'error')
+
+
+@pytest.mark.asyncio
+async def test_dispatch_priority(models, monkeypatch):
+    workflows, jobs, leases = models
+    add_workflow(workflows, [])
+    jobs.rows['j'] = {'id': 'j', 'status': 'Queued', 'priority': MANUAL}
+    jobs.rows['k'] = {'id': 'k', 'status': 'Queued', 'priority': None}
+
+    calls = []
+    monkeypatch.setattr(
+        tasks, 'execute', lambda *args, **kwargs: calls.append((args, kwargs))
+    )
+    with override_settings(ASYNC_TASKS=True):
+        await tasks.dispatch('w')
+    # all queued jobs with free slots are started,
+    # and a queued manual run stays in the manual lane
+    assert calls == [
+        (('w', 'j', 'token'), {'priority': MANUAL}),
+        (('w', 'k', 'token'), {'priority': None})
+    ]
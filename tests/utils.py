@@ -1,3 +1,5 @@
+import sqlite3
+
 from cloudcopy.server.config import settings
 
 class override_settings():
@@ -10,9 +12,183 @@ class override_settings():
 
     def reset(self, source, backup=None):
         for key, value in source.items():
-            if backup:
-                backup[key] = value
+            if backup is not None:
+                backup[key] = getattr(settings, key)
             setattr(settings, key, value)
 
     def __exit__(self, *args, **kwargs):
         self.reset(self.backup)
+
+
+# in-memory stand-ins for adbc's databases, shared by the unit tests
+def to_value(literal):
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    return int(literal)
+
+
+def matches(condition, row):
+    operator, args = next(iter(condition.items()))
+    if operator == 'or':
+        return any(matches(arg, row) for arg in args)
+    if operator == 'and':
+        return all(matches(arg, row) for arg in args)
+    column, value = args
+    if operator == 'in':
+        return row[column] in [to_value(v) for v in value]
+    value = to_value(value)
+    return {
+        '>': row[column] > value,
+        '>=': row[column] >= value,
+        '<=': row[column] <= value,
+        '=': row[column] == value
+    }[operator]
+
+
+class FakeQuery(object):
+    """In-memory stand-in for a table's query model"""
+    def __init__(
+        self,
+        rows,
+        condition=None,
+        order=(),
+        size=None,
+        values=None,
+        fields=None,
+        state=None
+    ):
+        self.rows = rows
+        # shared by the queries of a test, e.g. counters
+        self.state = state
+        self.condition = condition
+        self.order = order
+        self.size = size
+        self.data = values
+        self.fields = fields
+
+    def copy(self, **kwargs):
+        options = {
+            'condition': self.condition,
+            'order': self.order,
+            'size': self.size,
+            'fields': self.fields,
+            'state': self.state
+        }
+        options.update(kwargs)
+        return self.__class__(self.rows, **options)
+
+    def where(self, condition):
+        return self.copy(condition=condition)
+
+    def sort(self, *order):
+        return self.copy(order=order)
+
+    def limit(self, size):
+        return self.copy(size=size)
+
+    def take(self, *fields):
+        return self.copy(fields=fields)
+
+    def values(self, values):
+        return self.__class__(self.rows, values=values, state=self.state)
+
+    async def get(self):
+        rows = [
+            dict(row) for row in self.rows
+            if not self.condition or matches(self.condition, row)
+        ]
+        rows.sort(key=lambda row: tuple(row[o] for o in self.order))
+        if self.fields:
+            rows = [{f: row[f] for f in self.fields} for row in rows]
+        return rows[:self.size]
+
+    async def delete(self):
+        self.rows[:] = [
+            row for row in self.rows if not matches(self.condition, row)
+        ]
+
+    async def add(self):
+        self.rows.extend(self.data)
+
+
+class FakeDatabase(object):
+    query_class = FakeQuery
+
+    def __init__(self, rows, state=None, table='test'):
+        self.rows = rows
+        self.state = state
+        self.table = table
+
+    async def get_model(self, table):
+        return self.query_class(self.rows, state=self.state)
+
+    async def query(self, sql, *params):
+        """Run raw SQL on a SQLite copy of the rows"""
+        columns = sorted({column for row in self.rows for column in row})
+        connection = sqlite3.connect(':memory:')
+        connection.execute(
+            f'CREATE TABLE "{self.table}" '
+            f'({", ".join(f"{column!r}" for column in columns)})'
+        )
+        connection.executemany(
+            f'INSERT INTO "{self.table}" VALUES '
+            f'({", ".join("?" for _ in columns)})',
+            [[row.get(column) for column in columns] for row in self.rows]
+        )
+        return connection.execute(sql, params).fetchall()
+
+
+class SqliteDatabase(object):
+    """Stand-in for the internal database handle, on an in-memory SQLite
+
+    For models' raw SQL statements, e.g. Lease.acquire
+    """
+    def __init__(self, schema):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.executescript(schema)
+        # statements run with execute
+        self.executed = []
+
+    async def execute(self, sql, *params):
+        self.executed.append(sql)
+        self.connection.execute(sql, params)
+        self.connection.commit()
+
+    async def query(self, sql, *params):
+        rows = self.connection.execute(sql, params).fetchall()
+        self.connection.commit()
+        return rows
+
+    async def query_one_value(self, sql, *params):
+        rows = await self.query(sql, *params)
+        return rows[0][0] if rows else None
+
+    def get_query(self, name=None):
+        """Get a stand-in query model, for raw SQL and inserts only"""
+        return SqliteQuery(self, name)
+
+    async def get_model(self, name):
+        return self.get_query(name)
+
+    def model(self, cls):
+        return cls(self.get_query(getattr(cls, 'name', None)))
+
+
+class SqliteQuery(object):
+    def __init__(self, database, name, data=None):
+        self.database = database
+        self.name = name
+        self.data = data
+
+    def values(self, data):
+        return SqliteQuery(self.database, self.name, data)
+
+    async def add(self):
+        rows = self.data if isinstance(self.data, list) else [self.data]
+        for row in rows:
+            columns = ', '.join(f'"{column}"' for column in row)
+            marks = ', '.join('?' for _ in row)
+            await self.database.execute(
+                f'INSERT INTO "{self.name}" ({columns}) VALUES ({marks})',
+                *row.values()
+            )